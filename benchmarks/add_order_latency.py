@@ -0,0 +1,134 @@
+'''
+    Latency of the add_order write path, before and after switching to INSERT ... RETURNING.
+
+    The legacy path is a copy of the original add_order (ORM add, flush, then one refresh
+    for the order and one per item). Both paths run against the same freshly created SQLite
+    database and are timed end to end, including the commit.
+
+    export PYTHONPATH="$PYTHONPATH:./src/"; poetry run python -m benchmarks.add_order_latency
+'''
+import argparse
+import datetime
+import statistics
+import time
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+from pier2.models import Base, Orders, OrderItems, CustomerAddresess, Customers, Items, Stores, FulfillmentModality, OrderSource
+from pier2.routers.orders import add_order
+from pier2.schemas import NewOrder, NewOrderItem
+
+ITEM_COUNTS = [1, 10, 50, 100]
+
+
+def legacy_add_order(order: NewOrder, items, db):
+    db_order = Orders(**order.dict())
+    items = [OrderItems(**item.dict()) for item in items]
+
+    for item in items:
+        item.order = db_order
+
+    db_order.items = items
+    db.add(db_order)
+    results = db.query(CustomerAddresess).filter(
+        CustomerAddresess.customer_address_id == order.dict()['billing_address_id']).first()
+    assert results and results.is_billing
+
+    shipping_home_address_ids = [item.dest_customer_address_id for item in items
+                                 if item.fulfillment_modality in
+                                 [FulfillmentModality.store_to_home, FulfillmentModality.ware_to_home]]
+    db.query(CustomerAddresess).filter(
+        CustomerAddresess.customer_address_id.in_(shipping_home_address_ids)).all()
+
+    db.flush()
+    db.refresh(db_order)
+    for item in items:
+        db.refresh(item)
+
+    db.commit()
+    return db_order
+
+
+def returning_add_order(order: NewOrder, items, db):
+    return add_order(order = order, items = items, db = db)
+
+
+def setup(url, max_items):
+    engine = create_engine(url)
+    Base.metadata.create_all(engine)
+    Session = sessionmaker(bind = engine, autoflush = False)
+
+    with Session() as db:
+        customer = Customers(email = "pink@floyd.com", first_name = "Pink", last_name = "Floyd")
+        db.add(customer)
+        db.flush()
+        address = CustomerAddresess(customer_id = customer.customer_id, address_line_1 = "34 Haight",
+                                    city = "San Francisco", state = "CA", zip_code = "94131",
+                                    is_billing = True, is_shipping = True)
+        store = Stores()
+        db.add_all([address, store] + [Items() for _ in range(max_items)])
+        db.commit()
+        ids = (customer.customer_id, address.customer_address_id, store.store_id)
+
+    return engine, Session, ids
+
+
+def make_payload(ids, num_items):
+    customer_id, address_id, store_id = ids
+    order = NewOrder(customer_id = customer_id,
+                     time_of_order = datetime.datetime(2025, 2, 9, 14, 14, 37),
+                     source = OrderSource.online,
+                     billing_address_id = address_id)
+    items = [NewOrderItem(item_id = item_id,
+                          fulfillment_modality = FulfillmentModality.store_to_home,
+                          quantity = 1,
+                          price_per_item = 9.99,
+                          source_store_id = store_id,
+                          dest_customer_address_id = address_id) for item_id in range(1, num_items + 1)]
+    return order, items
+
+
+def run(path, engine, Session, ids, num_items, repeats):
+    statements = 0
+
+    def count(*args):
+        nonlocal statements
+        statements += 1
+
+    event.listen(engine, "before_cursor_execute", count)
+    order, items = make_payload(ids, num_items)
+    timings = []
+    for _ in range(repeats):
+        with Session() as db:
+            start = time.perf_counter()
+            path(order, items, db)
+            timings.append((time.perf_counter() - start) * 1000)
+    event.remove(engine, "before_cursor_execute", count)
+
+    timings.sort()
+    return {
+        'p50_ms': statistics.median(timings),
+        'p95_ms': timings[int(0.95 * (len(timings) - 1))],
+        'statements': statements / repeats,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default = "sqlite:///:memory:", help = "Database to benchmark against.")
+    parser.add_argument("--repeats", type = int, default = 200)
+    parser.add_argument("--items", type = int, nargs = "+", default = ITEM_COUNTS)
+    args = parser.parse_args()
+
+    engine, Session, ids = setup(args.url, max(args.items))
+
+    print(f"{'items':>6} {'path':>10} {'p50 ms':>9} {'p95 ms':>9} {'stmts':>7}")
+    for num_items in args.items:
+        for name, path in [("legacy", legacy_add_order), ("returning", returning_add_order)]:
+            r = run(path, engine, Session, ids, num_items, args.repeats)
+            print(f"{num_items:>6} {name:>10} {r['p50_ms']:>9.3f} {r['p95_ms']:>9.3f} {r['statements']:>7.1f}")
+
+
+if __name__ == "__main__":
+    main()
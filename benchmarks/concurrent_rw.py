@@ -0,0 +1,156 @@
+'''
+    Analytics reads running concurrently with add_order writes on a file backed SQLite database,
+    with SQLite's defaults (rollback journal, synchronous=FULL) and with the pragmas database.py
+    applies (WAL, synchronous=NORMAL, busy_timeout, mmap and cache size).
+
+    In rollback journal mode a committing writer locks readers out of the whole file, so the
+    reader latency tail follows the writers. In WAL mode readers work off a snapshot and only
+    writers serialize among themselves.
+
+    export PYTHONPATH="$PYTHONPATH:./src/"; poetry run python -m benchmarks.concurrent_rw
+'''
+import argparse
+import datetime
+import os
+import random
+import shutil
+import statistics
+import tempfile
+import threading
+import time
+
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import sessionmaker
+
+from pier2 import rollups
+from pier2.database import engine_options, apply_sqlite_pragmas
+from pier2.models import Base, Customers, CustomerAddresess, Items, Stores, FulfillmentModality, OrderSource, BillingZipOrderCounts
+from pier2.routers.orders import add_order, add_orders_bulk
+from pier2.schemas import NewOrder, NewOrderItem, NewBulkOrder
+
+# SQLite's own defaults, busy_timeout kept so readers wait on locks instead of failing.
+ROLLBACK_JOURNAL = {"journal_mode": "DELETE", "synchronous": "FULL", "busy_timeout": 5000,
+                    "mmap_size": None, "cache_size": None}
+
+
+def make_order(customer_id, address_id, store_id, item_ids):
+    order = NewOrder(customer_id = customer_id,
+                     time_of_order = datetime.datetime(2025, 2, 9, random.randint(1, 23), random.randint(0, 59)),
+                     source = random.choice(list(OrderSource)),
+                     billing_address_id = address_id)
+    items = [NewOrderItem(item_id = item_id,
+                          fulfillment_modality = FulfillmentModality.store_to_home,
+                          quantity = 1,
+                          price_per_item = 9.99,
+                          source_store_id = store_id,
+                          dest_customer_address_id = address_id) for item_id in random.sample(item_ids, 3)]
+    return order, items
+
+
+def seed(path, num_customers, num_orders):
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(engine)
+    Session = sessionmaker(bind = engine, autoflush = False)
+
+    with Session() as db:
+        db.add(Stores())
+        db.add_all([Items() for _ in range(20)])
+        db.add_all([Customers(email = f"{i}@piertwo.com", first_name = "Pink", last_name = "Floyd")
+                    for i in range(num_customers)])
+        db.flush()
+        db.add_all([CustomerAddresess(customer_id = i + 1, address_line_1 = "34 Haight", city = "San Francisco",
+                                      state = "CA", zip_code = f"{94000 + i % 500}", is_billing = True,
+                                      is_shipping = True) for i in range(num_customers)])
+        db.commit()
+
+    customers = [(i + 1, i + 1) for i in range(num_customers)]
+    item_ids = list(range(1, 21))
+    with Session() as db:
+        for start in range(0, num_orders, 10000):
+            batch = [NewBulkOrder(order = order, items = items) for order, items in
+                     (make_order(*random.choice(customers), 1, item_ids) for _ in range(min(10000, num_orders - start)))]
+            add_orders_bulk(orders = batch, db = db)
+    engine.dispose()
+    return customers, item_ids
+
+
+def run(path, pragmas, customers, item_ids, readers, writers, duration):
+    url = f"sqlite:///{path}"
+    engine = create_engine(url, **engine_options(url, {"size": readers + writers}))
+    apply_sqlite_pragmas(engine, pragmas)
+    Session = sessionmaker(bind = engine, autoflush = False)
+
+    read_latencies, write_latencies, errors = [], [], []
+    deadline = time.perf_counter() + duration
+
+    def reader():
+        queries = [rollups.billing_zip_counts_query(), rollups.shipping_zip_counts_query(),
+                   select(BillingZipOrderCounts)]
+        while time.perf_counter() < deadline:
+            with Session() as db:
+                start = time.perf_counter()
+                try:
+                    db.execute(random.choice(queries)).all()
+                    read_latencies.append(time.perf_counter() - start)
+                except Exception as e:
+                    errors.append(e)
+
+    def writer():
+        while time.perf_counter() < deadline:
+            order, items = make_order(*random.choice(customers), 1, item_ids)
+            with Session() as db:
+                start = time.perf_counter()
+                try:
+                    add_order(order = order, items = items, db = db)
+                    write_latencies.append(time.perf_counter() - start)
+                except Exception as e:
+                    errors.append(e)
+
+    threads = [threading.Thread(target = reader) for _ in range(readers)] + \
+              [threading.Thread(target = writer) for _ in range(writers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    engine.dispose()
+
+    def percentiles(latencies):
+        latencies = sorted(latencies) or [0]
+        return (statistics.median(latencies) * 1000,
+                latencies[int(0.99 * (len(latencies) - 1))] * 1000,
+                latencies[-1] * 1000)
+
+    return {
+        "reads_per_sec": len(read_latencies) / duration,
+        "read_ms": percentiles(read_latencies),
+        "writes_per_sec": len(write_latencies) / duration,
+        "write_ms": percentiles(write_latencies),
+        "errors": len(errors),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--customers", type = int, default = 2000)
+    parser.add_argument("--orders", type = int, default = 50000)
+    parser.add_argument("--readers", type = int, default = 4)
+    parser.add_argument("--writers", type = int, default = 2)
+    parser.add_argument("--duration", type = float, default = 10)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        seeded = os.path.join(workdir, "seeded.db")
+        customers, item_ids = seed(seeded, args.customers, args.orders)
+
+        print(f"{'mode':>16} {'reads/s':>8} {'read p50':>9} {'read p99':>9} {'read max':>9} "
+              f"{'writes/s':>9} {'write p99':>10} {'errors':>7}")
+        for name, pragmas in [("rollback journal", ROLLBACK_JOURNAL), ("tuned (WAL)", None)]:
+            path = os.path.join(workdir, f"{name.split()[0]}.db")
+            shutil.copy(seeded, path)
+            r = run(path, pragmas, customers, item_ids, args.readers, args.writers, args.duration)
+            print(f"{name:>16} {r['reads_per_sec']:>8.1f} {r['read_ms'][0]:>9.2f} {r['read_ms'][1]:>9.2f} "
+                  f"{r['read_ms'][2]:>9.2f} {r['writes_per_sec']:>9.1f} {r['write_ms'][1]:>10.2f} {r['errors']:>7}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+'''
+    Requests/sec of the service in sync and async database mode at increasing client concurrency.
+
+    For every mode a uvicorn server is started on a fresh file backed SQLite database (through
+    PIER2_CONFIG), seeded over HTTP, and then hit by N concurrent clients for a fixed duration
+    with a read heavy mix: entity GETs, order GETs, /query aggregates and a share of add_order.
+
+    Async mode needs: poetry run pip install "sqlalchemy[asyncio]" aiosqlite
+
+    export PYTHONPATH="$PYTHONPATH:./src/"; poetry run python -m benchmarks.load
+'''
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+import yaml
+from sqlalchemy import create_engine
+
+from pier2.models import Base
+
+CONCURRENCY = [1, 64, 512]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(workdir, mode, database_url):
+    config_path = os.path.join(workdir, f"{mode}.yaml")
+    with open(config_path, "w") as f:
+        yaml.safe_dump({"database": {"url": database_url, "mode": mode}}, f)
+
+    engine = create_engine(database_url)
+    Base.metadata.create_all(engine)
+    engine.dispose()
+
+    port = free_port()
+    env = dict(os.environ, PIER2_CONFIG = config_path)
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "pier2.main:app", "--port", str(port),
+         "--log-level", "warning", "--no-access-log"],
+        env = env, stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+
+    base_url = f"http://127.0.0.1:{port}"
+    for _ in range(100):
+        try:
+            httpx.get(base_url + "/")
+            return server, base_url
+        except httpx.TransportError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError(f"Server for {mode} mode did not start.")
+
+
+def seed(base_url, num_customers, orders_per_customer):
+    with httpx.Client(base_url = base_url, timeout = 60) as client:
+        store_id = client.post("/stores/", json = {}).json()["store_id"]
+        item_ids = [client.post("/items/", json = {}).json()["item_id"] for _ in range(20)]
+        customers = []
+        bulk = []
+        for i in range(num_customers):
+            customer_id = client.post("/customers/", json = {
+                "email": f"{i}@piertwo.com", "first_name": "Pink", "last_name": "Floyd"}).json()["customer_id"]
+            address_id = client.post("/customers/addresses", json = {
+                "customer_id": customer_id, "address_line_1": "34 Haight", "city": "San Francisco",
+                "state": "CA", "zip_code": f"{94000 + i % 100}", "is_billing": True,
+                "is_shipping": True}).json()["customer_address_id"]
+            customers.append((customer_id, address_id))
+            for j in range(orders_per_customer):
+                bulk.append(order_payload(customer_id, address_id, store_id, item_ids))
+
+        resp = client.post("/orders/bulk", json = bulk)
+        resp.raise_for_status()
+        order_ids = [i for i in resp.json()["order_ids"] if i]
+    return customers, order_ids, store_id, item_ids
+
+
+def order_payload(customer_id, address_id, store_id, item_ids):
+    return {
+        "order": {"customer_id": customer_id, "time_of_order": "2025-02-09 14:14:37",
+                  "source": random.choice([1, 2]), "billing_address_id": address_id},
+        "items": [{"item_id": item_id, "fulfillment_modality": 3, "quantity": 1, "price_per_item": 9.99,
+                   "source_store_id": store_id, "dest_customer_address_id": address_id}
+                  for item_id in random.sample(item_ids, 3)],
+    }
+
+
+def next_request(data, write_ratio):
+    customers, order_ids, store_id, item_ids = data
+    customer_id, address_id = random.choice(customers)
+    if random.random() < write_ratio:
+        return "POST", "/orders/", order_payload(customer_id, address_id, store_id, item_ids)
+    return "GET", random.choice([
+        f"/customers/{customer_id}",
+        f"/customers/addresses/{address_id}",
+        f"/orders/{random.choice(order_ids)}",
+        "/query/count_billing_orders",
+        "/query/count_by_shipping_zip",
+        "/query/instore_shoppers",
+    ]), None
+
+
+class Connection:
+    '''
+        Minimal keep-alive HTTP/1.1 client. httpx's async pool costs more CPU per request than
+        the service itself at high concurrency, which on a small machine hides the server.
+    '''
+    def __init__(self, host, port):
+        self.host, self.port = host, port
+
+    async def open(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+
+    async def request(self, method, path, body = None):
+        payload = json.dumps(body).encode() if body is not None else b""
+        self.writer.write((f"{method} {path} HTTP/1.1\r\nHost: {self.host}\r\n"
+                           f"Content-Type: application/json\r\nContent-Length: {len(payload)}\r\n\r\n").encode()
+                          + payload)
+        status_line, _, headers = (await self.reader.readuntil(b"\r\n\r\n")).partition(b"\r\n")
+        length = 0
+        for header in headers.split(b"\r\n"):
+            name, _, value = header.partition(b":")
+            if name.lower() == b"content-length":
+                length = int(value)
+        await self.reader.readexactly(length)
+        return int(status_line.split()[1])
+
+    def close(self):
+        self.writer.close()
+
+
+async def run_load(base_url, data, concurrency, duration, write_ratio):
+    latencies = []
+    errors = 0
+    host, port = httpx.URL(base_url).host, httpx.URL(base_url).port
+
+    async def worker():
+        nonlocal errors
+        connection = Connection(host, port)
+        await connection.open()
+        try:
+            while time.perf_counter() < deadline:
+                method, path, body = next_request(data, write_ratio)
+                start = time.perf_counter()
+                try:
+                    if await connection.request(method, path, body) != 200:
+                        errors += 1
+                except (OSError, asyncio.IncompleteReadError):
+                    errors += 1
+                    connection.close()
+                    await connection.open()
+                latencies.append(time.perf_counter() - start)
+        finally:
+            connection.close()
+
+    deadline = time.perf_counter() + duration
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "requests_per_sec": len(latencies) / elapsed,
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p99_ms": latencies[int(0.99 * (len(latencies) - 1))] * 1000,
+        "errors": errors,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modes", nargs = "+", default = ["sync", "async"], choices = ["sync", "async"])
+    parser.add_argument("--concurrency", type = int, nargs = "+", default = CONCURRENCY)
+    parser.add_argument("--duration", type = float, default = 10, help = "Seconds per concurrency level.")
+    parser.add_argument("--write-ratio", type = float, default = 0.05)
+    parser.add_argument("--customers", type = int, default = 200)
+    parser.add_argument("--orders-per-customer", type = int, default = 10)
+    args = parser.parse_args()
+
+    print(f"{'mode':>6} {'clients':>8} {'req/s':>9} {'p50 ms':>9} {'p99 ms':>9} {'errors':>7}")
+    with tempfile.TemporaryDirectory() as workdir:
+        for mode in args.modes:
+            server, base_url = start_server(workdir, mode, f"sqlite:///{workdir}/{mode}.db")
+            try:
+                data = seed(base_url, args.customers, args.orders_per_customer)
+                for concurrency in args.concurrency:
+                    r = asyncio.run(run_load(base_url, data, concurrency, args.duration, args.write_ratio))
+                    print(f"{mode:>6} {concurrency:>8} {r['requests_per_sec']:>9.1f} {r['p50_ms']:>9.2f} "
+                          f"{r['p99_ms']:>9.2f} {r['errors']:>7}")
+            finally:
+                server.terminate()
+                server.wait()
+
+
+if __name__ == "__main__":
+    main()
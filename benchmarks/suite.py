@@ -0,0 +1,322 @@
+'''
+    Latency and throughput of every endpoint on databases seeded with 10^4 to 10^7 orders.
+
+    The data comes from the generators of tests/test_suite.py (get_customers_df,
+    get_customer_addresses_df, get_orders_df), run in chunks of customers with their ids shifted
+    so that they add up to one consistent dataset, and loaded with pier2.seed.
+
+    Every endpoint is then called sequentially in process (no network) and its p50/p95/p99
+    latency and requests/sec are recorded, for each backend (in-memory SQLite, SQLite file, or
+    any --url) and scale. The entity and query caches are cleared before every timed request
+    unless --cached is given, so by default the numbers are those of the database path.
+
+    Results are written as JSON. Given a --baseline (the JSON of an earlier run) the run exits
+    non zero if an endpoint's p95 or throughput regressed by more than --tolerance.
+
+    export PYTHONPATH="$PYTHONPATH:./src/"; poetry run python -m benchmarks.suite --orders 10000 100000
+'''
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import tempfile
+import time
+
+import sqlalchemy
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, insert
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from pier2 import rollups, seed as pier2_seed
+from pier2.cache import entity_cache, query_cache
+from pier2.database import get_db, get_read_db, engine_options, apply_sqlite_pragmas
+from pier2.main import app
+from pier2.models import Base, Items, Stores, Warehouses
+from tests.test_suite import get_customers_df, get_customer_addresses_df, get_orders_df
+
+SCALES = [10 ** 4]
+BACKENDS = ["memory", "file"]
+CUSTOMERS_PER_CHUNK = 200
+
+NUM_ITEMS = 100
+NUM_STORES = 10
+NUM_WAREHOUSES = 10
+
+ITEM_ID_COLUMNS = ["source_warehouse_id", "source_store_id", "dest_store_id", "dest_customer_address_id"]
+
+
+def create_backend_engine(backend, workdir, url = None):
+    if backend == "memory":
+        return create_engine("sqlite://", poolclass = StaticPool, connect_args = {"check_same_thread": False})
+    if backend == "file":
+        url = f"sqlite:///{workdir}/suite.db"
+    engine = create_engine(url, **engine_options(url))
+    apply_sqlite_pragmas(engine)
+    return engine
+
+
+def generate(num_orders, item_ids, store_ids, warehouse_ids):
+    '''
+        Yields (customers, addresses, orders, order_items) dataframes of CUSTOMERS_PER_CHUNK
+        customers each, with ids continuing from the previous chunk, until num_orders orders.
+    '''
+    customer_offset = address_offset = order_offset = chunk = 0
+    while order_offset < num_orders:
+        customers = get_customers_df(CUSTOMERS_PER_CHUNK)
+        addresses = get_customer_addresses_df(list(customers.customer_id))
+        orders, order_items = get_orders_df(customers, addresses, item_ids, store_ids, warehouse_ids)
+
+        orders = orders[orders.order_id <= num_orders - order_offset]
+        order_items = order_items[order_items.order_id.isin(orders.order_id)].copy()
+
+        customers["email"] = f"{chunk}." + customers.email
+        # NewOrder rejects timestamps at exactly midnight as missing their time.
+        orders["time_of_order"] = orders.time_of_order.str.replace(" 00:00:00", " 00:00:01")
+        for df, column, offset in [(customers, "customer_id", customer_offset),
+                                   (addresses, "customer_id", customer_offset),
+                                   (addresses, "customer_address_id", address_offset),
+                                   (orders, "customer_id", customer_offset),
+                                   (orders, "billing_address_id", address_offset),
+                                   (orders, "order_id", order_offset),
+                                   (order_items, "order_id", order_offset),
+                                   (order_items, "dest_customer_address_id", address_offset)]:
+            df[column] += offset
+
+        customer_offset += len(customers)
+        address_offset += len(addresses)
+        order_offset += len(orders)
+        chunk += 1
+        yield customers, addresses, orders, order_items
+
+
+def bulk_payload(orders, order_items):
+    '''
+        POST /orders/bulk body, the NaNs of the optional item columns are left out.
+    '''
+    items_by_order = {}
+    for item in order_items.drop(columns = ["order_item_id"]).to_dict("records"):
+        for column in ITEM_ID_COLUMNS:
+            if column in item and item[column] == item[column]:
+                item[column] = int(item[column])
+            else:
+                item.pop(column, None)
+        items_by_order.setdefault(item.pop("order_id"), []).append(item)
+
+    return [{"order": {k: v for k, v in order.items() if k != "order_id"},
+             "items": items_by_order.get(order["order_id"], [])}
+            for order in orders.to_dict("records")]
+
+
+def seed(Session, num_orders):
+    '''
+        Returns what the requests are drawn from: customer ids, emails, address ids, order ids
+        and some order payloads.
+    '''
+    with Session() as db:
+        db.execute(insert(Items), [{"item_id": i} for i in range(1, NUM_ITEMS + 1)])
+        db.execute(insert(Stores), [{"store_id": i} for i in range(1, NUM_STORES + 1)])
+        db.execute(insert(Warehouses), [{"warehouse_id": i} for i in range(1, NUM_WAREHOUSES + 1)])
+        db.commit()
+
+    data = {"customer_ids": [], "emails": [], "address_ids": [], "order_ids": [], "payloads": []}
+    for customers, addresses, orders, order_items in generate(num_orders, list(range(1, NUM_ITEMS + 1)),
+                                                              list(range(1, NUM_STORES + 1)),
+                                                              list(range(1, NUM_WAREHOUSES + 1))):
+        with Session() as db:
+            pier2_seed.seed(db, customers, addresses, orders, order_items, rebuild_rollups = False)
+
+        data["customer_ids"].extend(customers.customer_id)
+        data["emails"].extend(customers.email)
+        data["address_ids"].extend(addresses.customer_address_id)
+        data["order_ids"].extend(orders.order_id)
+        data["payloads"].extend(bulk_payload(orders.sample(min(len(orders), 100)), order_items))
+
+    with Session() as db:
+        rollups.rebuild(db)
+        db.commit()
+    return data
+
+
+def endpoints(data):
+    '''
+        name -> function returning (method, path, params, json) of a random request. Writes come
+        last so the reads see the seeded data.
+    '''
+    def get(path, params = None):
+        return lambda: ("GET", path() if callable(path) else path, params() if callable(params) else params, None)
+
+    customer_id = lambda: random.choice(data["customer_ids"])
+    email = lambda: {"email": random.choice(data["emails"])}
+    year = datetime.datetime.now().year
+    window = {"start": f"{year - 1}-01-01T00:00:00", "end": f"{year - 1}-04-01T00:00:00"}
+
+    return {
+        "GET /customers/{id}": get(lambda: f"/customers/{customer_id()}"),
+        "GET /customers/addresses/{id}": get(lambda: f"/customers/addresses/{random.choice(data['address_ids'])}"),
+        "GET /orders/{id}": get(lambda: f"/orders/{random.choice(data['order_ids'])}"),
+        "GET /items/{id}": get(lambda: f"/items/{random.randint(1, NUM_ITEMS)}"),
+        "GET /stores/{id}": get(lambda: f"/stores/{random.randint(1, NUM_STORES)}"),
+        "GET /warehouses/{id}": get(lambda: f"/warehouses/{random.randint(1, NUM_WAREHOUSES)}"),
+        "GET /query/order_history": get("/query/order_history", email),
+        "GET /query/order_history?limit": get("/query/order_history", lambda: dict(email(), limit = 10)),
+        "GET /query/order_history?stream": get("/query/order_history", lambda: dict(email(), stream = True)),
+        "GET /query/order_history?fast": get("/query/order_history", lambda: dict(email(), fast = True)),
+        "GET /query/count_billing_orders": get("/query/count_billing_orders"),
+        "GET /query/count_by_shipping_zip": get("/query/count_by_shipping_zip"),
+        "GET /query/instore_shoppers": get("/query/instore_shoppers", {"top_k": 10}),
+        "GET /query/count_billing_orders?window": get("/query/count_billing_orders", window),
+        "GET /query/count_by_shipping_zip?window": get("/query/count_by_shipping_zip", window),
+        "GET /query/instore_shoppers?window": get("/query/instore_shoppers", dict(window, top_k = 10)),
+        "GET /query/count_billing_orders?bucket": get("/query/count_billing_orders", dict(window, bucket = "week")),
+        "POST /orders": lambda: ("POST", "/orders", None, random.choice(data["payloads"])),
+        "POST /orders/bulk (100)": lambda: ("POST", "/orders/bulk", None, random.sample(data["payloads"], 100)),
+    }
+
+
+def measure(client, request, num_requests, warmup, cached):
+    latencies = []
+    errors = 0
+    for i in range(warmup + num_requests):
+        method, path, params, body = request()
+        if not cached:
+            entity_cache.clear()
+            query_cache.clear()
+        start = time.perf_counter()
+        resp = client.request(method, path, params = params, json = body)
+        elapsed = time.perf_counter() - start
+        if i >= warmup:
+            latencies.append(elapsed)
+            errors += resp.status_code != 200
+
+    latencies.sort()
+    percentile = lambda p: latencies[int(p * (len(latencies) - 1))] * 1000
+    return {
+        "requests": num_requests,
+        "errors": errors,
+        "mean_ms": statistics.mean(latencies) * 1000,
+        "p50_ms": percentile(0.50),
+        "p95_ms": percentile(0.95),
+        "p99_ms": percentile(0.99),
+        "throughput_rps": num_requests / sum(latencies),
+    }
+
+
+def run(backend, num_orders, args):
+    with tempfile.TemporaryDirectory() as workdir:
+        engine = create_backend_engine(backend, workdir, args.url)
+        Base.metadata.create_all(engine)
+        Session = sessionmaker(bind = engine, autoflush = False)
+
+        def get_session():
+            db = Session()
+            try:
+                yield db
+            finally:
+                db.close()
+
+        previous = dict(app.dependency_overrides)
+        app.dependency_overrides[get_db] = app.dependency_overrides[get_read_db] = get_session
+        entity_cache.clear()
+        query_cache.clear()
+        try:
+            client = TestClient(app, raise_server_exceptions = False)
+            start = time.perf_counter()
+            data = seed(Session, num_orders)
+            print(f"Seeded {len(data['order_ids'])} orders on {backend} in {time.perf_counter() - start:.1f}s")
+
+            results = []
+            for name, request in endpoints(data).items():
+                r = dict(backend = backend, orders = num_orders, endpoint = name,
+                         **measure(client, request, args.requests, args.warmup, args.cached))
+                print(f"{backend:>7} {num_orders:>9} {name:<45} {r['p50_ms']:>8.2f} {r['p95_ms']:>8.2f} "
+                      f"{r['p99_ms']:>8.2f} {r['throughput_rps']:>9.1f} {r['errors']:>6}")
+                results.append(r)
+            return results
+        finally:
+            app.dependency_overrides.clear()
+            app.dependency_overrides.update(previous)
+            engine.dispose()
+
+
+def metadata(args):
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output = True, text = True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "commit": commit,
+        "python": platform.python_version(),
+        "sqlalchemy": sqlalchemy.__version__,
+        "platform": platform.platform(),
+        "requests_per_endpoint": args.requests,
+        "cached": args.cached,
+    }
+
+
+def compare(baseline, results, tolerance):
+    '''
+        Returns a description of every (backend, orders, endpoint) whose p95 latency grew or
+        throughput dropped by more than tolerance (a fraction) against the baseline.
+    '''
+    previous = {(r["backend"], r["orders"], r["endpoint"]): r for r in baseline["results"]}
+    regressions = []
+    for r in results:
+        b = previous.get((r["backend"], r["orders"], r["endpoint"]))
+        if b is None:
+            continue
+        if r["p95_ms"] > b["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{r['backend']} {r['orders']} {r['endpoint']}: "
+                               f"p95 {b['p95_ms']:.2f}ms -> {r['p95_ms']:.2f}ms")
+        if r["throughput_rps"] < b["throughput_rps"] * (1 - tolerance):
+            regressions.append(f"{r['backend']} {r['orders']} {r['endpoint']}: "
+                               f"throughput {b['throughput_rps']:.1f}/s -> {r['throughput_rps']:.1f}/s")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--orders", type = int, nargs = "+", default = SCALES, help = "Orders to seed, 10^4 to 10^7.")
+    parser.add_argument("--backends", nargs = "+", default = BACKENDS, choices = BACKENDS + ["url"])
+    parser.add_argument("--url", help = "Database url for the url backend, e.g. a Postgres database. It must be empty.")
+    parser.add_argument("--requests", type = int, default = 200, help = "Timed requests per endpoint.")
+    parser.add_argument("--warmup", type = int, default = 20)
+    parser.add_argument("--cached", action = "store_true", help = "Keep the entity and query caches between requests.")
+    parser.add_argument("--output", help = "Results file, benchmarks/results/suite-<timestamp>.json by default.")
+    parser.add_argument("--baseline", help = "Results file of an earlier run to compare against.")
+    parser.add_argument("--tolerance", type = float, default = 0.2)
+    args = parser.parse_args()
+    if "url" in args.backends and not args.url:
+        parser.error("The url backend requires --url.")
+
+    print(f"{'backend':>7} {'orders':>9} {'endpoint':<45} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+          f"{'req/s':>9} {'errors':>6}")
+    results = []
+    for num_orders in args.orders:
+        for backend in args.backends:
+            results.extend(run(backend, num_orders, args))
+
+    report = {"meta": metadata(args), "results": results}
+    output = args.output or os.path.join(
+        "benchmarks", "results", f"suite-{datetime.datetime.now().strftime('%Y%m%dT%H%M%S')}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok = True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent = 2)
+    print(f"Results written to {output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(json.load(f), results, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
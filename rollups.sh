@@ -0,0 +1,2 @@
+#!/bin/bash
+export PYTHONPATH="$PYTHONPATH:./src/"; poetry run python -m scripts.rollups "$@"
@@ -0,0 +1,40 @@
+'''
+    Explains the SQL of every /query endpoint and fails if any of it reads a table without an index.
+
+    export PYTHONPATH="$PYTHONPATH:./src/"; poetry run python -m scripts.index_advisor [--url sqlite://]
+'''
+import argparse
+import sys
+from sqlalchemy import create_engine
+from sqlalchemy.pool import StaticPool
+from pier2 import index_advisor
+# The service's config.yaml, or the file PIER2_CONFIG points to.
+from pier2.database import config
+
+parser = argparse.ArgumentParser(description = "Check the /query endpoints for full table scans.")
+parser.add_argument("--url", default = config["database"]["url"],
+                    help = "Database to explain against, defaults to the service's (config.yaml or PIER2_CONFIG).")
+parser.add_argument("--seed", action = "store_true",
+                    help = "Create the schema and add sample rows first. Implied for in-memory SQLite.")
+parser.add_argument("--verbose", action = "store_true", help = "Print every plan.")
+args = parser.parse_args()
+
+in_memory = args.url in ["sqlite://", "sqlite:///:memory:"]
+if in_memory:
+    engine = create_engine(args.url, connect_args = {"check_same_thread": False}, poolclass = StaticPool)
+else:
+    engine = create_engine(args.url)
+
+report = index_advisor.check(engine, seed = args.seed or in_memory)
+
+failed = False
+for path, statement, plan, scans in report:
+    if scans or args.verbose:
+        print(f"{'FULL SCAN of ' + ', '.join(scans) if scans else 'OK'}: {path}")
+        print("    " + " ".join(statement.split()))
+        for line in plan:
+            print(f"        {line}")
+    failed = failed or bool(scans)
+
+print(f"Explained {len(report)} statements, {'some' if failed else 'none'} of them scan a full table.")
+sys.exit(1 if failed else 0)
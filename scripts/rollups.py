@@ -0,0 +1,33 @@
+'''
+    Rebuild or verify the /query rollup tables against orders/order_items.
+
+    export PYTHONPATH="$PYTHONPATH:./src/"; poetry run python -m scripts.rollups verify
+'''
+import argparse
+import sys
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+from pier2 import rollups
+# The service's config.yaml, or the file PIER2_CONFIG points to.
+from pier2.database import DATABASE_URL
+
+parser = argparse.ArgumentParser(description = "Rebuild or verify the /query rollup tables.")
+parser.add_argument("command", choices = ["rebuild", "verify"])
+args = parser.parse_args()
+
+engine = create_engine(DATABASE_URL)
+with Session(engine) as db:
+    if args.command == "rebuild":
+        rollups.rebuild(db)
+        db.commit()
+        print("Rollups rebuilt successfully!")
+
+    diffs = rollups.verify(db)
+    for table, mismatched in diffs.items():
+        print(f"{table}: {len(mismatched)} mismatched keys")
+        for key, expected, actual in mismatched[:20]:
+            print(f"    {key}: expected {expected}, found {actual}")
+
+    if diffs:
+        sys.exit(1)
+    print("Rollups match the base tables.")
@@ -0,0 +1,296 @@
+'''
+    Read-through caches.
+
+    Entity GET endpoints: entries are keyed by (entity, id) and hold the response model, so a
+    hit costs no database round trip and no ORM work. The backend is chosen in config.yaml
+    (cache.backend): an in-process LRU with a TTL by default, or redis to share entries between
+    workers. The POST handlers invalidate the entries of the rows they create once their
+    transaction commits.
+
+    /query/order_history resolves customers by email or phone through a cache of their ids,
+    dropped by POST /customers for the email and phone it registers.
+
+    Recent Idempotency-Keys of POST /orders are kept with the response they got, so retries are
+    answered without querying the order_idempotency_keys table.
+
+    /query aggregates: results are keyed by endpoint, parameters and a data version that the
+    order write paths bump after committing (query_cache in config.yaml). The same version makes
+    up the ETag, so a client holding the current one gets a 304 without any database work.
+'''
+import hashlib
+import logging
+import pickle
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from functools import wraps
+from inspect import iscoroutinefunction
+
+from fastapi import Response
+
+from .database import config, after_commit
+
+logger = logging.getLogger(__name__)
+
+MISSING = object()
+
+
+class CacheBackend:
+    '''
+        Interface of the cache backends. get returns MISSING when the key is absent or expired.
+    '''
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, value):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def stats(self) -> dict:
+        raise NotImplementedError
+
+
+class LRUCache(CacheBackend):
+
+    def __init__(self, maxsize: int = 100000, ttl_seconds: float = 300):
+        self.maxsize = maxsize
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = self.expirations = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return MISSING
+
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return MISSING
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last = False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.evictions = self.expirations = 0
+
+    def stats(self) -> dict:
+        return {"backend": "lru", "size": len(self._entries), "maxsize": self.maxsize,
+                "hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions, "expirations": self.expirations}
+
+
+class RedisCache(CacheBackend):
+    '''
+        Shared between workers. Requires the redis package. Expiry and eviction are left to
+        redis (maxmemory-policy), evictions are read from its INFO stats.
+    '''
+    def __init__(self, url: str, ttl_seconds: float = 300, prefix: str = "pier2:"):
+        import redis
+
+        self.url = url
+        self._redis = redis.Redis.from_url(url)
+        self.ttl_seconds = ttl_seconds
+        self.prefix = prefix
+        self.hits = self.misses = 0
+
+    def _key(self, key) -> str:
+        return self.prefix + ":".join(str(part) for part in key)
+
+    def get(self, key):
+        value = self._redis.get(self._key(key))
+        if value is None:
+            self.misses += 1
+            return MISSING
+        self.hits += 1
+        return pickle.loads(value)
+
+    def set(self, key, value):
+        self._redis.set(self._key(key), pickle.dumps(value), ex = int(self.ttl_seconds))
+
+    def delete(self, key):
+        self._redis.delete(self._key(key))
+
+    def clear(self):
+        keys = list(self._redis.scan_iter(self.prefix + "*"))
+        if keys:
+            self._redis.delete(*keys)
+        self.hits = self.misses = 0
+
+    def stats(self) -> dict:
+        return {"backend": "redis", "hits": self.hits, "misses": self.misses,
+                "evictions": self._redis.info("stats").get("evicted_keys", 0)}
+
+
+def build_cache(settings: dict = None, maxsize: int = 100000, prefix: str = "pier2:") -> CacheBackend:
+    settings = settings or {}
+    backend = settings.get("backend", "lru")
+    if backend == "lru":
+        return LRUCache(settings.get("maxsize", maxsize), settings.get("ttl_seconds", 300))
+    if backend == "redis":
+        return RedisCache(settings["url"], settings.get("ttl_seconds", 300), prefix)
+    raise ValueError(f"Unknown cache backend {backend}.")
+
+
+class DataVersion:
+    '''
+        Monotonic version of the order data in this process. The epoch changes on every start
+        so versions (and ETags) handed out by a previous process are never taken as current.
+    '''
+    def __init__(self):
+        self.epoch = uuid.uuid4().hex[:8]
+        self._version = 0
+        self._lock = threading.Lock()
+
+    @property
+    def value(self) -> str:
+        return f"{self.epoch}.{self._version}"
+
+    def bump(self):
+        with self._lock:
+            self._version += 1
+
+
+class RedisDataVersion:
+    '''
+        Version shared by every worker using the same redis, one GET per read.
+    '''
+    def __init__(self, url: str, key: str = "pier2:data_version"):
+        import redis
+
+        self._redis = redis.Redis.from_url(url)
+        self.key = key
+
+    @property
+    def value(self) -> str:
+        return (self._redis.get(self.key) or b"0").decode()
+
+    def bump(self):
+        self._redis.incr(self.key)
+
+
+entity_cache = build_cache(config.get("cache"), prefix = "pier2:entity:")
+query_cache = build_cache(config.get("query_cache"), maxsize = 1024, prefix = "pier2:query:")
+# ("email" | "phone", value) -> customer_id, resolved by /query/order_history.
+customer_lookup_cache = build_cache(config.get("customer_lookup_cache"), maxsize = 100000, prefix = "pier2:customer:")
+# Idempotency-Key -> (request hash, Order) of recent POST /orders, ahead of order_idempotency_keys.
+idempotency_cache = build_cache(config.get("idempotency_cache"), maxsize = 10000, prefix = "pier2:idempotency:")
+data_version = RedisDataVersion(query_cache.url) if isinstance(query_cache, RedisCache) else DataVersion()
+
+
+def cached(entity: str, schema, id_param: str):
+    '''
+        Caches the handler's result as schema under (entity, <value of id_param>). Only
+        successful lookups are cached, a 404 goes to the database every time.
+    '''
+    def decorator(func):
+        if iscoroutinefunction(func):
+            @wraps(func)
+            async def wrapper(*args, **kwargs):
+                key = (entity, kwargs[id_param])
+                value = entity_cache.get(key)
+                if value is MISSING:
+                    value = schema.model_validate(await func(*args, **kwargs), from_attributes = True)
+                    entity_cache.set(key, value)
+                return value
+        else:
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                key = (entity, kwargs[id_param])
+                value = entity_cache.get(key)
+                if value is MISSING:
+                    value = schema.model_validate(func(*args, **kwargs), from_attributes = True)
+                    entity_cache.set(key, value)
+                return value
+        return wrapper
+    return decorator
+
+
+def invalidate(db, entity: str, *ids):
+    '''
+        Drops the entries once the handler's transaction has committed.
+    '''
+    def drop():
+        for id in ids:
+            entity_cache.delete((entity, id))
+    after_commit(db, drop)
+
+
+def forget_customer_lookups(db, email: str, phone: str = None):
+    '''
+        Drops the customer_lookup_cache entries of email and phone once the handler's
+        transaction has committed.
+    '''
+    def drop():
+        customer_lookup_cache.delete(("email", email))
+        if phone is not None:
+            customer_lookup_cache.delete(("phone", phone))
+    after_commit(db, drop)
+
+
+def data_changed(db):
+    '''
+        Called by the order write paths, the /query results change once they commit.
+    '''
+    after_commit(db, data_version.bump)
+
+
+def query_etag(version: str, endpoint: str, params: dict) -> str:
+    digest = hashlib.sha1(repr((endpoint, sorted(params.items()))).encode()).hexdigest()[:16]
+    return f'"{version}-{digest}"'
+
+
+def cached_query(request, response, endpoint: str, params: dict, compute, snapshot = None, replica: bool = False):
+    '''
+        Returns a 304 if the client already has the current result, else the cached result
+        or compute() for the current data version, with its ETag. A materializer snapshot is
+        answered instead with the ETag of its version and its time in X-As-Of. A replica may
+        lag behind the current version, what it reads is returned without ETag or caching.
+    '''
+    if replica and snapshot is None:
+        response.headers["Cache-Control"] = "no-cache"
+        return compute()
+
+    version = data_version.value if snapshot is None else snapshot.version
+    etag = query_etag(version, endpoint, params)
+    headers = {"ETag": etag} if snapshot is None else {"ETag": etag, "X-As-Of": snapshot.as_of.isoformat()}
+    if etag in [tag.strip() for tag in request.headers.get("if-none-match", "").split(",")]:
+        return Response(status_code = 304, headers = headers)
+
+    response.headers.update(headers)
+    response.headers["Cache-Control"] = "no-cache"
+    if snapshot is not None:
+        return snapshot.value
+
+    key = (endpoint, tuple(sorted(params.items())), version)
+    value = query_cache.get(key)
+    if value is MISSING:
+        value = compute()
+        query_cache.set(key, value)
+    return value
@@ -1,44 +1,374 @@
+import itertools
 import logging
+import os
+import threading
+import time
 import yaml
+from contextvars import ContextVar
 from .models import Base
-from sqlalchemy import create_engine
+from .metrics import instrument_engine
+from .slow_queries import slow_query_log
+from .sketches import sketches
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
 from sqlalchemy.orm import sessionmaker
 from functools import wraps
-from fastapi import HTTPException, status
+from fastapi import HTTPException, Request, status
 
 logger = logging.getLogger(__name__)
 
-def transactional(func):
+# PIER2_CONFIG allows running several servers side by side (e.g. the benchmarks) with different settings.
+CONFIG_PATH = os.environ.get("PIER2_CONFIG", "config.yaml")
+
+with open(CONFIG_PATH, "r") as f:
+    config = yaml.safe_load(f)
+
+DATABASE_URL = config["database"]["url"]
+
+slow_query_log.configure(config.get("slow_queries"))
+sketches.configure(config.get("sketches"))
+
+# "sync": routers run in Starlette's threadpool on a blocking engine.
+# "async": routers run on the event loop, their bodies are executed through AsyncSession.run_sync.
+DATABASE_MODE = config["database"].get("mode", "sync")
+
+ASYNC_DRIVERS = {"sqlite": "sqlite+aiosqlite", "postgresql": "postgresql+asyncpg"}
+
+def _async_url(url: str) -> str:
+    url = make_url(url)
+    return url.set(drivername = ASYNC_DRIVERS[url.get_backend_name()]).render_as_string(hide_password = False)
+
+def _raise_for_failed_transaction(e):
+    logger.error(f"Transaction failed: {e}")
+    if isinstance(e, HTTPException):
+        raise e
+    raise HTTPException(status_code =
+                        status.HTTP_500_INTERNAL_SERVER_ERROR,
+                        detail="An internal server error occurred")
+
+def after_commit(db, callback):
+    '''
+        Runs callback once the transaction of the current transactional handler has committed.
+        Callbacks are dropped if it rolls back.
+    '''
+    db.info.setdefault("after_commit", []).append(callback)
+
+# Time of the last commit of the current request, set by ReadYourWritesMiddleware.
+_request_commit = ContextVar("request_commit", default = None)
+
+def _run_after_commit(db):
+    commit = _request_commit.get()
+    if commit is not None:
+        commit[0] = time.time()
+    for callback in db.info.pop("after_commit", []):
+        try:
+            callback()
+        except Exception as e:
+            logger.error(f"After commit callback failed: {e}")
+
+def _sync_transactional(func):
     @wraps(func)
     def wrapper(*args, **kwargs):
         db = kwargs['db']
         try:
             result = func(*args, **kwargs)
             db.commit()
+            _run_after_commit(db)
             return result
-        except HTTPException as e:
-            db.rollback()
-            logger.error(f"Transaction failed: {e}")
-            raise
         except Exception as e:
             db.rollback()
-            logger.error(f"Transaction failed: {e}")
-            raise HTTPException(status_code =
-                                status.HTTP_500_INTERNAL_SERVER_ERROR,
-                                detail="An internal server error occurred")
-            raise
+            db.info.pop("after_commit", None)
+            _raise_for_failed_transaction(e)
     return wrapper
 
-with open("config.yaml", "r") as f:
-    config = yaml.safe_load(f)
+def _async_session_bound(func, commit: bool):
+    '''
+        Runs the (sync) body of func on the greenlet of the injected AsyncSession, so the
+        request does not hold a threadpool worker while waiting on the database. A plain
+        Session (e.g. injected by the tests) falls back to the sync behaviour.
+    '''
+    sync_func = _sync_transactional(func) if commit else func
 
-DATABASE_URL = config["database"]["url"]
-engine = create_engine(DATABASE_URL)
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        db = kwargs['db']
+        if not isinstance(db, AsyncSession):
+            return sync_func(*args, **kwargs)
+        try:
+            result = await db.run_sync(lambda session: func(*args, **dict(kwargs, db = session)))
+            if commit:
+                await db.commit()
+                _run_after_commit(db)
+            return result
+        except Exception as e:
+            await db.rollback()
+            db.info.pop("after_commit", None)
+            _raise_for_failed_transaction(e)
+    return wrapper
+
+def transactional(func):
+    if DATABASE_MODE == "async":
+        return _async_session_bound(func, commit = True)
+    return _sync_transactional(func)
+
+def read_only(func):
+    '''
+        For handlers that only read. Nothing is committed, the session is released by get_db.
+    '''
+    if DATABASE_MODE == "async":
+        return _async_session_bound(func, commit = False)
+    return func
+
+POOL_DEFAULTS = {
+    "size": 5,
+    "max_overflow": 10,
+    "recycle_seconds": 1800,
+    "timeout_seconds": 30,
+    "pre_ping": True,
+}
+
+# Applied on every new SQLite connection, a value of None leaves SQLite's default in place.
+# WAL lets readers run alongside a writer and only fsyncs at checkpoints with synchronous=NORMAL.
+SQLITE_PRAGMA_DEFAULTS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": 5000,       # ms
+    "mmap_size": 268435456,     # bytes
+    "cache_size": -65536,       # negative is KiB
+}
+
+def _is_sqlite_memory(url) -> bool:
+    url = make_url(url)
+    return url.get_backend_name() == "sqlite" and url.database in [None, "", ":memory:"]
+
+def engine_options(url, pool_settings = None) -> dict:
+    '''
+        create_engine keyword arguments for the pool settings (config.yaml database.pool).
+        In-memory SQLite lives in a single connection and keeps SQLAlchemy's default pool.
+    '''
+    if _is_sqlite_memory(url):
+        return {}
+
+    pool = dict(POOL_DEFAULTS, **(pool_settings or {}))
+    return {
+        "pool_size": pool["size"],
+        "max_overflow": pool["max_overflow"],
+        "pool_recycle": pool["recycle_seconds"],
+        "pool_timeout": pool["timeout_seconds"],
+        "pool_pre_ping": pool["pre_ping"],
+    }
+
+def apply_sqlite_pragmas(engine, pragma_settings = None):
+    '''
+        Sets the pragmas (config.yaml database.sqlite) on each connection of a SQLite engine.
+        Takes the sync engine, for an AsyncEngine pass async_engine.sync_engine.
+    '''
+    if engine.dialect.name != "sqlite":
+        return
+
+    pragmas = dict(SQLITE_PRAGMA_DEFAULTS, **(pragma_settings or {}))
+    if _is_sqlite_memory(engine.url):
+        pragmas.pop("journal_mode")
+    statements = [f"PRAGMA {name} = {value}" for name, value in pragmas.items() if value is not None]
+
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for statement in statements:
+            cursor.execute(statement)
+        cursor.close()
+
+def create_configured_engine(url):
+    engine = create_engine(url, **engine_options(url, config["database"].get("pool")))
+    apply_sqlite_pragmas(engine, config["database"].get("sqlite"))
+    instrument_engine(engine)
+    slow_query_log.install(engine)
+    return engine
+
+engine = create_configured_engine(DATABASE_URL)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
-def get_db():
+REPLICA_DEFAULTS = {
+    "urls": [],
+    "selection": "round_robin",         # or least_loaded
+    "read_your_writes_seconds": 5,      # 0 to always read from the replicas
+}
+
+REPLICA_SETTINGS = dict(REPLICA_DEFAULTS, **(config["database"].get("replicas") or {}))
+
+# Set on the responses of requests that committed, get_read_db reads from the primary while it is recent.
+LAST_WRITE_COOKIE = "pier2_last_write"
+
+class ReadEngines:
+    '''
+        The replica engines get_read_db picks from: in turn (round_robin), or the one with the
+        fewest connections checked out of its pool (least_loaded, ties in turn).
+    '''
+    def __init__(self, engines: list, selection: str = "round_robin"):
+        if selection not in ("round_robin", "least_loaded"):
+            raise ValueError(f"Unknown replica selection {selection}")
+        self.engines = engines
+        self.selection = selection
+        self._turns = itertools.count()
+        self._lock = threading.Lock()
+
+    def pick(self):
+        with self._lock:
+            turn = next(self._turns)
+        if self.selection == "least_loaded":
+            rotated = self.engines[turn % len(self.engines):] + self.engines[:turn % len(self.engines)]
+            return min(rotated, key = lambda engine: engine.pool.checkedout())
+        return self.engines[turn % len(self.engines)]
+
+def _reads_from_primary(request: Request) -> bool:
+    '''
+        Read your writes: a client that committed within read_your_writes_seconds reads from the
+        primary, the replicas may not have caught up yet.
+    '''
+    try:
+        last_write = float(request.cookies[LAST_WRITE_COOKIE])
+    except (KeyError, ValueError):
+        return False
+    return time.time() - last_write < REPLICA_SETTINGS["read_your_writes_seconds"]
+
+class ReadYourWritesMiddleware:
+    '''
+        Sets LAST_WRITE_COOKIE on the response of every request whose transaction committed.
+    '''
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        commit = [None]
+        token = _request_commit.set(commit)
+
+        async def send_with_cookie(message):
+            if message["type"] == "http.response.start" and commit[0] is not None:
+                cookie = (f"{LAST_WRITE_COOKIE}={commit[0]:.3f}; Max-Age={REPLICA_SETTINGS['read_your_writes_seconds']}; "
+                          "Path=/; HttpOnly; SameSite=Lax")
+                message["headers"] = list(message.get("headers", [])) + [(b"set-cookie", cookie.encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_cookie)
+        finally:
+            _request_commit.reset(token)
+
+def on_replica(db) -> bool:
+    '''
+        Whether get_read_db bound db to a replica, whose data may be older than data_version.
+    '''
+    return db.info.get("replica", False)
+
+def get_sync_db():
+    '''
+        A blocking Session in both modes, for long jobs that run in the threadpool (imports).
+    '''
     db = SessionLocal()
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+if DATABASE_MODE == "async":
+    from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, async_session, create_async_engine
+
+    def _create_async_configured_engine(url):
+        try:
+            import greenlet     # required by SQLAlchemy's asyncio extension, checked here to fail early
+            async_engine = create_async_engine(url, **engine_options(url, config["database"].get("pool")))
+        except ImportError as e:
+            raise RuntimeError(f"database.mode async requires the async extra "
+                               f"(pip install 'pier2[async]'): {e}") from e
+        apply_sqlite_pragmas(async_engine.sync_engine, config["database"].get("sqlite"))
+        instrument_engine(async_engine.sync_engine)
+        slow_query_log.install(async_engine.sync_engine)
+        return async_engine
+
+    ASYNC_DATABASE_URL = config["database"].get("async_url") or _async_url(DATABASE_URL)
+    async_engine = _create_async_configured_engine(ASYNC_DATABASE_URL)
+    # Objects must stay loaded after commit, they are serialized outside of the session's greenlet.
+    AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+    async def get_db():
+        async with AsyncSessionLocal() as db:
+            yield db
+
+    read_engines = ReadEngines([_create_async_configured_engine(_async_url(url)) for url in REPLICA_SETTINGS["urls"]],
+                               REPLICA_SETTINGS["selection"]) if REPLICA_SETTINGS["urls"] else None
+
+    async def get_read_db(request: Request):
+        '''
+            get_db for handlers that only read, on a replica when any are configured.
+        '''
+        if read_engines is None or _reads_from_primary(request):
+            session = AsyncSessionLocal()
+        else:
+            session = AsyncSessionLocal(bind = read_engines.pick(), info = {"replica": True})
+        async with session as db:
+            yield db
+else:
+    read_engines = ReadEngines([create_configured_engine(url) for url in REPLICA_SETTINGS["urls"]],
+                               REPLICA_SETTINGS["selection"]) if REPLICA_SETTINGS["urls"] else None
+
+    def get_db():
+        db = SessionLocal()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    def get_read_db(request: Request):
+        '''
+            get_db for handlers that only read, on a replica when any are configured.
+        '''
+        if read_engines is None or _reads_from_primary(request):
+            db = SessionLocal()
+        else:
+            db = SessionLocal(bind = read_engines.pick(), info = {"replica": True})
+        try:
+            yield db
+        finally:
+            db.close()
+
+def stream_partitions(db, statement, size: int, scalars: bool = False):
+    '''
+        Lazily iterates the results of statement in lists of up to size rows using a server side
+        cursor (yield_per). Returns an async iterator when db is the sync facade of an AsyncSession
+        (i.e. inside a read_only/transactional handler in async mode). Handlers return before the
+        response is streamed, so the session is closed here once the results are exhausted.
+    '''
+    statement = statement.execution_options(yield_per = size)
+    adb = async_session(db) if DATABASE_MODE == "async" else None
+
+    if adb is None:
+        def partitions():
+            try:
+                result = db.execute(statement)
+                yield from (result.scalars() if scalars else result).partitions()
+            finally:
+                db.close()
+        return partitions()
+
+    async def async_partitions():
+        try:
+            result = await adb.stream(statement)
+            async for partition in (result.scalars() if scalars else result).partitions():
+                yield partition
+        finally:
+            await adb.close()
+    return async_partitions()
+
+def map_stream(func, iterator):
+    '''
+        map() that also works for the async iterators returned by stream_partitions.
+    '''
+    if hasattr(iterator, "__aiter__"):
+        async def mapped():
+            async for value in iterator:
+                yield func(value)
+        return mapped()
+    return map(func, iterator)
@@ -0,0 +1,155 @@
+'''
+    Incremental writers for the /export endpoints.
+
+    A writer is built from the (name, SQLAlchemy type) pairs of the exported statement's columns.
+    write(rows) encodes one chunk of rows and returns the bytes to send, close() returns whatever
+    ends the file (the Arrow end of stream marker, the Parquet footer). Nothing but the current
+    chunk is held in memory. Enums are written by name, as they are stored.
+
+    The arrow and parquet formats require the pyarrow package.
+'''
+import csv
+import io
+import logging
+
+from sqlalchemy import types
+
+logger = logging.getLogger(__name__)
+
+
+def _csv_converter(column_type):
+    '''
+        The conversion a column's values need before csv.writer (which writes None as an empty
+        field), None if str() is fine.
+    '''
+    if isinstance(column_type, types.Enum):
+        return lambda value: value.name
+    if isinstance(column_type, (types.DateTime, types.Date)):
+        return lambda value: value.isoformat()
+    return None
+
+
+class CSVWriter:
+    media_type = "text/csv"
+    extension = "csv"
+
+    def __init__(self, columns: list):
+        self._converters = [(i, converter) for i, (_, column_type) in enumerate(columns)
+                            if (converter := _csv_converter(column_type)) is not None]
+        self._buffer = io.StringIO()
+        self._writer = csv.writer(self._buffer)
+        self._writer.writerow([name for name, _ in columns])
+
+    def _convert(self, row):
+        row = list(row)
+        for i, converter in self._converters:
+            if row[i] is not None:
+                row[i] = converter(row[i])
+        return row
+
+    def _drain(self) -> bytes:
+        data = self._buffer.getvalue().encode("utf-8")
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        return data
+
+    def write(self, rows) -> bytes:
+        self._writer.writerows(map(self._convert, rows) if self._converters else rows)
+        return self._drain()
+
+    def close(self) -> bytes:
+        return self._drain()
+
+
+class _Sink:
+    '''
+        Write only file object collecting what pyarrow writes until it is drained.
+    '''
+    def __init__(self):
+        self._parts = []
+        self.closed = False
+
+    def write(self, data):
+        self._parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data = b"".join(self._parts)
+        self._parts.clear()
+        return data
+
+
+def _arrow_type(pa, column_type):
+    # Enum subclasses String, so it has to come first.
+    if isinstance(column_type, (types.Enum, types.String)):
+        return pa.string()
+    if isinstance(column_type, types.Boolean):
+        return pa.bool_()
+    if isinstance(column_type, types.Integer):
+        return pa.int64()
+    if isinstance(column_type, (types.Float, types.Numeric)):
+        return pa.float64()
+    if isinstance(column_type, types.DateTime):
+        return pa.timestamp("us")
+    if isinstance(column_type, types.Date):
+        return pa.date32()
+    return pa.string()
+
+
+class ArrowWriter:
+    '''
+        Arrow IPC stream format, one record batch per chunk.
+    '''
+    media_type = "application/vnd.apache.arrow.stream"
+    extension = "arrow"
+
+    def __init__(self, columns: list):
+        import pyarrow
+
+        self._pa = pyarrow
+        self.schema = pyarrow.schema([(name, _arrow_type(pyarrow, column_type)) for name, column_type in columns])
+        self._enums = {i for i, (_, column_type) in enumerate(columns) if isinstance(column_type, types.Enum)}
+        self._sink = _Sink()
+        self._writer = self._open(pyarrow.PythonFile(self._sink, mode = "w"))
+
+    def _open(self, file):
+        return self._pa.ipc.new_stream(file, self.schema)
+
+    def _batch(self, rows):
+        columns = list(zip(*rows)) if rows else [[] for _ in self.schema]
+        arrays = []
+        for i, (values, field) in enumerate(zip(columns, self.schema)):
+            if i in self._enums:
+                values = [v.name if v is not None else None for v in values]
+            arrays.append(self._pa.array(values, type = field.type))
+        return self._pa.RecordBatch.from_arrays(arrays, schema = self.schema)
+
+    def write(self, rows) -> bytes:
+        self._writer.write_batch(self._batch(rows))
+        return self._sink.drain()
+
+    def close(self) -> bytes:
+        self._writer.close()
+        return self._sink.drain()
+
+
+class ParquetWriter(ArrowWriter):
+    '''
+        Parquet, one row group per chunk.
+    '''
+    media_type = "application/vnd.apache.parquet"
+    extension = "parquet"
+
+    def _open(self, file):
+        import pyarrow.parquet
+
+        return pyarrow.parquet.ParquetWriter(file, self.schema)
+
+
+FORMATS = {"csv": CSVWriter, "arrow": ArrowWriter, "parquet": ParquetWriter}
@@ -0,0 +1,45 @@
+'''
+    JSON responses encoded straight from column data.
+
+    The default response path validates every returned object against the response model and
+    walks the result through jsonable_encoder before json.dumps, which costs more than the SQL
+    for large lists. FastJSONResponse takes plain dicts and lists of trusted database values and
+    encodes them in one call, with orjson when it is installed and the standard library otherwise.
+    The output is byte for byte the one of the default path: compact separators, UTF-8, enums by
+    value and datetimes in ISO format.
+'''
+import datetime
+import enum
+import json
+import logging
+
+from fastapi.responses import Response
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+
+def _default(value):
+    if isinstance(value, enum.Enum):
+        return value.value
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps(content) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content, default = _default)
+    return json.dumps(content, default = _default, ensure_ascii = False, allow_nan = False,
+                      separators = (",", ":")).encode("utf-8")
+
+
+class FastJSONResponse(Response):
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        return dumps(content)
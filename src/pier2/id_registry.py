@@ -0,0 +1,142 @@
+'''
+    In-memory sets of the ids of the items, stores and warehouses.
+
+    Order items reference them without a foreign key that SQLite would enforce, and checking
+    every reference with a query would cost a round trip per order. These ids are dense
+    integers, so each table is held as a bitmap: one bit per id up to the largest, 125 KB per
+    million ids, with O(1) membership tests.
+
+    The sets are loaded at startup, or on first use, and the POST handlers add the rows they
+    create once their transaction commits. Ids missing from a set are looked up in the database
+    before being reported as unknown, so rows created by another worker are found (and added)
+    as well. Only references to rows that do not exist cost a query.
+'''
+import logging
+import threading
+
+from sqlalchemy import select
+
+from .database import after_commit
+from .models import Items, Stores, Warehouses
+
+logger = logging.getLogger(__name__)
+
+LOOKUP_BATCH_SIZE = 500     # ids per IN (...) when looking up ids missing from a set
+
+
+class IdBitmap:
+
+    def __init__(self):
+        self._bits = bytearray()
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def _add(self, id: int):
+        byte, bit = id >> 3, 1 << (id & 7)
+        if byte >= len(self._bits):
+            # Grown at least twofold so loading ids in order stays linear.
+            self._bits.extend(bytes(max(byte + 1 - len(self._bits), len(self._bits))))
+        if not self._bits[byte] & bit:
+            self._bits[byte] |= bit
+            self._count += 1
+
+    def add(self, id: int):
+        with self._lock:
+            self._add(id)
+
+    def update(self, ids):
+        with self._lock:
+            for id in ids:
+                self._add(id)
+
+    def add_range(self, first: int, last: int):
+        '''
+            Adds first..last (inclusive), whole bytes at a time.
+        '''
+        with self._lock:
+            if last - first < 16:
+                for id in range(first, last + 1):
+                    self._add(id)
+                return
+            self._add(last)
+            start, end = (first + 7) >> 3, last >> 3
+            before = int.from_bytes(self._bits[start:end], "little").bit_count()
+            self._bits[start:end] = b"\xff" * (end - start)
+            self._count += (end - start) * 8 - before
+            for id in range(first, start << 3):
+                self._add(id)
+            for id in range(end << 3, last):
+                self._add(id)
+
+    def __contains__(self, id) -> bool:
+        byte = id >> 3
+        return 0 <= byte < len(self._bits) and bool(self._bits[byte] & (1 << (id & 7)))
+
+    def __len__(self) -> int:
+        return self._count
+
+
+class IdRegistry:
+
+    def __init__(self, columns: dict):
+        self.columns = columns
+        self._sets = {}
+        self._lock = threading.Lock()
+
+    def load(self, db, tables = None):
+        '''
+            (Re)reads the ids of tables, all of them by default.
+        '''
+        for table in tables or self.columns:
+            ids = IdBitmap()
+            ids.update(db.execute(select(self.columns[table])).scalars())
+            self._sets[table] = ids
+            logger.info(f"Loaded {len(ids)} {table} ids.")
+
+    def _ids(self, db, table: str) -> IdBitmap:
+        ids = self._sets.get(table)
+        if ids is None:
+            with self._lock:
+                if table not in self._sets:
+                    self.load(db, [table])
+                ids = self._sets[table]
+        return ids
+
+    def missing(self, db, table: str, ids) -> set:
+        '''
+            The ids that are not those of rows of table.
+        '''
+        known = self._ids(db, table)
+        unknown = list({id for id in ids if id not in known})
+        column = self.columns[table]
+        found = []
+        for start in range(0, len(unknown), LOOKUP_BATCH_SIZE):
+            found.extend(db.execute(select(column).where(column.in_(unknown[start:start + LOOKUP_BATCH_SIZE]))).scalars())
+        known.update(found)
+        return set(unknown).difference(found)
+
+    def add(self, db, table: str, id: int):
+        '''
+            Adds the id of a row created by the handler's transaction once it has committed.
+        '''
+        def register():
+            ids = self._sets.get(table)
+            if ids is not None:
+                ids.add(id)
+        after_commit(db, register)
+
+    def add_range(self, db, table: str, first: int, last: int):
+        '''
+            add, for the ids first..last (inclusive).
+        '''
+        def register():
+            ids = self._sets.get(table)
+            if ids is not None:
+                ids.add_range(first, last)
+        after_commit(db, register)
+
+    def clear(self):
+        self._sets.clear()
+
+
+id_registry = IdRegistry({"items": Items.item_id, "stores": Stores.store_id, "warehouses": Warehouses.warehouse_id})
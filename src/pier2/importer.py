@@ -0,0 +1,401 @@
+'''
+    Bulk import of customers, customer addresses, orders and order items from CSV or Parquet files.
+
+    Files are read IMPORT_CHUNK_SIZE rows at a time, parents before children. Every chunk is
+    validated with vectorized checks equivalent to the validators of schemas.py (the same regular
+    expressions, states and modality rules) and to the checks of the POST handlers, its foreign
+    keys are resolved with dict and set lookups, and its valid rows are inserted with seed's
+    batched executemany and committed. Rejected rows are reported with their file row number and
+    reason. The rollups are rebuilt once at the end.
+
+    The ids in the files are those of the source system. Accepted rows get the next ids of their
+    tables and the references of the later files are translated through them. References to a
+    table without a file in the import (and to items, stores and warehouses) must be ids of rows
+    already in the database. Writes through the API should be paused while importing.
+
+    Command line:
+
+    export PYTHONPATH="$PYTHONPATH:./src/"; poetry run python -m pier2.importer --customers customers.csv \
+        --customer_addresses addresses.parquet --orders orders.csv --order_items items.csv --rejects rejects.csv
+'''
+import argparse
+import csv
+import logging
+import os
+import time
+import pandas as pd
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from . import rollups
+from .cache import data_version
+from .database import config
+from .id_registry import id_registry
+from .models import Customers, CustomerAddresess, Items, Stores, Warehouses
+from .models import FulfillmentModality, OrderSource, HOME_DELIVERY_MODALITIES
+from .schemas import EMAIL_REGEX, PHONE_REGEX, ZIP_REGEX, MODALITY_COLUMNS, MODALITY_MASKS, modality_errors, states
+from .schemas import ImportFiles, ImportResult, ImportTableResult, ImportRejection
+from .seed import TABLES, frame_columns, insert_columns, next_id, advance_sequences
+
+logger = logging.getLogger(__name__)
+
+IMPORT_CHUNK_SIZE = 50000
+LOOKUP_BATCH_SIZE = 500     # ids per IN (...) when checking references against the database
+MAX_REPORTED_REJECTIONS = 1000
+
+# Relative paths given to the admin endpoint are resolved against it, others must be inside it.
+IMPORT_DIRECTORY = (config.get("imports") or {}).get("directory", "imports")
+
+# table -> [(column, referenced table name or id column, required)]
+REFERENCES = {
+    "customers": [],
+    "customer_addresses": [("customer_id", "customers", True)],
+    "orders": [("customer_id", "customers", True), ("billing_address_id", "customer_addresses", True)],
+    "order_items": [("order_id", "orders", True),
+                    ("item_id", Items.item_id, True),
+                    ("source_warehouse_id", Warehouses.warehouse_id, False),
+                    ("source_store_id", Stores.store_id, False),
+                    ("dest_store_id", Stores.store_id, False),
+                    ("dest_customer_address_id", "customer_addresses", False)],
+}
+
+BOOLEANS = {"true": True, "t": True, "yes": True, "1": True, "1.0": True,
+            "false": False, "f": False, "no": False, "0": False, "0.0": False}
+
+
+def _strings(frame, column: str) -> pd.Series:
+    if column not in frame:
+        return pd.Series(pd.NA, index = frame.index, dtype = "string")
+    return frame[column].astype("string")
+
+
+def _integers(frame, column: str):
+    '''
+        The column as Int64 and the mask of the values given that are not integers.
+    '''
+    if column not in frame:
+        return pd.Series(pd.NA, index = frame.index, dtype = "Int64"), pd.Series(False, index = frame.index)
+    values = frame[column]
+    numbers = pd.to_numeric(values, errors = "coerce")
+    invalid = (values.notna() & numbers.isna()) | (numbers.notna() & (numbers % 1 != 0))
+    return numbers.where(~invalid).astype("Int64"), invalid
+
+
+def _booleans(frame, column: str):
+    '''
+        The column as bool (missing is False) and the mask of the values that are not booleans.
+    '''
+    if column not in frame:
+        return pd.Series(False, index = frame.index), pd.Series(False, index = frame.index)
+    if frame[column].dtype == bool:
+        return frame[column], pd.Series(False, index = frame.index)
+    text = frame[column].astype("string").str.strip().str.lower()
+    parsed = text.map(BOOLEANS, na_action = "ignore")
+    return parsed.fillna(False).astype(bool), text.notna() & parsed.isna()
+
+
+def _enum_names(frame, column: str, enum_type) -> pd.Series:
+    '''
+        Names of the members given by name or value, NA when missing or invalid.
+    '''
+    names = {e.name: e.name for e in enum_type}
+    names.update({str(e.value): e.name for e in enum_type})
+    names.update({f"{e.value}.0": e.name for e in enum_type})
+    return _strings(frame, column).str.strip().map(names, na_action = "ignore").astype("string")
+
+
+def _is_not(values: pd.Series, pattern: str) -> pd.Series:
+    '''
+        The values given that do not match pattern (re.match semantics, as in schemas.py).
+    '''
+    return values.notna() & ~values.fillna("").str.match(pattern).astype(bool)
+
+
+class Importer:
+
+    def __init__(self, db: Session, rejects_path: str = None):
+        self.db = db
+        self.ids = {}
+        self.next_ids = {}
+        # What is known of the rows imported so far, saving lookups of the next chunks.
+        self.address_flags = {}             # address id -> (is_billing, is_shipping)
+        self.result = ImportResult(tables = {}, rejected = [])
+        self._rejects_file = open(rejects_path, "w", newline = "") if rejects_path else None
+        self._rejects = csv.writer(self._rejects_file) if self._rejects_file else None
+        if self._rejects:
+            self._rejects.writerow(["table", "row", "id", "detail"])
+
+    def _existing(self, column, values) -> set:
+        ids = [v.item() if hasattr(v, "item") else v for v in set(values)]
+        found = set()
+        for start in range(0, len(ids), LOOKUP_BATCH_SIZE):
+            found.update(self.db.execute(select(column).where(column.in_(ids[start:start + LOOKUP_BATCH_SIZE]))).scalars())
+        return found
+
+    def _address_flags(self, address_ids) -> tuple:
+        '''
+            (billing, shipping) sets of the given (database) address ids.
+        '''
+        ids = {int(v) for v in address_ids}
+        billing = {id for id in ids if self.address_flags.get(id, (False, False))[0]}
+        shipping = {id for id in ids if self.address_flags.get(id, (False, False))[1]}
+        ids = [id for id in ids if id not in self.address_flags]
+        for start in range(0, len(ids), LOOKUP_BATCH_SIZE):
+            for row in self.db.execute(select(CustomerAddresess.customer_address_id, CustomerAddresess.is_billing,
+                                              CustomerAddresess.is_shipping).where(
+                    CustomerAddresess.customer_address_id.in_(ids[start:start + LOOKUP_BATCH_SIZE]))):
+                if row.is_billing:
+                    billing.add(row.customer_address_id)
+                if row.is_shipping:
+                    shipping.add(row.customer_address_id)
+        return billing, shipping
+
+    def _resolve(self, frame, column: str, target, required: bool, reject) -> pd.Series:
+        '''
+            The database ids referenced by column. Ids of a table being imported are translated,
+            others are checked against id_registry or the database.
+        '''
+        values, invalid = _integers(frame, column)
+        reject(invalid, f"Invalid {column}.")
+        if required:
+            reject(values.isna() & ~invalid, f"{column} is required.")
+
+        if isinstance(target, str) and target not in self.ids:
+            model, key, _ = TABLES[target]
+            target = getattr(model, key)
+
+        if isinstance(target, str):
+            mapping = self.ids[target]
+            resolved = pd.Series([mapping.get(v) if v is not pd.NA else None for v in values],
+                                 index = frame.index, dtype = "Int64")
+        elif target.table.name in id_registry.columns:
+            missing = id_registry.missing(self.db, target.table.name, [int(v) for v in values.dropna().unique()])
+            resolved = values.where(~values.isin(list(missing)))
+        else:
+            found = self._existing(target, values.dropna())
+            resolved = values.where(values.isin(list(found)))
+        reject(values.notna() & resolved.isna(), "Unknown " + column + " " + values.astype("string"))
+        return resolved
+
+    def _customers(self, frame, reject) -> pd.DataFrame:
+        email = _strings(frame, "email")
+        reject(email.isna(), "email is required.")
+        reject(_is_not(email, EMAIL_REGEX), "Invalid email format.")
+        for column in ["first_name", "last_name"]:
+            reject(_strings(frame, column).fillna("").str.strip() == "", "Invalid name as it was empty.")
+        phone = _strings(frame, "phone")
+        reject(_is_not(phone, PHONE_REGEX), "Invalid phone number format.")
+
+        for column, values in [("email", email), ("phone", phone)]:
+            reject(values.notna() & values.duplicated(), f"The {column} appears more than once in the file.")
+            existing = self._existing(getattr(Customers, column), values.dropna())
+            reject(values.isin(list(existing)), f"A customer with this {column} exists already.")
+
+        return pd.DataFrame({"email": email, "first_name": _strings(frame, "first_name"),
+                             "last_name": _strings(frame, "last_name"), "phone": phone})
+
+    def _customer_addresses(self, frame, reject) -> pd.DataFrame:
+        for column in ["address_line_1", "city"]:
+            reject(_strings(frame, column).isna(), f"{column} is required.")
+        state = _strings(frame, "state")
+        reject(~state.str.upper().isin(states).fillna(False).astype(bool), "Invalid state " + state.fillna("") + ".")
+        reject(~_strings(frame, "zip_code").fillna("").str.match(ZIP_REGEX).astype(bool), "Invalid zip code.")
+
+        flags = {}
+        for column in ["is_billing", "is_shipping"]:
+            flags[column], invalid = _booleans(frame, column)
+            reject(invalid, f"Invalid {column}.")
+        reject(~flags["is_billing"] & ~flags["is_shipping"],
+               "An address must be either set to shipping or billing or both. Got false for both.")
+
+        return pd.DataFrame({"customer_id": self._resolve(frame, "customer_id", "customers", True, reject),
+                             "address_line_1": _strings(frame, "address_line_1"),
+                             "address_line_2": _strings(frame, "address_line_2"),
+                             "city": _strings(frame, "city"),
+                             "state": state.str.upper(),
+                             "zip_code": _strings(frame, "zip_code"),
+                             **flags})
+
+    def _orders(self, frame, reject) -> pd.DataFrame:
+        values = _strings(frame, "time_of_order")
+        times = pd.to_datetime(values, errors = "coerce", format = "ISO8601")
+        reject(values.isna(), "time_of_order is required.")
+        reject(values.notna() & times.isna(), "Invalid time_of_order.")
+        reject((times.dt.hour == 0) & (times.dt.minute == 0) & (times.dt.second == 0),
+               "Time of order must contain time information.")
+        source = _enum_names(frame, "source", OrderSource)
+        reject(source.isna(), "Invalid source.")
+
+        billing_address_id = self._resolve(frame, "billing_address_id", "customer_addresses", True, reject)
+        billing, _ = self._address_flags(billing_address_id.dropna())
+        reject(billing_address_id.notna() & ~billing_address_id.isin(billing),
+               "The address provided for billing is not marked as a billing address.")
+
+        return pd.DataFrame({"customer_id": self._resolve(frame, "customer_id", "customers", True, reject),
+                             "time_of_order": times, "source": source,
+                             "billing_address_id": billing_address_id})
+
+    def _order_items(self, frame, reject) -> pd.DataFrame:
+        modality = _enum_names(frame, "fulfillment_modality", FulfillmentModality)
+        reject(modality.isna(), "Invalid fulfillment_modality.")
+        # The masks of modality_errors as column operations, which then only builds the messages.
+        sources = {column: _integers(frame, column)[0] for column in MODALITY_COLUMNS}
+        set_mask, given_mask = 0, 0
+        for bit, values in enumerate(sources.values()):
+            set_mask = set_mask | values.notna().astype(int) * (1 << bit)
+            given_mask = given_mask | values.fillna(0).ne(0).astype(int) * (1 << bit)
+        required = modality.map({m.name: masks[0] for m, masks in MODALITY_MASKS.items()}).fillna(0).astype(int)
+        forbidden = modality.map({m.name: masks[1] for m, masks in MODALITY_MASKS.items()}).fillna(0).astype(int)
+        invalid = modality.notna() & (((set_mask & required) != required) | ((given_mask & forbidden) != 0))
+        columns = {}
+        for column, values in sources.items():
+            values = values[invalid].astype(object)
+            columns[column] = values.where(values.notna(), None).tolist()
+        errors = pd.Series(modality_errors([FulfillmentModality[name] for name in modality[invalid]], columns),
+                           index = modality.index[invalid], dtype = object).reindex(frame.index)
+        reject(errors.notna(), errors)
+
+        quantity, _ = _integers(frame, "quantity")
+        reject(quantity.isna(), "Invalid quantity.")
+        price = pd.to_numeric(frame.get("price_per_item", pd.Series(index = frame.index)), errors = "coerce")
+        reject(price.isna(), "Invalid price_per_item.")
+
+        items = pd.DataFrame({column: self._resolve(frame, column, target, required, reject)
+                              for column, target, required in REFERENCES["order_items"]})
+        items["fulfillment_modality"] = modality
+        items["quantity"] = quantity
+        items["price_per_item"] = price
+
+        home = modality.isin([m.name for m in HOME_DELIVERY_MODALITIES])
+        _, shipping = self._address_flags(items.dest_customer_address_id[home].dropna())
+        reject(home & items.dest_customer_address_id.notna() & ~items.dest_customer_address_id.isin(shipping),
+               "Some shipping addresses are not marked as is_shipping. ")
+        return items
+
+    def _report(self, name: str, rows, ids, reasons):
+        for row, id, reason in zip(rows, ids, reasons):
+            rejection = ImportRejection(table = name, row = row, id = None if id is pd.NA else str(id), detail = reason)
+            if len(self.result.rejected) < MAX_REPORTED_REJECTIONS:
+                self.result.rejected.append(rejection)
+            if self._rejects:
+                self._rejects.writerow([name, row, rejection.id or "", reason])
+
+    def import_chunk(self, name: str, frame: pd.DataFrame, first_row: int):
+        model, key, _ = TABLES[name]
+        frame = frame.reset_index(drop = True)
+        rows = pd.RangeIndex(first_row, first_row + len(frame))
+        reasons = pd.Series(None, index = frame.index, dtype = object)
+
+        def reject(mask, reason):
+            mask = mask.fillna(False).astype(bool) & reasons.isna()
+            reasons[mask] = reason[mask] if isinstance(reason, pd.Series) else reason
+
+        source_ids, invalid = _integers(frame, key)
+        if key not in frame:
+            source_ids = pd.Series(rows, index = frame.index, dtype = "Int64")
+        reject(invalid, f"Invalid {key}.")
+        if name in self.ids:
+            seen = self.ids[name]
+            reject(source_ids.duplicated() | pd.Series([v in seen for v in source_ids], index = frame.index),
+                   f"The {key} appears more than once in the file.")
+
+        values = getattr(self, f"_{name}")(frame, reject)
+
+        accepted = reasons.isna()
+        values = values[accepted].copy()
+        start = self.next_ids.setdefault(name, next_id(self.db, model, key))
+        new_ids = range(start, start + len(values))
+        self.next_ids[name] += len(values)
+        if name in self.ids:
+            self.ids[name].update(zip(source_ids[accepted].tolist(), new_ids))
+        if name == "customer_addresses":
+            self.address_flags.update(zip(new_ids, zip(values.is_billing, values.is_shipping)))
+
+        if len(values):
+            values.insert(0, key, list(new_ids))
+            insert_columns(self.db, model.__table__, frame_columns(model.__table__, values))
+            self.db.commit()
+
+        table = self.result.tables.setdefault(name, ImportTableResult())
+        table.rows += len(frame)
+        table.imported += len(values)
+        table.rejected += len(frame) - len(values)
+        self._report(name, rows[~accepted], source_ids[~accepted], reasons[~accepted])
+
+    def run(self, paths: dict) -> ImportResult:
+        # Ids are translated for every table with a file, children of the others reference the database.
+        self.ids = {name: {} for name in TABLES if paths.get(name) and name != "order_items"}
+        start = time.perf_counter()
+        try:
+            for name in TABLES:
+                if not paths.get(name):
+                    continue
+                first_row = 1
+                for frame in read_chunks(paths[name]):
+                    self.import_chunk(name, frame, first_row)
+                    first_row += len(frame)
+                logger.info(f"Imported {name}: {self.result.tables.get(name)}")
+        except Exception:
+            self.db.rollback()
+            raise
+        finally:
+            self._finish()
+        imported = sum(table.imported for table in self.result.tables.values())
+        logger.info(f"Imported {imported} rows in {time.perf_counter() - start:.2f}s.")
+        return self.result
+
+    def _finish(self):
+        imported = [name for name, table in self.result.tables.items() if table.imported]
+        if imported:
+            if self.db.get_bind().dialect.name == "postgresql":
+                advance_sequences(self.db, imported)
+            if "orders" in imported or "order_items" in imported:
+                rollups.rebuild(self.db)
+            self.db.commit()
+            data_version.bump()
+        if self._rejects_file:
+            self._rejects_file.close()
+
+
+def read_chunks(path: str, chunk_size: int = None):
+    '''
+        DataFrames of up to chunk_size rows, Parquet by extension (requires pyarrow), CSV otherwise.
+        CSV values are read as strings and parsed by the checks.
+    '''
+    chunk_size = chunk_size or IMPORT_CHUNK_SIZE
+    if str(path).endswith(".parquet"):
+        import pyarrow.parquet
+
+        for batch in pyarrow.parquet.ParquetFile(path).iter_batches(batch_size = chunk_size):
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(path, chunksize = chunk_size, dtype = str, keep_default_na = False,
+                               na_values = [""])
+
+
+def import_files(db: Session, files: ImportFiles) -> ImportResult:
+    return Importer(db, files.rejects).run(files.model_dump())
+
+
+def resolve_path(path: str) -> str:
+    '''
+        path inside IMPORT_DIRECTORY, ValueError if it points outside of it.
+    '''
+    directory = os.path.realpath(IMPORT_DIRECTORY)
+    resolved = os.path.realpath(os.path.join(directory, path))
+    if os.path.commonpath([directory, resolved]) != directory:
+        raise ValueError(f"{path} is outside of the import directory.")
+    return resolved
+
+
+if __name__ == "__main__":
+    from .database import SessionLocal
+
+    parser = argparse.ArgumentParser(description = "Bulk import of CSV or Parquet files.")
+    for name in list(TABLES) + ["rejects"]:
+        parser.add_argument(f"--{name}")
+    args = parser.parse_args()
+
+    with SessionLocal() as db:
+        result = import_files(db, ImportFiles(**vars(args)))
+    print(result.model_dump_json(indent = 2, exclude = {"rejected"}))
@@ -0,0 +1,168 @@
+'''
+    Checks that every /query endpoint is served by indexes.
+
+    Each endpoint is called through the app against the given engine while the SQL it sends
+    is captured, then every captured statement is explained with EXPLAIN QUERY PLAN (SQLite)
+    or EXPLAIN (Postgres, with sequential scans disabled so that a Seq Scan in the plan means
+    no usable index exists). A statement reading a table without an index is reported.
+
+    Requires the dev dependencies (the app is driven through fastapi's TestClient).
+'''
+import datetime
+import logging
+import re
+from contextlib import contextmanager
+from sqlalchemy import event, select
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+from .cache import query_cache
+from .database import get_db, get_read_db
+from .models import Base, Customers, Orders
+from .routers import queries
+
+logger = logging.getLogger(__name__)
+
+# Tables whose entire content is the answer of an endpoint, scanning them is the point.
+FULL_SCAN_ALLOWED = {"billing_zip_order_counts", "shipping_zip_order_counts"}
+
+SQLITE_SCAN = re.compile(r"^SCAN (\w+)$")
+POSTGRES_SCAN = re.compile(r"Seq Scan on (\w+)")
+
+
+def _post(client, path, data):
+    resp = client.post(path, json = data)
+    if resp.status_code != 200:
+        raise ValueError(f"Could not seed the database: {resp.text}")
+    return resp.json()
+
+
+def seed_sample_data(client):
+    '''
+        Just enough rows for every endpoint to run each of its queries.
+    '''
+    store_id = _post(client, "/stores", {})["store_id"]
+    item_id = _post(client, "/items", {})["item_id"]
+    customer_id = _post(client, "/customers", {"email": "pink@floyd.com", "first_name": "Pink",
+                                               "last_name": "Floyd", "phone": "111-222-4444"})["customer_id"]
+    address_id = _post(client, "/customers/addresses", {
+        "customer_id": customer_id, "address_line_1": "34 Haight", "city": "San Francisco",
+        "state": "CA", "zip_code": "94131", "is_billing": True, "is_shipping": True})["customer_address_id"]
+    _post(client, "/orders", {
+        "order": {"customer_id": customer_id, "time_of_order": "2025-02-09 14:14:37",
+                  "source": 1, "billing_address_id": address_id},
+        "items": [{"item_id": item_id, "fulfillment_modality": 3, "quantity": 1, "price_per_item": 1.0,
+                   "source_store_id": store_id, "dest_customer_address_id": address_id}]})
+
+
+def sample_requests(db: Session):
+    '''
+        (path, params) for every /query endpoint and each of its query shapes.
+    '''
+    customer = db.execute(select(Customers.email, Customers.phone).limit(1)).first()
+    email = customer.email if customer else "pink@floyd.com"
+    phone = customer.phone if customer else "111-222-4444"
+    order = db.execute(select(Orders.time_of_order, Orders.order_id).order_by(
+        Orders.time_of_order, Orders.order_id).limit(1)).first()
+    after = queries.encode_cursor(*(order or (datetime.datetime(2025, 1, 1), 0)))
+
+    return [
+        ("/query/order_history", {"email": email}),
+        ("/query/order_history", {"phone": phone}),
+        ("/query/order_history", {"email": email, "limit": 10, "after": after}),
+        ("/query/order_history", {"email": email, "stream": True}),
+        ("/query/order_history", {"email": email, "limit": 10, "after": after, "fast": True}),
+        ("/query/count_billing_orders", {}),
+        ("/query/count_by_shipping_zip", {}),
+        ("/query/instore_shoppers", {"top_k": 5}),
+        ("/query/count_billing_orders", {"start": "2025-02-01", "end": "2025-03-01"}),
+        ("/query/count_by_shipping_zip", {"start": "2025-02-01", "end": "2025-03-01"}),
+        ("/query/instore_shoppers", {"top_k": 5, "start": "2025-02-01", "end": "2025-03-01"}),
+        ("/query/count_billing_orders", {"start": "2025-01-01", "bucket": "week"}),
+        ("/query/count_by_shipping_zip", {"start": "2025-01-01", "bucket": "day"}),
+        ("/query/instore_shoppers", {"top_k": 5, "start": "2025-01-01", "bucket": "month"}),
+    ]
+
+
+@contextmanager
+def _client(db: Session):
+    from fastapi.testclient import TestClient
+    from .main import app
+
+    previous = dict(app.dependency_overrides)
+    app.dependency_overrides[get_db] = app.dependency_overrides[get_read_db] = lambda: db
+    try:
+        yield TestClient(app)
+    finally:
+        app.dependency_overrides.clear()
+        app.dependency_overrides.update(previous)
+
+
+def capture(engine: Engine, db: Session, requests):
+    '''
+        Returns [(path, statement, parameters)] for every statement the requests executed.
+    '''
+    captured = []
+    current = {}
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if not executemany:
+            captured.append((current["path"], statement, parameters))
+
+    # Cached /query results would hide their statements.
+    query_cache.clear()
+    event.listen(engine, "before_cursor_execute", record)
+    try:
+        with _client(db) as client:
+            for path, params in requests:
+                current["path"] = path
+                resp = client.get(path, params = params)
+                if resp.status_code != 200:
+                    logger.warning(f"{path} {params} returned {resp.status_code}: {resp.text}")
+    finally:
+        event.remove(engine, "before_cursor_execute", record)
+    return captured
+
+
+def explain(engine: Engine, statement, parameters):
+    '''
+        Returns the plan lines and the tables read without an index.
+    '''
+    with engine.connect() as conn:
+        if engine.dialect.name == "sqlite":
+            plan = [row[-1] for row in conn.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parameters)]
+            scans = [m.group(1) for m in map(SQLITE_SCAN.match, plan) if m]
+        elif engine.dialect.name == "postgresql":
+            conn.exec_driver_sql("SET enable_seqscan = off")
+            plan = [row[0] for row in conn.exec_driver_sql("EXPLAIN " + statement, parameters)]
+            scans = [m.group(1) for m in map(POSTGRES_SCAN.search, plan) if m]
+        else:
+            raise NotImplementedError(f"No EXPLAIN support for the {engine.dialect.name} dialect.")
+        conn.rollback()
+
+    return plan, [table for table in scans if table in Base.metadata.tables and table not in FULL_SCAN_ALLOWED]
+
+
+def check(engine: Engine, seed: bool = False):
+    '''
+        Returns [(path, statement, plan, full scans)] for every explained statement.
+        With seed the schema is created and sample rows are added first (for empty databases).
+        An in-memory SQLite engine must use StaticPool, the app runs on other threads.
+    '''
+    with Session(engine) as db:
+        if seed:
+            Base.metadata.create_all(engine)
+            with _client(db) as client:
+                seed_sample_data(client)
+
+        captured = capture(engine, db, sample_requests(db))
+
+    report = []
+    seen = set()
+    for path, statement, parameters in captured:
+        if statement in seen or not statement.lstrip().upper().startswith("SELECT"):
+            continue
+        seen.add(statement)
+        plan, scans = explain(engine, statement, parameters)
+        report.append((path, statement, plan, scans))
+    return report
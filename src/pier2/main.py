@@ -2,7 +2,14 @@ from fastapi import FastAPI
 import logging, logging.config
 import sys
 from configparser import ConfigParser
-from .routers import assets, customers, orders, queries
+from contextlib import asynccontextmanager
+from sqlalchemy.exc import SQLAlchemyError
+from . import metrics
+from .database import config, SessionLocal, ReadYourWritesMiddleware, REPLICA_SETTINGS, read_engines
+from .id_registry import id_registry
+from .sketches import sketches
+from .materializer import materializer
+from .routers import admin, assets, customers, exports, orders, queries
 
 def setup_logging():
     logging.config.fileConfig('logging_config.ini')
@@ -12,13 +19,39 @@ logging.basicConfig(level=logging.DEBUG, format='%(levelname)s: %(message)s')
 logger = logging.getLogger(__name__)
 logger.info("Logging has been setup.")
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # The ids order items are checked against, loaded before the first request.
+    try:
+        with SessionLocal() as db:
+            id_registry.load(db)
+    except SQLAlchemyError as e:
+        logger.warning(f"Ids not loaded at startup, they will be on first use: {e}")
+    # Loads and persists the sketches in the background, a large catch-up does not delay startup.
+    sketches.start(SessionLocal)
+    materializer.start(SessionLocal)
+    yield
+    materializer.stop()
+    sketches.stop()
+
+app = FastAPI(lifespan = lifespan)
 app.include_router(customers.router)
 app.include_router(orders.router)
 app.include_router(assets.stores_router)
 app.include_router(assets.items_router)
 app.include_router(assets.warehouses_router)
 app.include_router(queries.router)
+app.include_router(exports.router)
+app.include_router(admin.router)
+
+# Clients that just wrote read from the primary, see database.get_read_db.
+if read_engines is not None and REPLICA_SETTINGS["read_your_writes_seconds"]:
+    app.add_middleware(ReadYourWritesMiddleware)
+
+# Statement counts, DB and serialization time per request: Server-Timing headers and /metrics.
+if config.get("metrics", {}).get("enabled", True):
+    app.add_middleware(metrics.MetricsMiddleware)
+    app.include_router(metrics.router)
 
 logger.info("Routers have been added.")
 
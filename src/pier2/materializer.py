@@ -0,0 +1,148 @@
+'''
+    Background materialization of the heavy /query aggregates.
+
+    The full count_billing_orders and count_by_shipping_zip answers read every row of their
+    rollup, whatever the request, and the query cache only keeps them until the next order. A
+    worker thread started in the lifespan recomputes them into in-memory snapshots instead:
+    right after an order write raises the dirty flag (at most every min_interval_seconds, so a
+    burst of orders costs one refresh) and every interval_seconds in any case, which picks up
+    imports, seeds and other workers' writes.
+
+    The endpoints answer from the latest snapshot, with its time in an X-As-Of header. Once the
+    data changed (from the first dirty flag raised after the snapshot was read) for more than
+    max_lag_seconds without a refresh (a stalled, failing or stopped worker) the snapshot is not
+    used, the request computes the answer itself as before.
+'''
+import datetime
+import logging
+import threading
+import time
+from typing import NamedTuple
+
+from .cache import data_version
+from .database import config
+
+logger = logging.getLogger(__name__)
+
+SETTINGS_DEFAULTS = {
+    "enabled": True,
+    "interval_seconds": 60,         # refresh at least this often
+    "min_interval_seconds": 1,      # and at most this often
+    "max_lag_seconds": 30,
+}
+
+
+class Snapshot(NamedTuple):
+    version: str                    # data version the snapshot was read at
+    as_of: datetime.datetime
+    value: dict
+
+
+class Materializer:
+
+    def __init__(self, settings: dict = None):
+        self._views = {}
+        self._snapshots = {}
+        self._dirty_since = {}      # name -> first mark_dirty not covered by its snapshot
+        self._failures = {}         # name -> error of its last refresh, until reported by latest
+        self._dirty = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self.configure(settings)
+
+    def configure(self, settings: dict = None):
+        settings = dict(SETTINGS_DEFAULTS, **(settings or {}))
+        self.enabled = settings["enabled"]
+        self.interval_seconds = settings["interval_seconds"]
+        self.min_interval_seconds = settings["min_interval_seconds"]
+        self.max_lag_seconds = settings["max_lag_seconds"]
+
+    def register(self, name: str, compute):
+        '''
+            compute(db) returns the answer of the endpoint name.
+        '''
+        self._views[name] = compute
+
+    def clear(self):
+        self._snapshots.clear()
+        self._dirty_since.clear()
+        self._failures.clear()
+
+    def mark_dirty(self):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        for name in self._views:
+            self._dirty_since.setdefault(name, now)
+        self._dirty.set()
+
+    def refresh(self, db):
+        '''
+            Recomputes every registered view. The version is read first, so writes committed
+            while computing leave the snapshots out of date rather than passing for current.
+        '''
+        version = data_version.value
+        as_of = datetime.datetime.now(datetime.timezone.utc)
+        for name, compute in self._views.items():
+            start = time.perf_counter()
+            try:
+                value = compute(db)
+            except Exception as e:
+                logger.error(f"Could not materialize {name}: {e}")
+                self._failures[name] = e
+                db.rollback()
+                continue
+            self._snapshots[name] = Snapshot(version, as_of, value)
+            self._failures.pop(name, None)
+            # Writes flagged while computing are not covered by this snapshot.
+            if self._dirty_since.get(name, as_of) < as_of:
+                self._dirty_since.pop(name, None)
+            logger.debug(f"Materialized {name} in {time.perf_counter() - start:.3f}s.")
+
+    def latest(self, name: str):
+        '''
+            The snapshot of name to answer from, None to compute the answer in the request.
+        '''
+        snapshot = self._snapshots.get(name) if self.enabled else None
+        if snapshot is None or snapshot.version == data_version.value:
+            return snapshot
+        # Changes of other workers or imports raise no flag here, they count from the snapshot.
+        changed = self._dirty_since.get(name, snapshot.as_of)
+        lag = (datetime.datetime.now(datetime.timezone.utc) - changed).total_seconds()
+        failure = self._failures.pop(name, None)
+        if failure is not None:
+            logger.warning(f"{name} as of {snapshot.as_of.isoformat()} is {lag:.1f}s behind, "
+                           f"its refresh failed: {failure}")
+        return snapshot if lag <= self.max_lag_seconds else None
+
+    def _run(self, session_factory):
+        while not self._stop.is_set():
+            try:
+                with session_factory() as db:
+                    self.refresh(db)
+            except Exception as e:
+                logger.error(f"Materializer refresh failed: {e}")
+            if self._stop.wait(self.min_interval_seconds):
+                break
+            self._dirty.wait(max(self.interval_seconds - self.min_interval_seconds, 0))
+            self._dirty.clear()
+
+    def start(self, session_factory):
+        '''
+            Starts the worker thread, refreshing with sessions of session_factory.
+        '''
+        if not self.enabled or self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target = self._run, args = (session_factory,),
+                                        name = "materializer", daemon = True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._dirty.set()
+        self._thread.join()
+        self._thread = None
+
+
+materializer = Materializer(config.get("materializer"))
@@ -0,0 +1,273 @@
+'''
+    Per request performance metrics.
+
+    MetricsMiddleware opens a RequestStats for every HTTP request in a context variable. The
+    cursor hooks installed by instrument_engine add each statement's count, time and rows to
+    it, and MetricsRoute marks when the endpoint returned so the time FastAPI then spends
+    validating and serializing the result is known. The numbers are sent back in a
+    Server-Timing header and added to per route histograms served at /metrics in the
+    Prometheus text format.
+
+    Everything outside of a request (scripts, tests driving the engine directly) is ignored.
+'''
+import bisect
+import logging
+import threading
+import time
+from contextvars import ContextVar
+from functools import wraps
+from inspect import iscoroutinefunction
+
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+from fastapi.routing import APIRoute
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+SECONDS_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+COUNT_BUCKETS = [0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000]
+ROWS_BUCKETS = [0, 1, 10, 100, 1000, 10000, 100000]
+
+
+class RequestStats:
+    __slots__ = ("scope", "start", "statements", "db_seconds", "rows", "endpoint_done", "response_start")
+
+    def __init__(self, scope: dict = None):
+        self.scope = scope or {}
+        self.start = time.perf_counter()
+        self.statements = 0
+        self.db_seconds = 0.0
+        self.rows = 0
+        self.endpoint_done = None
+        self.response_start = None
+
+    @property
+    def method(self) -> str:
+        return self.scope.get("method")
+
+    @property
+    def route(self) -> str:
+        '''
+            The path template of the matched route, the raw path until routing is done.
+        '''
+        route = self.scope.get("route")
+        return route.path if route is not None else self.scope.get("path")
+
+    @property
+    def serialize_seconds(self) -> float:
+        if self.endpoint_done is None or self.response_start is None:
+            return 0.0
+        return self.response_start - self.endpoint_done
+
+    def server_timing(self) -> str:
+        return (f'db;dur={self.db_seconds * 1000:.2f};desc="{self.statements} statements, {self.rows} rows", '
+                f'serialize;dur={self.serialize_seconds * 1000:.2f}, '
+                f'app;dur={(self.response_start - self.start) * 1000:.2f}')
+
+
+_current: ContextVar = ContextVar("pier2_request_stats", default = None)
+
+
+def current_stats():
+    '''
+        The RequestStats of the request being handled, None outside of a request.
+    '''
+    return _current.get()
+
+
+class _RowCountingCursor:
+    '''
+        Counts the rows fetched through the DBAPI cursor of a statement that returns rows.
+    '''
+    __slots__ = ("_cursor", "_stats")
+
+    def __init__(self, cursor, stats):
+        self._cursor = cursor
+        self._stats = stats
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        if row is not None:
+            self._stats.rows += 1
+        return row
+
+    def fetchmany(self, *args, **kwargs):
+        rows = self._cursor.fetchmany(*args, **kwargs)
+        self._stats.rows += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        self._stats.rows += len(rows)
+        return rows
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+def instrument_engine(engine):
+    '''
+        Installs the cursor hooks on engine (for an AsyncEngine pass async_engine.sync_engine).
+    '''
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if context is not None and _current.get() is not None:
+            context.metrics_start = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        stats = _current.get()
+        if stats is None or context is None:
+            return
+        stats.statements += 1
+        stats.db_seconds += time.perf_counter() - getattr(context, "metrics_start", time.perf_counter())
+        if cursor.description is None:
+            if cursor.rowcount > 0:
+                stats.rows += cursor.rowcount
+        elif context.cursor is cursor:
+            context.cursor = _RowCountingCursor(cursor, stats)
+
+
+class Histogram:
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name: str, labels: str) -> list:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ["+Inf"], self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f"{name}_sum{{{labels}}} {self.sum}")
+        lines.append(f"{name}_count{{{labels}}} {self.count}")
+        return lines
+
+
+# name -> (help, buckets, RequestStats -> observed value)
+HISTOGRAMS = {
+    "pier2_request_duration_seconds": ("Time until the response completed.", SECONDS_BUCKETS, None),
+    "pier2_db_seconds": ("Time spent executing SQL statements.", SECONDS_BUCKETS, lambda s: s.db_seconds),
+    "pier2_db_statements": ("SQL statements executed.", COUNT_BUCKETS, lambda s: s.statements),
+    "pier2_db_rows": ("Rows returned or affected by the SQL statements.", ROWS_BUCKETS, lambda s: s.rows),
+    "pier2_serialize_seconds": ("Time from the endpoint returning to the response starting.",
+                                SECONDS_BUCKETS, lambda s: s.serialize_seconds),
+}
+
+
+class Registry:
+    '''
+        Histograms per (method, route template) and request counts per status.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._requests = {}
+
+    def observe(self, method: str, route: str, status: int, stats: RequestStats, duration: float):
+        key = (method, route)
+        with self._lock:
+            histograms = self._histograms.get(key)
+            if histograms is None:
+                histograms = self._histograms[key] = {name: Histogram(buckets)
+                                                      for name, (_, buckets, _) in HISTOGRAMS.items()}
+            for name, (_, _, value) in HISTOGRAMS.items():
+                histograms[name].observe(duration if value is None else value(stats))
+            self._requests[key + (status,)] = self._requests.get(key + (status,), 0) + 1
+
+    def render(self) -> str:
+        with self._lock:
+            lines = ["# HELP pier2_requests_total Requests handled.", "# TYPE pier2_requests_total counter"]
+            for (method, route, status), count in sorted(self._requests.items()):
+                lines.append(f'pier2_requests_total{{method="{method}",route="{route}",status="{status}"}} {count}')
+            for name, (help, _, _) in HISTOGRAMS.items():
+                lines.extend([f"# HELP {name} {help}", f"# TYPE {name} histogram"])
+                for (method, route), histograms in sorted(self._histograms.items()):
+                    lines.extend(histograms[name].render(name, f'method="{method}",route="{route}"'))
+        return "\n".join(lines) + "\n"
+
+    def clear(self):
+        with self._lock:
+            self._histograms.clear()
+            self._requests.clear()
+
+
+registry = Registry()
+
+
+class MetricsMiddleware:
+    '''
+        Plain ASGI middleware, BaseHTTPMiddleware would add a task and a copy of the body
+        to every request.
+    '''
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        stats = RequestStats(scope)
+        token = _current.set(stats)
+        status = 500
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                stats.response_start = time.perf_counter()
+                message["headers"] = list(message.get("headers", [])) + [
+                    (b"server-timing", stats.server_timing().encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _current.reset(token)
+            route = scope.get("route")
+            registry.observe(scope["method"], route.path if route is not None else "unmatched", status,
+                             stats, time.perf_counter() - stats.start)
+
+
+def _mark_endpoint_done(func):
+    if iscoroutinefunction(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            result = await func(*args, **kwargs)
+            stats = _current.get()
+            if stats is not None:
+                stats.endpoint_done = time.perf_counter()
+            return result
+    else:
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            result = func(*args, **kwargs)
+            stats = _current.get()
+            if stats is not None:
+                stats.endpoint_done = time.perf_counter()
+            return result
+    return wrapper
+
+
+class MetricsRoute(APIRoute):
+    '''
+        route_class of the routers, records when the endpoint returned.
+    '''
+    def __init__(self, path, endpoint, **kwargs):
+        super().__init__(path, _mark_endpoint_done(endpoint), **kwargs)
+
+
+router = APIRouter(tags=["metrics"])
+
+@router.get("/metrics", response_class = PlainTextResponse)
+def get_metrics():
+    return registry.render()
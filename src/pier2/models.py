@@ -1,7 +1,8 @@
 import enum
 
-from sqlalchemy import Column, Identity, Enum as SQLEnum, DateTime, Integer, String, Float, Boolean, ForeignKey, UniqueConstraint
+from sqlalchemy import Column, Identity, Enum as SQLEnum, DateTime, Integer, String, Float, Boolean, ForeignKey, UniqueConstraint, Index
 from sqlalchemy.orm import declarative_base, relationship
+from sqlalchemy.sql import func
 
 Base = declarative_base()
 
@@ -11,6 +12,9 @@ class FulfillmentModality(enum.Enum):
     store_to_home = 3
     store_inventory = 4
 
+# Modalities delivering to a customer address, i.e. the ones counted as shipping to a zip code.
+HOME_DELIVERY_MODALITIES = [FulfillmentModality.store_to_home, FulfillmentModality.ware_to_home]
+
 class OrderSource(enum.Enum):
     store = 1
     online = 2
@@ -53,7 +57,20 @@ class Orders(Base):
     billing_address_id = Column(Integer, ForeignKey('customer_addresses.customer_address_id'), nullable = False)
 
     billing_address = relationship("CustomerAddresess", foreign_keys=[billing_address_id])
-    items = relationship("OrderItems", back_populates="order")
+    items = relationship("OrderItems", back_populates="order", order_by="OrderItems.order_item_id")
+
+    __table_args__ = (
+        # order_history: equality on customer_id, keyset order on (time_of_order, order_id).
+        Index('ix_orders_customer_time', 'customer_id', 'time_of_order', 'order_id'),
+        # count_billing_orders (rollup rebuild): covering for the join on the billing address.
+        Index('ix_orders_billing_address', 'billing_address_id'),
+        # instore_shoppers (rollup rebuild): covering for the filter on source grouped by customer.
+        Index('ix_orders_source_customer', 'source', 'customer_id'),
+        # Windowed aggregates: range on time_of_order, covering for count_billing_orders and
+        # count_by_shipping_zip, equality on source then range for instore_shoppers.
+        Index('ix_orders_time', 'time_of_order', 'billing_address_id'),
+        Index('ix_orders_source_time', 'source', 'time_of_order', 'customer_id'),
+    )
 
 
 class OrderItems(Base):
@@ -84,9 +101,54 @@ class OrderItems(Base):
                          'dest_store_id',
                          'dest_customer_address_id',
                          name='_unique_item_src_dest'),
+        # count_by_shipping_zip (rollup rebuild): covering for the join on the destination address,
+        # the modality filter and the distinct order count.
+        Index('ix_order_items_dest_modality_order', 'dest_customer_address_id', 'fulfillment_modality', 'order_id'),
+        # Windowed count_by_shipping_zip: the items of the orders in the window.
+        Index('ix_order_items_order_modality_dest', 'order_id', 'fulfillment_modality', 'dest_customer_address_id'),
     )
 
 
+class OrderIdempotencyKeys(Base):
+    '''
+        Idempotency-Key header of the POST /orders requests and a hash of their body, so a
+        retried request gets the order it created instead of a duplicate.
+    '''
+    __tablename__ = "order_idempotency_keys"
+
+    idempotency_key = Column(String(255), primary_key = True)
+    order_id = Column(Integer, ForeignKey('orders.order_id'), nullable = False)
+    request_hash = Column(String(64), nullable = False)
+    created_at = Column(DateTime, server_default = func.now(), nullable = False)
+
+
+# Rollups maintained incrementally by the order write paths (see rollups.py) so that the
+# /query aggregates do not have to join and group the full order history on every call.
+
+class BillingZipOrderCounts(Base):
+    __tablename__ = "billing_zip_order_counts"
+
+    zip_code = Column(String(5), primary_key = True)
+    order_count = Column(Integer, nullable = False, default = 0)
+
+
+class ShippingZipOrderCounts(Base):
+    '''
+        Number of distinct orders with at least one item delivered to the zip code.
+    '''
+    __tablename__ = "shipping_zip_order_counts"
+
+    zip_code = Column(String(5), primary_key = True)
+    order_count = Column(Integer, nullable = False, default = 0)
+
+
+class InstoreShopperCounts(Base):
+    __tablename__ = "instore_shopper_counts"
+
+    customer_id = Column(Integer, ForeignKey('customers.customer_id'), primary_key = True)
+    order_count = Column(Integer, index = True, nullable = False, default = 0)
+
+
 class Stores(Base):
     __tablename__ = "stores"
 
@@ -0,0 +1,155 @@
+'''
+    Pre-aggregated rollups backing the /query aggregates.
+
+    The write paths call record_orders() inside their own transaction so the rollups
+    never drift from orders/order_items. Data loaded behind the API's back (raw copies,
+    older databases) can be brought in line with rebuild(), and verify() recomputes
+    every rollup from the base tables and reports the differences.
+
+    The same queries restricted to a window of time_of_order (and optionally grouped per
+    day/week/month) answer the windowed /query aggregates, which the rollups cannot.
+'''
+import logging
+from collections import Counter
+from sqlalchemy import select, delete, func, distinct, insert, literal_column, cast, Date
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+
+from .models import (CustomerAddresess, Orders, OrderItems, OrderSource, HOME_DELIVERY_MODALITIES,
+                     BillingZipOrderCounts, ShippingZipOrderCounts, InstoreShopperCounts)
+
+logger = logging.getLogger(__name__)
+
+
+BUCKETS = ["day", "week", "month"]
+
+# SQLite date() modifiers and Postgres date_trunc units, weeks start on Monday in both.
+SQLITE_BUCKET_MODIFIERS = {"day": [], "week": ["weekday 0", "-6 days"], "month": ["start of month"]}
+
+def time_bucket(column, bucket: str, dialect: str):
+    '''
+        First day of the day/week/month bucket containing column, as a date.
+    '''
+    if bucket not in BUCKETS:
+        raise ValueError(f"Unknown bucket {bucket}.")
+    # Literal units so that the expression renders identically in the select and the group by.
+    if dialect == "sqlite":
+        return func.date(column, *[literal_column(f"'{m}'") for m in SQLITE_BUCKET_MODIFIERS[bucket]], type_ = Date)
+    if dialect == "postgresql":
+        # date_trunc returns a timestamp, the cast makes the bucket keys dates as on SQLite.
+        return cast(func.date_trunc(literal_column(f"'{bucket}'"), column), Date)
+    raise NotImplementedError(f"Time buckets do not support the {dialect} dialect yet.")
+
+def _window(query, start, end, bucket, dialect):
+    '''
+        Restricts query to start <= time_of_order < end and adds a "bucket" column it is also
+        grouped by. ix_orders_time lets the database read only the orders in the window.
+    '''
+    if start is not None:
+        query = query.where(Orders.time_of_order >= start)
+    if end is not None:
+        query = query.where(Orders.time_of_order < end)
+    if bucket is not None:
+        column = time_bucket(Orders.time_of_order, bucket, dialect).label("bucket")
+        query = query.add_columns(column).group_by(column)
+    return query
+
+def is_windowed(start, end, bucket) -> bool:
+    return start is not None or end is not None or bucket is not None
+
+def billing_zip_counts_query(start = None, end = None, bucket = None, dialect = None):
+    query = select(CustomerAddresess.zip_code, func.count().label("order_count")).join(
+        Orders, Orders.billing_address_id == CustomerAddresess.customer_address_id).group_by(
+            CustomerAddresess.zip_code)
+    return _window(query, start, end, bucket, dialect)
+
+def shipping_zip_counts_query(start = None, end = None, bucket = None, dialect = None):
+    query = select(CustomerAddresess.zip_code, func.count(distinct(OrderItems.order_id)).label("order_count")).join(
+        OrderItems, OrderItems.dest_customer_address_id == CustomerAddresess.customer_address_id).where(
+            OrderItems.fulfillment_modality.in_(HOME_DELIVERY_MODALITIES)).group_by(
+                CustomerAddresess.zip_code)
+    if not is_windowed(start, end, bucket):
+        return query
+    # An IN on the orders in the window rather than a join, so that the items are looked up by
+    # order_id instead of read through the modality index for the whole history.
+    query = query.where(OrderItems.order_id.in_(_window(select(Orders.order_id), start, end, None, dialect)))
+    if bucket is not None:
+        query = query.join(Orders, Orders.order_id == OrderItems.order_id)
+    return _window(query, None, None, bucket, dialect)
+
+def instore_shopper_counts_query(start = None, end = None, bucket = None, dialect = None):
+    query = select(Orders.customer_id, func.count().label("order_count")).where(
+        Orders.source == OrderSource.store).group_by(Orders.customer_id)
+    return _window(query, start, end, bucket, dialect)
+
+# rollup model -> (key column name, query computing it from the base tables)
+ROLLUPS = {
+    BillingZipOrderCounts: ("zip_code", billing_zip_counts_query),
+    ShippingZipOrderCounts: ("zip_code", shipping_zip_counts_query),
+    InstoreShopperCounts: ("customer_id", instore_shopper_counts_query),
+}
+
+
+def _increment(db: Session, model, key: str, counts: Counter):
+    if not counts:
+        return
+
+    table = model.__table__
+    dialect = db.get_bind().dialect.name
+    if dialect == "postgresql":
+        stmt = postgresql.insert(table)
+    elif dialect == "sqlite":
+        stmt = sqlite.insert(table)
+    else:
+        raise NotImplementedError(f"Rollups do not support the {dialect} dialect yet.")
+
+    stmt = stmt.on_conflict_do_update(
+        index_elements = [key],
+        set_ = {"order_count": table.c.order_count + stmt.excluded.order_count})
+    # Sorted so concurrent writers lock rows in the same order.
+    db.execute(stmt, [{key: k, "order_count": counts[k]} for k in sorted(counts)])
+
+
+def record_orders(db: Session, orders, addresses):
+    '''
+        orders are the (NewOrder, List[NewOrderItem]) pairs that were just inserted and
+        addresses maps every address id they reference to a row carrying its zip_code.
+    '''
+    billing, shipping, instore = Counter(), Counter(), Counter()
+    for order, items in orders:
+        billing[addresses[order.billing_address_id].zip_code] += 1
+        shipping.update({addresses[item.dest_customer_address_id].zip_code for item in items
+                         if item.fulfillment_modality in HOME_DELIVERY_MODALITIES})
+        if order.source == OrderSource.store:
+            instore[order.customer_id] += 1
+
+    _increment(db, BillingZipOrderCounts, "zip_code", billing)
+    _increment(db, ShippingZipOrderCounts, "zip_code", shipping)
+    _increment(db, InstoreShopperCounts, "customer_id", instore)
+
+
+def rebuild(db: Session):
+    '''
+        Recomputes every rollup from scratch. The caller owns the transaction.
+    '''
+    for model, (key, query) in ROLLUPS.items():
+        db.execute(delete(model))
+        db.execute(insert(model).from_select([key, "order_count"], query()))
+        logger.info(f"Rebuilt {model.__tablename__}.")
+
+
+def verify(db: Session):
+    '''
+        Returns {table name: [(key, expected, actual), ...]} for every rollup that does not
+        match its base tables. An empty dict means all rollups are consistent.
+    '''
+    diffs = {}
+    for model, (key, query) in ROLLUPS.items():
+        expected = dict(db.execute(query()).all())
+        actual = {k: v for k, v in db.execute(select(getattr(model, key), model.order_count)).all() if v}
+        mismatched = [(k, expected.get(k, 0), actual.get(k, 0))
+                      for k in sorted(expected.keys() | actual.keys(), key = str)
+                      if expected.get(k, 0) != actual.get(k, 0)]
+        if mismatched:
+            diffs[model.__tablename__] = mismatched
+    return diffs
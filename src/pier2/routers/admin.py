@@ -0,0 +1,49 @@
+import logging
+import os
+from fastapi import APIRouter, Depends, HTTPException, Query
+from sqlalchemy.orm import Session
+from typing import Optional
+from ..cache import entity_cache
+from ..database import get_sync_db
+from ..schemas import ImportFiles, ImportResult
+from ..slow_queries import slow_query_log
+from ..metrics import MetricsRoute
+
+logger = logging.getLogger(__name__)
+router = APIRouter(prefix="/admin", tags=["admin"], route_class=MetricsRoute)
+
+@router.get("/cache")
+def get_cache_stats():
+    return entity_cache.stats()
+
+@router.get("/slow_queries")
+def get_slow_queries(limit: Optional[int] = Query(None, gt = 0)):
+    '''
+        The statements that exceeded slow_queries.threshold_ms, newest first.
+    '''
+    return slow_query_log.entries(limit)
+
+@router.post("/import", response_model=ImportResult)
+def import_files(files: ImportFiles, db: Session = Depends(get_sync_db)):
+    '''
+        Imports CSV or Parquet files of the import directory (config.yaml imports.directory), see
+        importer.py. A sync handler with a blocking session in both database modes, so the import
+        runs in the threadpool rather than on the event loop.
+    '''
+    # Imported here, pandas is only needed by the service when importing.
+    try:
+        from .. import importer
+    except ImportError:
+        raise HTTPException(status_code=501, detail="Imports require pandas.")
+
+    paths = {}
+    for name, path in files.model_dump().items():
+        if path is None:
+            continue
+        try:
+            paths[name] = importer.resolve_path(path)
+        except ValueError as e:
+            raise HTTPException(status_code=422, detail=str(e))
+        if name != "rejects" and not os.path.isfile(paths[name]):
+            raise HTTPException(status_code=422, detail=f"{path} does not exist.")
+    return importer.import_files(db, ImportFiles(**paths))
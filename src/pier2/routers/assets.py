@@ -1,16 +1,47 @@
 import logging
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from sqlalchemy import func, insert, literal, select, text
 from sqlalchemy.orm import Session
 from typing import List
-from ..database import get_db, transactional
+from ..database import get_db, get_read_db, transactional, read_only
+from ..cache import cached, invalidate
+from ..id_registry import id_registry
 from ..models import Stores, Warehouses, Items
-from ..schemas import NewStore, Store, NewWarehouse, Warehouse, NewItem, Item
+from ..schemas import NewStore, Store, NewWarehouse, Warehouse, NewItem, Item, IdRange
+from ..metrics import MetricsRoute
 
 logger = logging.getLogger(__name__)
 
-stores_router = APIRouter(prefix="/stores", tags=["stores"])
-items_router = APIRouter(prefix="/items", tags=["items"])
-warehouses_router = APIRouter(prefix="/warehouses", tags=["warehouses"])
+stores_router = APIRouter(prefix="/stores", tags=["stores"], route_class=MetricsRoute)
+items_router = APIRouter(prefix="/items", tags=["items"], route_class=MetricsRoute)
+warehouses_router = APIRouter(prefix="/warehouses", tags=["warehouses"], route_class=MetricsRoute)
+
+# Rows created by one call of the /batch endpoints.
+MAX_BATCH_COUNT = 1000000
+
+def _add_batch(db: Session, model, count: int) -> IdRange:
+    '''
+        Inserts count rows with one INSERT ... SELECT from a recursive CTE counting up from the
+        largest id, so the new ids are contiguous. SQLite serializes writers, Postgres takes a
+        table lock for the duration of the transaction and has its identity sequence moved past
+        the new ids.
+    '''
+    table = model.__table__
+    key = table.primary_key.columns[0]
+    postgres = db.get_bind().dialect.name == "postgresql"
+    if postgres:
+        db.execute(text(f"LOCK TABLE {table.name} IN EXCLUSIVE MODE"))
+
+    ids = select((func.coalesce(func.max(key), 0) + 1).label("id"), literal(1).label("n")).cte("ids", recursive = True)
+    ids = ids.union_all(select(ids.c.id + 1, ids.c.n + 1).where(ids.c.n < count))
+    db.execute(insert(table).from_select([key.name], select(ids.c.id)))
+
+    last_id = db.execute(select(func.max(key))).scalar_one()
+    if postgres:
+        db.execute(text(f"SELECT setval(pg_get_serial_sequence('{table.name}', '{key.name}'), {last_id})"))
+
+    id_registry.add_range(db, table.name, last_id - count + 1, last_id)
+    return IdRange(first_id = last_id - count + 1, last_id = last_id, count = count)
 
 # Stores
 @stores_router.post("/", response_model=Store)
@@ -20,11 +51,19 @@ def add_store(store: NewStore, db: Session = Depends(get_db)):
     db.add(store)
     db.flush()
     db.refresh(store)
+    invalidate(db, "store", store.store_id)
+    id_registry.add(db, "stores", store.store_id)
     return store
 
-@stores_router.get("/{store_id}", response_model=Store)
+@stores_router.post("/batch", response_model=IdRange)
 @transactional
-def get_store(store_id: int, db: Session = Depends(get_db)):
+def add_stores_batch(count: int = Query(gt = 0, le = MAX_BATCH_COUNT), db: Session = Depends(get_db)):
+    return _add_batch(db, Stores, count)
+
+@stores_router.get("/{store_id}", response_model=Store)
+@cached("store", Store, "store_id")
+@read_only
+def get_store(store_id: int, db: Session = Depends(get_read_db)):
     store = db.query(Stores).filter(Stores.store_id == store_id).first()
     if not store:
         raise HTTPException(status_code=404, detail="Store not found")
@@ -38,11 +77,19 @@ def add_warehouse(warehouse: NewWarehouse, db: Session = Depends(get_db)):
     db.add(warehouse)
     db.flush()
     db.refresh(warehouse)
+    invalidate(db, "warehouse", warehouse.warehouse_id)
+    id_registry.add(db, "warehouses", warehouse.warehouse_id)
     return warehouse
 
-@warehouses_router.get("/{warehouse_id}", response_model=Warehouse)
+@warehouses_router.post("/batch", response_model=IdRange)
 @transactional
-def get_warehouse(warehouse_id: int, db: Session = Depends(get_db)):
+def add_warehouses_batch(count: int = Query(gt = 0, le = MAX_BATCH_COUNT), db: Session = Depends(get_db)):
+    return _add_batch(db, Warehouses, count)
+
+@warehouses_router.get("/{warehouse_id}", response_model=Warehouse)
+@cached("warehouse", Warehouse, "warehouse_id")
+@read_only
+def get_warehouse(warehouse_id: int, db: Session = Depends(get_read_db)):
     warehouse = db.query(Warehouses).filter(Warehouses.warehouse_id == warehouse_id).first()
     if not warehouse:
         raise HTTPException(status_code=404, detail="warehouse not found")
@@ -56,12 +103,20 @@ def add_item(item: NewItem, db: Session = Depends(get_db)):
     db.add(item)
     db.flush()
     db.refresh(item)
+    invalidate(db, "item", item.item_id)
+    id_registry.add(db, "items", item.item_id)
     return item
 
-@items_router.get("/{item_id}", response_model=Item)
+@items_router.post("/batch", response_model=IdRange)
 @transactional
-def get_item(item_id: int, db: Session = Depends(get_db)):
-    item = db.query(Items).filter(Items.v == item_id).first()
+def add_items_batch(count: int = Query(gt = 0, le = MAX_BATCH_COUNT), db: Session = Depends(get_db)):
+    return _add_batch(db, Items, count)
+
+@items_router.get("/{item_id}", response_model=Item)
+@cached("item", Item, "item_id")
+@read_only
+def get_item(item_id: int, db: Session = Depends(get_read_db)):
+    item = db.query(Items).filter(Items.item_id == item_id).first()
     if not item:
         raise HTTPException(status_code=404, detail="Item not found")
-    return Item
\ No newline at end of file
+    return item
\ No newline at end of file
@@ -2,13 +2,15 @@ import logging
 from fastapi import APIRouter, Depends, HTTPException
 from sqlalchemy.orm import Session
 
-from ..database import get_db, transactional
+from ..database import get_db, get_read_db, transactional, read_only
+from ..cache import cached, invalidate, forget_customer_lookups
 from ..models import Customers, CustomerAddresess
 from ..schemas import NewCustomer, Customer, NewCustomerAddress, CustomerAddress
+from ..metrics import MetricsRoute
 
 logger = logging.getLogger(__name__)
 
-router = APIRouter(prefix="/customers", tags=["customers"])
+router = APIRouter(prefix="/customers", tags=["customers"], route_class=MetricsRoute)
 
 @router.post("/", response_model=Customer)
 @transactional
@@ -17,11 +19,14 @@ def add_customer(customer: NewCustomer, db: Session = Depends(get_db)):
     db.add(db_customer)
     db.flush()
     db.refresh(db_customer)
+    invalidate(db, "customer", db_customer.customer_id)
+    forget_customer_lookups(db, db_customer.email, db_customer.phone)
     return db_customer
 
 @router.get("/{customer_id}", response_model=Customer)
-@transactional
-def get_customer(customer_id: int, db: Session = Depends(get_db)):
+@cached("customer", Customer, "customer_id")
+@read_only
+def get_customer(customer_id: int, db: Session = Depends(get_read_db)):
     customer = db.query(Customers).filter(Customers.customer_id == customer_id).first()
     if not customer:
         raise HTTPException(status_code=404, detail="Customer not found")
@@ -34,11 +39,13 @@ def add_customer_address(customer_address: NewCustomerAddress, db: Session = Dep
     db.add(db_customer_add)
     db.flush()
     db.refresh(db_customer_add)
+    invalidate(db, "customer_address", db_customer_add.customer_address_id)
     return db_customer_add
 
 @router.get("/addresses/{customer_address_id}", response_model=CustomerAddress)
-@transactional
-def get_customer_address(customer_address_id: int, db: Session = Depends(get_db)):
+@cached("customer_address", CustomerAddress, "customer_address_id")
+@read_only
+def get_customer_address(customer_address_id: int, db: Session = Depends(get_read_db)):
     customer_add = db.query(CustomerAddresess).filter(CustomerAddresess.customer_address_id == customer_address_id).first()
     if not customer_add:
         raise HTTPException(status_code=404, detail="Customer address not found")
@@ -0,0 +1,96 @@
+import datetime
+import logging
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import StreamingResponse
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from typing import Literal, Optional
+from ..database import get_read_db, read_only, stream_partitions
+from .. import rollups
+from ..export_formats import FORMATS
+from ..models import Orders, OrderItems, CustomerAddresess, BillingZipOrderCounts, ShippingZipOrderCounts, InstoreShopperCounts
+from ..metrics import MetricsRoute
+from .queries import Bucket, _window_params
+
+logger = logging.getLogger(__name__)
+router = APIRouter(prefix="/export", tags=["export"], route_class=MetricsRoute)
+
+# Rows per chunk read through the server side cursor and written out, so an export holds at
+# most this many rows in memory whatever the size of the table.
+EXPORT_CHUNK_SIZE = 10000
+
+Format = Literal["csv", "arrow", "parquet"]
+
+TABLES = {"orders": Orders, "order_items": OrderItems, "customer_addresses": CustomerAddresess}
+
+# /query aggregate -> (rollup model, key column, query computing a window from the base tables)
+AGGREGATES = {
+    "count_billing_orders": (BillingZipOrderCounts, "zip_code", rollups.billing_zip_counts_query),
+    "count_by_shipping_zip": (ShippingZipOrderCounts, "zip_code", rollups.shipping_zip_counts_query),
+    "instore_shoppers": (InstoreShopperCounts, "customer_id", rollups.instore_shopper_counts_query),
+}
+
+def _encoded(writer, partitions):
+    '''
+        The bytes of every chunk as it is read, then the end of the file. Sync iterators are run
+        in Starlette's threadpool by StreamingResponse, so encoding does not block the event loop.
+    '''
+    if hasattr(partitions, "__aiter__"):
+        async def chunks():
+            async for rows in partitions:
+                yield writer.write(rows)
+            yield writer.close()
+        return chunks()
+
+    def chunks():
+        for rows in partitions:
+            yield writer.write(rows)
+        yield writer.close()
+    return chunks()
+
+def _export(db: Session, statement, format: str, name: str) -> StreamingResponse:
+    try:
+        writer = FORMATS[format]([(column.name, column.type) for column in statement.selected_columns])
+    except ImportError:
+        raise HTTPException(status_code=501, detail=f"The {format} format requires pyarrow.")
+    return StreamingResponse(_encoded(writer, stream_partitions(db, statement, EXPORT_CHUNK_SIZE)),
+                             media_type = writer.media_type,
+                             headers = {"Content-Disposition": f'attachment; filename="{name}.{writer.extension}"'})
+
+@router.get("/query/{aggregate}")
+@read_only
+def export_aggregate(aggregate: Literal[tuple(AGGREGATES)],
+                     format: Format = "csv",
+                     start: Optional[datetime.datetime] = None,
+                     end: Optional[datetime.datetime] = None,
+                     bucket: Optional[Bucket] = None,
+                     db: Session = Depends(get_read_db)):
+    '''
+        Every row of a /query aggregate (no top_k), largest count first. With start, end or bucket
+        the counts are computed from the orders as for the /query endpoint, with a bucket column
+        first when bucketed.
+    '''
+    _window_params(start, end, bucket)
+    model, key, query = AGGREGATES[aggregate]
+
+    if not rollups.is_windowed(start, end, bucket):
+        statement = select(getattr(model, key), model.order_count).order_by(
+            model.order_count.desc(), getattr(model, key))
+    else:
+        counts = query(start, end, bucket, db.get_bind().dialect.name).subquery()
+        buckets = [counts.c.bucket] if bucket is not None else []
+        statement = select(*buckets, counts.c[key], counts.c.order_count).order_by(
+            *buckets, counts.c.order_count.desc(), counts.c[key])
+    return _export(db, statement, format, aggregate)
+
+@router.get("/{table}")
+@read_only
+def export_table(table: Literal[tuple(TABLES)],
+                 format: Format = "csv",
+                 db: Session = Depends(get_read_db)):
+    '''
+        Every row of table in primary key order, streamed in chunks of EXPORT_CHUNK_SIZE rows.
+    '''
+    model = TABLES[table]
+    statement = select(model.__table__).order_by(*model.__table__.primary_key.columns)
+    return _export(db, statement, format, table)
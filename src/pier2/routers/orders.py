@@ -1,58 +1,246 @@
+import hashlib
+import json
 import logging
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
-from typing import List
-from ..database import get_db, transactional
-from ..models import Orders, OrderItems, CustomerAddresess, FulfillmentModality
-from ..schemas import NewOrder, NewOrderItem, Order, OrderItem
+from fastapi import APIRouter, Depends, Header, HTTPException
+from sqlalchemy import select, insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, selectinload
+from functools import partial
+from itertools import islice
+from typing import Annotated, List, Optional
+from ..database import get_db, get_read_db, transactional, read_only, after_commit
+from ..cache import cached, invalidate, data_changed, idempotency_cache, MISSING
+from ..id_registry import id_registry
+from ..models import Customers, Orders, OrderItems, CustomerAddresess, OrderIdempotencyKeys, HOME_DELIVERY_MODALITIES
+from .. import rollups
+from ..sketches import sketches
+from ..materializer import materializer
+from ..schemas import NewOrder, NewOrderItem, Order, OrderItem, NewBulkOrder, BulkOrderResult, BulkOrderRejection
+from ..schemas import MODALITY_COLUMNS, modality_errors
+from ..metrics import MetricsRoute
 
 logger = logging.getLogger(__name__)
-router = APIRouter(prefix="/orders", tags=["orders"])
+router = APIRouter(prefix="/orders", tags=["orders"], route_class=MetricsRoute)
+
+# Orders validated (one IN query) and inserted (one executemany per table) at a time by /orders/bulk.
+BULK_BATCH_SIZE = 1000
+
+def _fetch_addresses(db: Session, address_ids):
+    rows = db.execute(select(CustomerAddresess.customer_address_id,
+                             CustomerAddresess.is_billing,
+                             CustomerAddresess.is_shipping,
+                             CustomerAddresess.zip_code).where(
+        CustomerAddresess.customer_address_id.in_(address_ids)))
+    return {row.customer_address_id: row for row in rows}
+
+def _fetch_customer_ids(db: Session, customer_ids) -> set:
+    return set(db.execute(select(Customers.customer_id).where(Customers.customer_id.in_(customer_ids))).scalars())
+
+def _order_address_ids(order: NewOrder, items: List[NewOrderItem]):
+    address_ids = {order.billing_address_id}
+    address_ids.update(item.dest_customer_address_id for item in items
+                       if item.fulfillment_modality in HOME_DELIVERY_MODALITIES)
+    return address_ids
+
+# Item columns referencing rows of the id_registry tables.
+REFERENCE_COLUMNS = {"item_id": "items", "source_warehouse_id": "warehouses",
+                     "source_store_id": "stores", "dest_store_id": "stores"}
+
+def _unknown_references(db: Session, items: List[NewOrderItem]) -> set:
+    '''
+        (column, id) of the references of items to rows that do not exist.
+    '''
+    ids = {}
+    for column, table in REFERENCE_COLUMNS.items():
+        ids.setdefault(table, set()).update(getattr(item, column) for item in items
+                                            if getattr(item, column) is not None)
+    missing = {table: id_registry.missing(db, table, table_ids) for table, table_ids in ids.items()}
+    return {(column, id) for column, table in REFERENCE_COLUMNS.items() for id in missing[table]}
+
+def _order_rejection(order: NewOrder, items: List[NewOrderItem], addresses, unknown,
+                     customer_ids: Optional[set] = None) -> Optional[str]:
+    '''
+        Returns why an order cannot be inserted, checked against prefetched addresses, the
+        unknown references found by _unknown_references and, if given, the existing customer ids.
+    '''
+    if customer_ids is not None and order.customer_id not in customer_ids:
+        return f"Unknown customer_id {order.customer_id}"
+
+    billing = addresses.get(order.billing_address_id)
+    if not billing:
+        return "The billing address id is invalid."
+    if not billing.is_billing:
+        return "The address provided for billing is not marked as a billing address."
+
+    for item in items:
+        if item.fulfillment_modality in HOME_DELIVERY_MODALITIES:
+            shipping = addresses.get(item.dest_customer_address_id)
+            if not shipping:
+                return f"The shipping address id {item.dest_customer_address_id} is invalid."
+            if not shipping.is_shipping:
+                return "Some shipping addresses are not marked as is_shipping. "
+
+    if unknown:
+        for item in items:
+            for column in REFERENCE_COLUMNS:
+                if (column, getattr(item, column)) in unknown:
+                    return f"Unknown {column} {getattr(item, column)}"
+
+    return None
+
+def _modality_rejections(entries: List[NewBulkOrder]) -> List[Optional[str]]:
+    '''
+        The first fulfillment modality error of the items of every order, checked for all the
+        items at once.
+    '''
+    items = [item for entry in entries for item in entry.items]
+    errors = iter(modality_errors([item.fulfillment_modality for item in items],
+                                  {column: [getattr(item, column) for item in items] for column in MODALITY_COLUMNS}))
+    rejections = []
+    for entry in entries:
+        order_errors = [error for error in islice(errors, len(entry.items)) if error]
+        rejections.append(order_errors[0] if order_errors else None)
+    return rejections
+
+def _request_hash(order: NewOrder, items: List[NewOrderItem]) -> str:
+    body = [order.model_dump(mode = "json"), [item.model_dump(mode = "json") for item in items]]
+    return hashlib.sha256(json.dumps(body, sort_keys = True).encode()).hexdigest()
+
+def _replayed_order(db: Session, idempotency_key: str, request_hash: str) -> Optional[Order]:
+    '''
+        The response of the order already created with idempotency_key, from idempotency_cache
+        or else the database. None if the key is new.
+    '''
+    entry = idempotency_cache.get(("order", idempotency_key))
+    if entry is MISSING:
+        row = db.execute(select(OrderIdempotencyKeys.order_id, OrderIdempotencyKeys.request_hash).where(
+            OrderIdempotencyKeys.idempotency_key == idempotency_key)).first()
+        if row is None:
+            return None
+        order = db.query(Orders).options(selectinload(Orders.items)).filter(Orders.order_id == row.order_id).one()
+        entry = (row.request_hash, Order.model_validate(order, from_attributes = True))
+        idempotency_cache.set(("order", idempotency_key), entry)
+
+    if entry[0] != request_hash:
+        raise HTTPException(status_code=422, detail="The Idempotency-Key was already used for a different order.")
+    return entry[1]
 
-# FIXME: Consider optimization this function. It's doing a lot of (possibly inneficient) queries.
 @router.post("/", response_model=Order)
 @transactional
-def add_order(order: NewOrder, items: List[NewOrderItem], db: Session = Depends(get_db)):
-    db_order = Orders(**order.dict())
-    items = [OrderItems(**item.dict()) for item in items]
+def add_order(order: NewOrder, items: List[NewOrderItem],
+              idempotency_key: Annotated[Optional[str], Header(max_length = 255)] = None,
+              db: Session = Depends(get_db)):
+    '''
+        Costs one address query and one INSERT ... RETURNING per table (per item on SQLite),
+        the item, store and warehouse ids are checked against id_registry. The response is
+        built from the submitted data and the returned keys instead of refreshing rows.
 
-    for item in items:
-        item.order = db_order
+        A request repeating the Idempotency-Key of an order gets that order back without
+        any validation or insert, a key reused with a different body is rejected.
+    '''
+    if idempotency_key is not None:
+        request_hash = _request_hash(order, items)
+        replayed = _replayed_order(db, idempotency_key, request_hash)
+        if replayed is not None:
+            return replayed
 
-    db_order.items = items
-    db.add(db_order)
-    results = db.query(CustomerAddresess).filter(
-        CustomerAddresess.customer_address_id == order.dict()['billing_address_id']).first()
+    addresses = _fetch_addresses(db, _order_address_ids(order, items))
+    reason = _order_rejection(order, items, addresses, _unknown_references(db, items))
+    if reason:
+        raise HTTPException(status_code=422, detail=reason)
 
-    if not results:
-        raise HTTPException(status_code=422, detail="The billing address id is invalid.")
-    if not results.is_billing:
-        raise HTTPException(status_code=422, detail="The address provided for billing is not marked as a billing address.")
+    order_data = order.dict()
+    order_id = db.execute(insert(Orders).values(**order_data).returning(Orders.order_id)).scalar_one()
+    if idempotency_key is not None:
+        try:
+            db.execute(insert(OrderIdempotencyKeys).values(idempotency_key = idempotency_key, order_id = order_id,
+                                                           request_hash = request_hash))
+        except IntegrityError:
+            raise HTTPException(status_code=409, detail="A request with the same Idempotency-Key is in progress.")
 
-    shipping_home_address_ids = [item.dest_customer_address_id for item in items
-                               if item.fulfillment_modality in
-                               [FulfillmentModality.store_to_home, FulfillmentModality.ware_to_home]]
+    item_rows = [dict(item.dict(), order_id = order_id) for item in items]
+    item_ids = []
+    if item_rows:
+        # Same as the orders of add_orders_bulk: multi-row INSERTs on Postgres, row by row on SQLite.
+        item_ids = db.execute(insert(OrderItems).returning(OrderItems.order_item_id, sort_by_parameter_order = True),
+                              item_rows).scalars().all()
 
-    shipping_home_addresses = db.query(CustomerAddresess).filter(
-        CustomerAddresess.customer_address_id.in_(shipping_home_address_ids)).all()
+    rollups.record_orders(db, [(order, items)], addresses)
+    after_commit(db, lambda: sketches.record_orders([(order_id, order, items)], addresses))
+    invalidate(db, "order", order_id)
+    data_changed(db)
+    after_commit(db, materializer.mark_dirty)
 
-    shipping_home_addresses = {ad.customer_address_id: ad.is_shipping for ad in shipping_home_addresses}
-    if not all(shipping_home_addresses.values()):
-        raise HTTPException(status_code=422,
-                            detail = "Some shipping addresses are not marked as is_shipping. ")
+    created = Order(order_id = order_id,
+                    items = [OrderItem(order_item_id = item_id, **row) for item_id, row in zip(item_ids, item_rows)],
+                    **order_data)
+    if idempotency_key is not None:
+        after_commit(db, lambda: idempotency_cache.set(("order", idempotency_key), (request_hash, created)))
+    return created
 
-    db.flush()
-    db.refresh(db_order)
+@router.post("/bulk", response_model=BulkOrderResult)
+@transactional
+def add_orders_bulk(orders: List[NewBulkOrder], db: Session = Depends(get_db)):
+    '''
+        Set based version of add_order for large replays. Every batch costs one address and
+        one customer query plus one executemany insert for orders and one for items. The items' fulfillment
+        modality rules are checked for the whole batch at once. Invalid orders are reported
+        in `rejected` and do not abort the rest of the batch.
+    '''
+    order_ids = [None] * len(orders)
+    rejected = []
 
-    for item in items:
-        db.refresh(item)
+    for start in range(0, len(orders), BULK_BATCH_SIZE):
+        batch = list(enumerate(orders[start:start + BULK_BATCH_SIZE], start))
+
+        address_ids = set()
+        for _, entry in batch:
+            address_ids.update(_order_address_ids(entry.order, entry.items))
+        addresses = _fetch_addresses(db, address_ids)
+        customer_ids = _fetch_customer_ids(db, {entry.order.customer_id for _, entry in batch})
+        unknown = _unknown_references(db, [item for _, entry in batch for item in entry.items])
+
+        accepted = []
+        modality_rejections = _modality_rejections([entry for _, entry in batch])
+        for (index, entry), modality_rejection in zip(batch, modality_rejections):
+            reason = modality_rejection or _order_rejection(entry.order, entry.items, addresses, unknown, customer_ids)
+            if reason:
+                rejected.append(BulkOrderRejection(index = index, detail = reason))
+            else:
+                accepted.append((index, entry))
 
-    return db_order
+        if not accepted:
+            continue
+
+        # Postgres batches this into multi-row INSERTs. SQLite cannot guarantee RETURNING order for
+        # those so SQLAlchemy executes it row by row there, which is still in-process and cheap.
+        new_ids = db.execute(
+            insert(Orders).returning(Orders.order_id, sort_by_parameter_order = True),
+            [entry.order.dict() for _, entry in accepted]).scalars().all()
+
+        item_rows = []
+        for (index, entry), order_id in zip(accepted, new_ids):
+            order_ids[index] = order_id
+            item_rows.extend(dict(item.dict(), order_id = order_id) for item in entry.items)
+
+        if item_rows:
+            db.execute(insert(OrderItems), item_rows)
+
+        rollups.record_orders(db, [(entry.order, entry.items) for _, entry in accepted], addresses)
+        after_commit(db, partial(sketches.record_orders, [(order_id, entry.order, entry.items)
+                                                          for (_, entry), order_id in zip(accepted, new_ids)], addresses))
+        invalidate(db, "order", *new_ids)
+        data_changed(db)
+        after_commit(db, materializer.mark_dirty)
+
+    logger.info(f"Bulk inserted {len(orders) - len(rejected)} orders, rejected {len(rejected)}.")
+    return BulkOrderResult(order_ids = order_ids, rejected = rejected)
 
 @router.get("/{order_id}", response_model=Order)
-@transactional
-def get_customer(order_id: int, db: Session = Depends(get_db)):
-    order = db.query(Orders).filter(Orders.order_id == order_id).first()
+@cached("order", Order, "order_id")
+@read_only
+def get_order(order_id: int, db: Session = Depends(get_read_db)):
+    order = db.query(Orders).options(selectinload(Orders.items)).filter(Orders.order_id == order_id).first()
     if not order:
         raise HTTPException(status_code=404, detail="Order not found")
     return order
@@ -1,17 +1,111 @@
+import base64
+import datetime
 import logging
-from sqlalchemy import func, distinct, and_
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
-from typing import List
-from ..database import get_db
-from ..models import Customers, CustomerAddresess, OrderItems, Orders, FulfillmentModality, OrderSource
-from ..schemas import Order
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
+from sqlalchemy import select, func, or_, and_
+from sqlalchemy.orm import Session, joinedload, selectinload
+from typing import List, Literal, Optional
+from ..database import get_read_db, on_replica, read_only, stream_partitions, map_stream
+from ..cache import cached_query, customer_lookup_cache, MISSING
+from .. import rollups
+from ..sketches import sketches
+from ..materializer import materializer
+from ..fast_json import FastJSONResponse
+from ..models import Customers, Orders, OrderItems, BillingZipOrderCounts, ShippingZipOrderCounts, InstoreShopperCounts
+from ..schemas import Order, OrderItem
+from ..metrics import MetricsRoute
 
 logger = logging.getLogger(__name__)
-router = APIRouter(prefix="/query", tags=["query"])
+router = APIRouter(prefix="/query", tags=["query"], route_class=MetricsRoute)
+
+# Orders per NDJSON batch, each batch costs one orders query and one selectin query for its items.
+STREAM_BATCH_SIZE = 500
+MAX_PAGE_SIZE = 1000
+
+# Columns of the fast order_history path, in the field order of the response models.
+ORDER_COLUMNS = [getattr(Orders, name) for name in Order.model_fields if name != "items"]
+ORDER_ITEM_COLUMNS = [getattr(OrderItems, name) for name in OrderItem.model_fields]
+
+def encode_cursor(time_of_order: datetime.datetime, order_id: int) -> str:
+    return base64.urlsafe_b64encode(f"{time_of_order.isoformat()}|{order_id}".encode()).decode()
+
+def decode_cursor(cursor: str):
+    try:
+        time_of_order, order_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.datetime.fromisoformat(time_of_order), int(order_id)
+    except ValueError:
+        raise HTTPException(status_code=422, detail=f"Invalid cursor {cursor}.")
+
+def _customer_id(email: Optional[str], phone: Optional[str]):
+    '''
+        The id of the customer with email or phone from customer_lookup_cache, else a scalar
+        subquery resolving it in the statement it is used in. Also returns the cache key.
+    '''
+    key = ("email", email) if email else ("phone", phone)
+    customer_id = customer_lookup_cache.get(key)
+    if customer_id is MISSING:
+        column = Customers.email if email else Customers.phone
+        customer_id = select(Customers.customer_id).where(column == key[1]).scalar_subquery()
+    return key, customer_id
+
+def _order_history_query(customer_id, after: Optional[str], *columns, items = selectinload):
+    '''
+        Keyset pagination on (time_of_order, order_id), which is unique and matches the ordering.
+        Selects the Orders entities with their items (loaded with the items loader option), or
+        only columns when given. customer_id is an id or the subquery of _customer_id.
+    '''
+    query = select(*columns) if columns else select(Orders).options(items(Orders.items))
+    query = query.where(Orders.customer_id == customer_id).order_by(Orders.time_of_order, Orders.order_id)
+
+    if after:
+        time_of_order, order_id = decode_cursor(after)
+        query = query.where(or_(Orders.time_of_order > time_of_order,
+                                and_(Orders.time_of_order == time_of_order, Orders.order_id > order_id)))
+    return query
+
+def _ndjson(orders) -> str:
+    return "".join(Order.model_validate(order, from_attributes = True).model_dump_json() + "\n" for order in orders)
+
+def _fast_order_history(db: Session, query) -> list:
+    '''
+        The orders of query (a column query from _order_history_query) as dicts, with their items
+        joined in the same statement. No ORM objects and no model validation.
+    '''
+    page = query.with_only_columns(Orders.order_id).subquery()
+    rows = select(*ORDER_COLUMNS, *ORDER_ITEM_COLUMNS).join(page, page.c.order_id == Orders.order_id).outerjoin(
+        OrderItems, OrderItems.order_id == Orders.order_id).order_by(
+        Orders.time_of_order, Orders.order_id, OrderItems.order_item_id)
+
+    orders = []
+    order_fields = [name for name in Order.model_fields if name != "items"]
+    for row in db.execute(rows):
+        if not orders or orders[-1]["order_id"] != row[0]:
+            orders.append(dict(zip(order_fields, row), items = []))
+        if row[len(order_fields)] is not None:
+            orders[-1]["items"].append(dict(zip(OrderItem.model_fields, row[len(order_fields):])))
+    return orders
 
 @router.get("/order_history", response_model=List[Order])
-def get_order_history(email: str = None, phone: str = None, db: Session = Depends(get_db)):
+@read_only
+def get_order_history(response: Response,
+                      email: str = None,
+                      phone: str = None,
+                      limit: Optional[int] = Query(None, gt = 0, le = MAX_PAGE_SIZE),
+                      after: Optional[str] = None,
+                      stream: bool = False,
+                      fast: bool = False,
+                      db: Session = Depends(get_read_db)):
+    '''
+        Orders are returned oldest first. With `limit` only one page is returned and the cursor of the
+        next page, if any, is sent in the X-Next-Cursor header to be passed back as `after`.
+        With `stream` the orders are sent as NDJSON, one order per line, in batches of STREAM_BATCH_SIZE.
+        With `fast` the orders are read as tuples and encoded without building the response models,
+        the body is the same.
+
+        The customer is resolved in the statement reading its orders and items (or from
+        customer_lookup_cache), so a page costs one round trip.
+    '''
 
     if email and phone:
         raise ValueError("Both phone number and email id cannot be provided. ")
@@ -19,40 +113,195 @@ def get_order_history(email: str = None, phone: str = None, db: Session = Depend
     if not email and not phone:
         raise ValueError("At least one of phone number and email id must be provided. ")
 
-    customer = None
-    if email:
-        customer = db.query(Customers).filter(Customers.email == email).first()
-    else:
-        customer = db.query(Customers).filter(Customers.phone == phone).first()
+    key, customer_id = _customer_id(email, phone)
+
+    def found(orders) -> list:
+        '''
+            Caches the customer's id from its orders. Without orders it takes a second query to
+            tell whether the customer exists.
+        '''
+        if orders:
+            customer_lookup_cache.set(key, orders[0]["customer_id"] if isinstance(orders[0], dict) else orders[0].customer_id)
+        elif not isinstance(customer_id, int):
+            resolve_customer()
+        return orders
+
+    def resolve_customer() -> int:
+        id = db.execute(select(customer_id)).scalar()
+        if id is None:
+            raise HTTPException(status_code=404, detail=f"Customer not found with {f'Email {email}' if email else f'Phone: {phone}'}")
+        customer_lookup_cache.set(key, id)
+        return id
 
-    if not customer:
-        raise HTTPException(status_code=404, detail=f"Customer not found with {f'Email {email}' if email else f'Phone: {phone}'}")
-    
-    orders = db.query(Orders).filter(Orders.customer_id == customer.customer_id).order_by(Orders.time_of_order).all()
+    if fast and not stream:
+        query = _order_history_query(customer_id, after, *ORDER_COLUMNS)
+        if limit:
+            query = query.limit(limit)
+        orders = found(_fast_order_history(db, query))
+        headers = {}
+        if limit and len(orders) == limit:
+            headers["X-Next-Cursor"] = encode_cursor(orders[-1]["time_of_order"], orders[-1]["order_id"])
+        return FastJSONResponse(orders, headers = headers)
+
+    if stream:
+        # Streamed after the handler returns, too late for a 404.
+        if not isinstance(customer_id, int):
+            customer_id = resolve_customer()
+        query = _order_history_query(customer_id, after)
+        if limit:
+            query = query.limit(limit)
+        return StreamingResponse(map_stream(_ndjson, stream_partitions(db, query, STREAM_BATCH_SIZE, scalars = True)),
+                                 media_type = "application/x-ndjson")
+
+    query = _order_history_query(customer_id, after, items = joinedload)
+    if limit:
+        query = query.limit(limit)
+    orders = found(db.execute(query).unique().scalars().all())
+    if limit and len(orders) == limit:
+        response.headers["X-Next-Cursor"] = encode_cursor(orders[-1].time_of_order, orders[-1].order_id)
     return orders
 
-@router.get("/count_billing_orders")
-def get_count_billing_orders(db: Session = Depends(get_db)):
+# The aggregates below read the rollups kept up to date by the order write paths (see rollups.py)
+# so they cost O(zips) or O(top_k) instead of a join and group by over the whole order history.
+# With a window (start/end) or a bucket they run the rollup queries restricted to the orders placed
+# in [start, end), which ix_orders_time lets the database read without touching the others.
+# Results are cached per data version and carry an ETag, see cache.cached_query.
 
-    results = db.query(CustomerAddresess.zip_code, func.count()).join(
-        Orders, Orders.billing_address_id == CustomerAddresess.customer_address_id).group_by(
-            CustomerAddresess.zip_code).order_by(func.count().desc()).all()
-    return {r[0]: r[1] for r in results}
+Bucket = Literal["day", "week", "month"]
 
-@router.get("/count_by_shipping_zip")
-def get_count_by_shipping_zip(db: Session = Depends(get_db)):
+def _window_params(start, end, bucket) -> dict:
+    if start is not None and end is not None and start >= end:
+        raise HTTPException(status_code=422, detail="start must be before end.")
+    return {"start": start, "end": end, "bucket": bucket}
+
+def _approx_params(approx: bool, start, end, bucket):
+    if not approx:
+        return
+    if not sketches.enabled:
+        raise HTTPException(status_code=501, detail="Approximate answers are disabled (sketches.enabled).")
+    if rollups.is_windowed(start, end, bucket):
+        raise HTTPException(status_code=422, detail="approx cannot be combined with start, end or bucket.")
+
+def _windowed_counts(db: Session, query, bucket: Optional[str], top_k: Optional[int] = None) -> dict:
+    '''
+        {key: count} largest first, or with a bucket {bucket start: {key: count}} for every
+        bucket in one query, top_k applying per bucket.
+    '''
+    counts = query.subquery()
+    key, order_count = counts.c[0], counts.c.order_count
 
-    valid_fulfillment_modalities = [FulfillmentModality.store_to_home, FulfillmentModality.ware_to_home]
+    if bucket is None:
+        query = select(key, order_count).order_by(order_count.desc(), key).limit(top_k)
+        return {r[0]: r[1] for r in db.execute(query)}
 
-    results = db.query(CustomerAddresess.zip_code, func.count(distinct(OrderItems.order_id))).join(
-        OrderItems, OrderItems.dest_customer_address_id == CustomerAddresess.customer_address_id).filter(
-            OrderItems.fulfillment_modality.in_(valid_fulfillment_modalities)).group_by(
-                CustomerAddresess.zip_code).order_by(func.count(distinct(OrderItems.order_id)).desc()).all()
+    rank = func.row_number().over(partition_by = counts.c.bucket,
+                                  order_by = (order_count.desc(), key)).label("rank")
+    ranked = select(counts.c.bucket, key, order_count, rank).subquery()
+    query = select(ranked.c.bucket, ranked.c[1], ranked.c.order_count).order_by(ranked.c.bucket, ranked.c.rank)
+    if top_k is not None:
+        query = query.where(ranked.c.rank <= top_k)
 
+    results = {}
+    for bucket_start, k, count in db.execute(query):
+        results.setdefault(bucket_start.isoformat(), {})[k] = count
+    return results
+
+def _billing_zip_counts(db: Session) -> dict:
+    results = db.query(BillingZipOrderCounts.zip_code, BillingZipOrderCounts.order_count).order_by(
+        BillingZipOrderCounts.order_count.desc(), BillingZipOrderCounts.zip_code).all()
     return {r[0]: r[1] for r in results}
 
+def _shipping_zip_counts(db: Session) -> dict:
+    results = db.query(ShippingZipOrderCounts.zip_code, ShippingZipOrderCounts.order_count).order_by(
+        ShippingZipOrderCounts.order_count.desc(), ShippingZipOrderCounts.zip_code).all()
+    return {r[0]: r[1] for r in results}
+
+# Without a window these two read their whole rollup, the lifespan's materializer keeps them ready.
+materializer.register("count_billing_orders", _billing_zip_counts)
+materializer.register("count_by_shipping_zip", _shipping_zip_counts)
+
+@router.get("/count_billing_orders")
+@read_only
+def get_count_billing_orders(request: Request,
+                             response: Response,
+                             start: Optional[datetime.datetime] = None,
+                             end: Optional[datetime.datetime] = None,
+                             bucket: Optional[Bucket] = None,
+                             db: Session = Depends(get_read_db)):
+    '''
+        Number of orders per billing zip code. Only orders placed in [start, end) are counted
+        if given, with `bucket` the counts are returned per day/week/month.
+    '''
+    params = _window_params(start, end, bucket)
+
+    def compute():
+        if rollups.is_windowed(start, end, bucket):
+            return _windowed_counts(db, rollups.billing_zip_counts_query(
+                start, end, bucket, db.get_bind().dialect.name), bucket)
+        return _billing_zip_counts(db)
+
+    snapshot = None if rollups.is_windowed(start, end, bucket) else materializer.latest("count_billing_orders")
+    return cached_query(request, response, "count_billing_orders", params, compute, snapshot, replica = on_replica(db))
+
+@router.get("/count_by_shipping_zip")
+@read_only
+def get_count_by_shipping_zip(request: Request,
+                              response: Response,
+                              start: Optional[datetime.datetime] = None,
+                              end: Optional[datetime.datetime] = None,
+                              bucket: Optional[Bucket] = None,
+                              approx: bool = False,
+                              db: Session = Depends(get_read_db)):
+    '''
+        Number of orders delivering to each zip code. Window and buckets as for count_billing_orders.
+        With `approx` the counts are HyperLogLog estimates, see sketches.py, each with the
+        bounds of its error: {zip: {"count", "lower", "upper"}}.
+    '''
+    _approx_params(approx, start, end, bucket)
+    params = dict(_window_params(start, end, bucket), approx = approx)
+
+    def compute():
+        if approx:
+            sketches.catch_up(db)
+            return sketches.shipping_counts()
+        if rollups.is_windowed(start, end, bucket):
+            return _windowed_counts(db, rollups.shipping_zip_counts_query(
+                start, end, bucket, db.get_bind().dialect.name), bucket)
+        return _shipping_zip_counts(db)
+
+    snapshot = None if approx or rollups.is_windowed(start, end, bucket) else materializer.latest("count_by_shipping_zip")
+    return cached_query(request, response, "count_by_shipping_zip", params, compute, snapshot, replica = on_replica(db))
+
 @router.get("/instore_shoppers")
-def get_instore_shoppers(top_k: int = 5, db: Session = Depends(get_db)):
-    results = db.query(Orders.customer_id, func.count()).filter(Orders.source == OrderSource.store).group_by(
-        Orders.customer_id).order_by(func.count().desc()).limit(top_k).all()
-    return {r[0]: r[1] for r in results}
\ No newline at end of file
+@read_only
+def get_instore_shoppers(request: Request,
+                         response: Response,
+                         top_k: int = 5,
+                         start: Optional[datetime.datetime] = None,
+                         end: Optional[datetime.datetime] = None,
+                         bucket: Optional[Bucket] = None,
+                         approx: bool = False,
+                         db: Session = Depends(get_read_db)):
+    '''
+        The top_k customers by number of in store orders. Window and buckets as for
+        count_billing_orders, with a bucket the top_k is per bucket. With `approx` they are
+        the heavy hitters of the Space-Saving sketch, see sketches.py, each with the bounds
+        of its count: {customer_id: {"count", "lower", "upper"}}.
+    '''
+    _approx_params(approx, start, end, bucket)
+    if approx and top_k > sketches.capacity:
+        raise HTTPException(status_code=422, detail=f"top_k cannot exceed {sketches.capacity} with approx.")
+    params = dict(_window_params(start, end, bucket), top_k = top_k, approx = approx)
+
+    def compute():
+        if approx:
+            sketches.catch_up(db)
+            return sketches.instore_top(top_k)
+        if rollups.is_windowed(start, end, bucket):
+            return _windowed_counts(db, rollups.instore_shopper_counts_query(
+                start, end, bucket, db.get_bind().dialect.name), bucket, top_k)
+        results = db.query(InstoreShopperCounts.customer_id, InstoreShopperCounts.order_count).order_by(
+            InstoreShopperCounts.order_count.desc(), InstoreShopperCounts.customer_id).limit(top_k).all()
+        return {r[0]: r[1] for r in results}
+
+    return cached_query(request, response, "instore_shoppers", params, compute, replica = on_replica(db))
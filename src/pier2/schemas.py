@@ -1,5 +1,5 @@
 from pydantic import BaseModel, ValidationError, validator, model_validator
-from typing import Optional, List
+from typing import Dict, Optional, List
 from typing_extensions import Self
 import re
 from .models import FulfillmentModality, OrderSource
@@ -13,23 +13,23 @@ states = [
     "SD", "TN", "TX", "UT", "VT", "VA", "WA", "WV", "WI", "WY"
 ]
 
+# Shared with the vectorized checks of importer.py, which apply them with the same re.match semantics.
+PHONE_REGEX = r"^\d{3}-\d{3}-\d{4}$"
+EMAIL_REGEX = r"[^@\s]+@[^@\s]+\.[^@\s]+"
+ZIP_REGEX = r"^\d{5}$"
+
 def validate_phone_number(phone: Optional[str]) -> Optional[str]:
     if phone is None:
         return None
 
-    phone_regex = r"^\d{3}-\d{3}-\d{4}$"
-
-    if not re.match(phone_regex, phone):
+    if not re.match(PHONE_REGEX, phone):
         raise ValueError("Invalid phone number format.")
 
     return phone
 
 def validate_email(email: str) -> str:
 
-
-    email_regex = r"[^@\s]+@[^@\s]+\.[^@\s]+"
-
-    if not re.match(email_regex, email):
+    if not re.match(EMAIL_REGEX, email):
         raise ValueError("Invalid email format.")
 
     return email
@@ -49,9 +49,7 @@ def validate_name(name: str) -> str:
 # FIXME: Obviously need to check zipcode beyond just format.
 def validate_zip(zip: str) -> str:
 
-    zip_regex = r"^\d{5}$"
-
-    if not re.match(zip_regex, zip):
+    if not re.match(ZIP_REGEX, zip):
         raise ValueError("Invalid zip code.")
 
     return zip
@@ -128,6 +126,15 @@ class Item(BaseModel):
     item_id: int
 
 
+class IdRange(BaseModel):
+    '''
+        The ids of the rows created by a /batch endpoint, first_id to last_id inclusive.
+    '''
+    first_id: int
+    last_id: int
+    count: int
+
+
 class OrderItem(BaseModel):
     order_item_id: int
     order_id: int
@@ -141,8 +148,67 @@ class OrderItem(BaseModel):
     dest_store_id: Optional[int] = None
     dest_customer_address_id: Optional[int] = None
 
-    
-class NewOrderItem(BaseModel):
+
+# modality -> (columns that must be set, columns that must be empty), the rules of NewOrderItem
+# as a table for the batch checks of modality_errors.
+MODALITY_RULES = {
+    FulfillmentModality.ware_to_home: (["source_warehouse_id", "dest_customer_address_id"],
+                                       ["source_store_id", "dest_store_id"]),
+    FulfillmentModality.ware_to_store: (["source_warehouse_id", "dest_store_id"],
+                                        ["source_store_id", "dest_customer_address_id"]),
+    FulfillmentModality.store_to_home: (["source_store_id", "dest_customer_address_id"],
+                                        ["source_warehouse_id", "dest_store_id"]),
+    FulfillmentModality.store_inventory: (["source_store_id"],
+                                          ["source_warehouse_id", "dest_store_id", "dest_customer_address_id"]),
+}
+
+MODALITY_COLUMNS = ["source_warehouse_id", "source_store_id", "dest_store_id", "dest_customer_address_id"]
+
+def _column_mask(columns) -> int:
+    return sum(1 << MODALITY_COLUMNS.index(column) for column in columns)
+
+# modality -> (required, forbidden) as bit masks over MODALITY_COLUMNS
+MODALITY_MASKS = {modality: (_column_mask(required), _column_mask(forbidden))
+                  for modality, (required, forbidden) in MODALITY_RULES.items()}
+
+def modality_error(modality: FulfillmentModality, row: dict) -> Optional[str]:
+    '''
+        The error of one row (a dict with the MODALITY_COLUMNS keys), None if it is valid.
+    '''
+    required, forbidden = MODALITY_RULES[modality]
+    for column in required:
+        if row[column] is None:
+            return f"{column} must be input when FulfillmentModality is {modality}"
+    if any(row[column] for column in forbidden):
+        supplied = " or ".join(f"{column} {row[column]}" for column in forbidden)
+        return f"Cannot supply {supplied} when {modality}."
+    return None
+
+def modality_errors(modalities: List[FulfillmentModality], columns: Dict[str, list]) -> List[Optional[str]]:
+    '''
+        The error NewOrderItem raises for each row of a batch, None for valid rows. columns has
+        the values of every MODALITY_COLUMNS column, aligned with modalities.
+
+        The columns are folded into one mask of set and one of non empty (truthy, as the rules
+        were always checked) columns per row, which are compared to MODALITY_MASKS. Only the
+        rows in error are looked at column by column to build their message.
+    '''
+    set_masks = [0] * len(modalities)
+    given_masks = [0] * len(modalities)
+    for bit, column in enumerate(MODALITY_COLUMNS):
+        values = columns[column]
+        set_masks = [mask | (value is not None) << bit for mask, value in zip(set_masks, values)]
+        given_masks = [mask | bool(value) << bit for mask, value in zip(given_masks, values)]
+
+    errors = [None] * len(modalities)
+    for i, (modality, set_mask, given_mask) in enumerate(zip(modalities, set_masks, given_masks)):
+        required, forbidden = MODALITY_MASKS[modality]
+        if set_mask & required != required or given_mask & forbidden:
+            errors[i] = modality_error(modality, {column: columns[column][i] for column in MODALITY_COLUMNS})
+    return errors
+
+
+class OrderItemFields(BaseModel):
 
     item_id: int
     fulfillment_modality: FulfillmentModality
@@ -154,8 +220,11 @@ class NewOrderItem(BaseModel):
     dest_store_id: Optional[int] = None
     dest_customer_address_id: Optional[int] = None
 
+
+class NewOrderItem(OrderItemFields):
+
     @model_validator(mode='after')
-    def validate_datetime(self) -> Self:
+    def validate_source_and_destination(self) -> Self:
         """
             Only 1 each of source and one of dest. should be set.
 
@@ -163,52 +232,18 @@ class NewOrderItem(BaseModel):
             available in the source/dest id's. But in this case being explicit
             at the cost of being redundant.
         """
-        fulfillment_modality = self.fulfillment_modality
-        source_warehouse_id = self.source_warehouse_id
-        source_store_id = self.source_store_id
-        dest_store_id = self.dest_store_id
-        dest_customer_address_id = self.dest_customer_address_id
-
+        error = modality_error(self.fulfillment_modality, {column: getattr(self, column) for column in MODALITY_COLUMNS})
+        if error:
+            raise ValueError(error)
 
-        if fulfillment_modality in [FulfillmentModality.ware_to_home, FulfillmentModality.ware_to_store]:
-                if source_warehouse_id is None:
-                    raise ValueError(f"source_warehouse_id must be input when FulfillmentModality is {fulfillment_modality}")
-
-                if fulfillment_modality == FulfillmentModality.ware_to_home:
-                    if dest_customer_address_id is None:
-                        raise ValueError(f"dest_customer_address_id must be input when FulfillmentModality is {fulfillment_modality}")
-
-                    if source_store_id or dest_store_id:
-                        raise ValueError(f"Cannot supply source_store_id {source_store_id} or dest_store_id {dest_store_id} when {fulfillment_modality}.")
-
-                if fulfillment_modality == FulfillmentModality.ware_to_store:
-                    if dest_store_id is None:
-                        raise ValueError(f"dest_store_id must be input when FulfillmentModality is {fulfillment_modality}")
-                    
-                    if source_store_id or dest_customer_address_id:
-                        raise ValueError(f"Cannot supply source_store_id {source_store_id} or dest_customer_address_id {dest_customer_address_id} when {fulfillment_modality}.")
-
-
-        if fulfillment_modality == FulfillmentModality.store_to_home:
-
-            if source_store_id is None:
-                raise ValueError(f"source_store_id must be input when FulfillmentModality is {fulfillment_modality}")
-
-            if dest_customer_address_id is None:
-                raise ValueError(f"dest_customer_address_id must be input when FulfillmentModality is {fulfillment_modality}")
-
-            if source_warehouse_id or dest_store_id:
-                raise ValueError(f"Cannot supply source_warehouse_id {source_warehouse_id} or dest_store_id {dest_store_id} when {fulfillment_modality}.")
-
-
-        if fulfillment_modality == FulfillmentModality.store_inventory:
-            if source_store_id is None:
-                raise ValueError(f"source_store_id must be input when FulfillmentModality is {fulfillment_modality}")
+        return self
 
-            if source_warehouse_id or dest_store_id or dest_customer_address_id:
-                raise ValueError(f"Cannot supply source_warehouse_id {source_warehouse_id} or dest_store_id {dest_store_id} or dest_customer_address_id {dest_customer_address_id} when {fulfillment_modality}.")
 
-        return self
+class NewBulkOrderItem(OrderItemFields):
+    '''
+        NewOrderItem without the per item modality check, /orders/bulk runs modality_errors over
+        all the items of a batch instead.
+    '''
 
 
 class NewOrder(BaseModel):
@@ -225,14 +260,6 @@ class NewOrder(BaseModel):
 
         return self
 
-    @model_validator(mode='after')
-    def validate_datetime(self) -> Self:
-
-        if not (self.time_of_order.hour != 0 or self.time_of_order.minute != 0 or self.time_of_order.second != 0):
-            raise ValueError("Time of order must contain time information.")
-
-        return self
-
 
 class Order(BaseModel):
     order_id: int
@@ -244,3 +271,54 @@ class Order(BaseModel):
 
 
 
+
+
+class NewBulkOrder(BaseModel):
+    order: NewOrder
+    items: List[NewBulkOrderItem]
+
+
+class BulkOrderRejection(BaseModel):
+    index: int
+    detail: str
+
+
+class BulkOrderResult(BaseModel):
+    '''
+        order_ids is aligned with the submitted orders, None marks a rejected order.
+    '''
+    order_ids: List[Optional[int]]
+    rejected: List[BulkOrderRejection]
+
+
+class ImportFiles(BaseModel):
+    '''
+        Paths on the server of the CSV or Parquet files to import, any subset. rejects is where
+        to write every rejected row as CSV.
+    '''
+    customers: Optional[str] = None
+    customer_addresses: Optional[str] = None
+    orders: Optional[str] = None
+    order_items: Optional[str] = None
+    rejects: Optional[str] = None
+
+
+class ImportTableResult(BaseModel):
+    rows: int = 0
+    imported: int = 0
+    rejected: int = 0
+
+
+class ImportRejection(BaseModel):
+    table: str
+    row: int                    # 1 based, header excluded
+    id: Optional[str] = None    # id of the row in the file
+    detail: str
+
+
+class ImportResult(BaseModel):
+    '''
+        rejected holds the first MAX_REPORTED_REJECTIONS rejections, ImportFiles.rejects gets all of them.
+    '''
+    tables: Dict[str, ImportTableResult]
+    rejected: List[ImportRejection]
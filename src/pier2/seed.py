@@ -0,0 +1,185 @@
+'''
+    Bulk loading of generated datasets (the DataFrames of tests/test_suite.py's get_customers_df,
+    get_customer_addresses_df and get_orders_df) straight into the tables.
+
+    Rows are inserted with batched Core executemany inserts in a single transaction, skipping
+    request validation and the ORM. The ids of the frames are shifted to continue from the ids
+    already in the tables, so every row gets the id the API would have assigned had the rows
+    been posted one by one in frame order. The rollups are rebuilt before committing and the
+    /query data version is bumped afterwards.
+'''
+import logging
+import time
+import pandas as pd
+from sqlalchemy import insert, select, func, text
+from sqlalchemy.orm import Session
+
+from . import rollups
+from .cache import data_version
+from .models import Customers, CustomerAddresess, Orders, OrderItems, FulfillmentModality, OrderSource
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 50000
+
+# Set for the duration of the load on SQLite, restored before committing. A larger page cache keeps
+# the index b-trees in memory while they grow. There is a single commit so synchronous is left alone.
+SQLITE_LOAD_PRAGMAS = {"cache_size": -262144, "temp_store": "MEMORY"}
+
+# frame name -> (model, primary key, [(frame name, foreign key column)] referencing it)
+TABLES = {
+    "customers": (Customers, "customer_id",
+                  [("customer_addresses", "customer_id"), ("orders", "customer_id")]),
+    "customer_addresses": (CustomerAddresess, "customer_address_id",
+                           [("orders", "billing_address_id"), ("order_items", "dest_customer_address_id")]),
+    "orders": (Orders, "order_id", [("order_items", "order_id")]),
+    "order_items": (OrderItems, "order_item_id", []),
+}
+
+ENUM_COLUMNS = {"source": OrderSource, "fulfillment_modality": FulfillmentModality}
+
+
+def frame_columns(table, frame) -> dict:
+    '''
+        {column name: list of values} for the columns of table in frame, with NaN as None,
+        enums by name and time_of_order as datetimes.
+    '''
+    columns = {}
+    for column in [c for c in frame.columns if c in table.c]:
+        values = frame[column]
+        if column in ENUM_COLUMNS and not isinstance(values.iloc[0], (str, ENUM_COLUMNS[column])):
+            values = values.map({e.value: e.name for e in ENUM_COLUMNS[column]})
+        elif column == "time_of_order":
+            values = pd.to_datetime(values)
+        if values.hasnans:
+            values = values.astype(object).where(values.notna(), None)
+        columns[column] = values.tolist()
+    return columns
+
+
+def insert_columns(db: Session, table, columns: dict):
+    '''
+        Compiles the insert once and passes the rows to the driver's executemany in batches.
+        The bind processors of the column types are applied column by column up front rather
+        than per row and parameter by SQLAlchemy, which costs more than the inserts themselves.
+    '''
+    conn = db.connection()
+    dialect = conn.dialect
+    compiled = insert(table).compile(dialect = dialect, column_keys = list(columns))
+
+    for name, values in columns.items():
+        processor = table.c[name].type.dialect_impl(dialect).bind_processor(dialect)
+        if processor is not None:
+            columns[name] = [processor(v) for v in values]
+
+    if compiled.positional:
+        rows = list(zip(*[columns[name] for name in compiled.positiontup]))
+    else:
+        rows = [dict(zip(columns, row)) for row in zip(*columns.values())]
+    for batch in range(0, len(rows), BATCH_SIZE):
+        conn.exec_driver_sql(str(compiled), rows[batch:batch + BATCH_SIZE])
+    return len(rows)
+
+
+def _is_empty(db: Session, table) -> bool:
+    return db.execute(select(table).limit(1)).first() is None
+
+
+def next_id(db: Session, model, key: str) -> int:
+    return (db.execute(select(func.max(getattr(model, key)))).scalar() or 0) + 1
+
+
+def _shift_ids(db: Session, frames: dict) -> dict:
+    '''
+        Moves the ids of every frame (and the columns referencing them) so that the smallest
+        becomes the next id of its table. Returns {frame name: offset}.
+    '''
+    offsets = {}
+    for name, (model, key, references) in TABLES.items():
+        frame = frames.get(name)
+        if frame is None or frame.empty:
+            continue
+        offset = next_id(db, model, key) - int(frame[key].min())
+        offsets[name] = offset
+        if offset == 0:
+            continue
+        frames[name] = frame.assign(**{key: frame[key] + offset})
+        for ref_name, column in references:
+            if frames.get(ref_name) is not None:
+                frames[ref_name] = frames[ref_name].assign(**{column: frames[ref_name][column] + offset})
+    return offsets
+
+
+def _sqlite_pragmas(db: Session, pragmas: dict) -> dict:
+    '''
+        Sets pragmas on the session's connection, returns their previous values.
+    '''
+    conn = db.connection()
+    previous = {name: conn.exec_driver_sql(f"PRAGMA {name}").scalar() for name in pragmas}
+    for name, value in pragmas.items():
+        conn.exec_driver_sql(f"PRAGMA {name} = {value}")
+    return previous
+
+
+def advance_sequences(db: Session, names):
+    '''
+        Postgres hands out identity values from a sequence, which explicit ids do not move.
+        names are keys of TABLES.
+    '''
+    for name in names:
+        model, key, _ = TABLES[name]
+        table = model.__tablename__
+        db.execute(text(f"SELECT setval(pg_get_serial_sequence('{table}', '{key}'), "
+                        f"(SELECT max({key}) FROM {table}))"))
+
+
+def seed(db: Session,
+         customers = None,
+         customer_addresses = None,
+         orders = None,
+         order_items = None,
+         sqlite_pragmas: bool = True,
+         rebuild_rollups: bool = True) -> dict:
+    '''
+        Inserts the given frames (any subset, referenced rows must exist or be part of the
+        load) and commits. Returns {frame name: offset added to its ids}. Items, stores and
+        warehouses referenced by order_items must exist. When loading in chunks, pass
+        rebuild_rollups = False to all but the last one.
+    '''
+    frames = {"customers": customers, "customer_addresses": customer_addresses,
+              "orders": orders, "order_items": order_items}
+    dialect = db.get_bind().dialect.name
+    start = time.perf_counter()
+    try:
+        previous = _sqlite_pragmas(db, SQLITE_LOAD_PRAGMAS) if sqlite_pragmas and dialect == "sqlite" else {}
+        offsets = _shift_ids(db, frames)
+
+        rows = 0
+        for name, (model, key, _) in TABLES.items():
+            if frames[name] is None or frames[name].empty:
+                continue
+            table = model.__table__
+            # Building the secondary indexes of an empty table once at the end beats
+            # growing them row by row.
+            deferred = [index for index in table.indexes if not index.unique] if _is_empty(db, table) else []
+            for index in deferred:
+                index.drop(db.connection())
+            rows += insert_columns(db, table, frame_columns(table, frames[name]))
+            for index in deferred:
+                index.create(db.connection())
+
+        if dialect == "postgresql":
+            advance_sequences(db, [name for name in TABLES if frames[name] is not None and not frames[name].empty])
+        if rebuild_rollups:
+            rollups.rebuild(db)
+        if previous:
+            _sqlite_pragmas(db, previous)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+    data_version.bump()
+    elapsed = time.perf_counter() - start
+    logger.info(f"Seeded {rows} rows in {elapsed:.2f}s ({rows / elapsed:.0f} rows/s).")
+    return offsets
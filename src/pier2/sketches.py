@@ -0,0 +1,408 @@
+'''
+    Streaming sketches answering /query aggregates approximately (approx=true).
+
+    instore_shoppers: a Space-Saving summary of the in store orders per customer keeps the
+    heaviest `capacity` customers with counts that overestimate by at most their recorded error,
+    and a Count-Min sketch of the same stream caps that overestimate (by epsilon * orders with
+    probability 1 - delta). count_by_shipping_zip: a HyperLogLog of the order ids of every zip,
+    with a relative standard error of 1.04 / sqrt(2 ** precision), exact for zips of up to
+    2 ** precision / 16 orders. Answers cost O(top_k) or O(zips) whatever the number of orders
+    and carry lower and upper bounds.
+
+    The order write paths record their orders once committed. Orders written by other workers or
+    loaded behind the API's back (seed, imports) are picked up by catch_up(), which reads the
+    orders above a watermark before every approximate answer, without holding the sketches while
+    it reads. A worker thread started in the lifespan reads the sketches back (then catches up)
+    at startup, pickles them to sketches.path every persist_seconds and at shutdown.
+'''
+import array
+import bisect
+import hashlib
+import heapq
+import logging
+import math
+import os
+import pickle
+import threading
+
+from sqlalchemy import select
+
+from .models import CustomerAddresess, Orders, OrderItems, OrderSource, HOME_DELIVERY_MODALITIES
+
+logger = logging.getLogger(__name__)
+
+SETTINGS_DEFAULTS = {
+    "enabled": True,
+    "capacity": 1000,           # customers monitored by Space-Saving, the largest top_k
+    "epsilon": 0.0005,          # Count-Min overestimate bound, as a fraction of the orders
+    "delta": 0.01,
+    "precision": 10,            # HyperLogLog registers per zip = 2 ** precision
+    "path": "sketches.pickle",  # null to keep them in memory only
+    "persist_seconds": 60,
+}
+
+CATCH_UP_BATCH_SIZE = 10000
+# catch_up keeps the watermark this many ids below the highest order it has read and reads them
+# again, so an order committed after a later one (ids are allocated before commit) is not missed.
+CATCH_UP_RESCAN_IDS = 1000
+
+
+def _hash(value) -> int:
+    '''
+        64 bit hash, stable across processes unlike hash() so persisted sketches stay valid.
+    '''
+    return int.from_bytes(hashlib.blake2b(str(value).encode(), digest_size = 8).digest(), "little")
+
+
+class SpaceSaving:
+    '''
+        Top heavy hitters of a stream in `capacity` counters. A key that is not monitored takes
+        over the smallest counter, inheriting its count as its error, so count - error <= true
+        count <= count.
+    '''
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.counters = {}      # key -> [count, error]
+        self._heap = []         # (count, key), stale entries are skipped when popping
+
+    def add(self, key, count: int = 1):
+        counter = self.counters.get(key)
+        if counter is None:
+            if len(self.counters) < self.capacity:
+                counter = self.counters[key] = [0, 0]
+            else:
+                smallest = self._pop_smallest()
+                error = self.counters.pop(smallest)[0]
+                counter = self.counters[key] = [error, error]
+        counter[0] += count
+        heapq.heappush(self._heap, (counter[0], key))
+        if len(self._heap) > 4 * self.capacity:
+            self._heap = [(counter[0], key) for key, counter in self.counters.items()]
+            heapq.heapify(self._heap)
+
+    def _pop_smallest(self):
+        while True:
+            count, key = heapq.heappop(self._heap)
+            counter = self.counters.get(key)
+            if counter is not None and counter[0] == count:
+                return key
+
+    def top(self, k: int) -> list:
+        '''
+            [(key, count, error)] of the k largest counts.
+        '''
+        return [(key, count, error) for key, (count, error) in
+                heapq.nlargest(k, self.counters.items(), key = lambda item: item[1][0])]
+
+
+class CountMinSketch:
+
+    def __init__(self, epsilon: float, delta: float):
+        self.width = math.ceil(math.e / epsilon)
+        self.depth = math.ceil(math.log(1 / delta))
+        self.epsilon = epsilon
+        self.total = 0
+        self.rows = [array.array("q", bytes(8 * self.width)) for _ in range(self.depth)]
+
+    def _columns(self, key):
+        h = _hash(key)
+        h1, h2 = h & 0xFFFFFFFF, h >> 32
+        return [(h1 + i * h2) % self.width for i in range(self.depth)]
+
+    def add(self, key, count: int = 1):
+        self.total += count
+        for row, column in zip(self.rows, self._columns(key)):
+            row[column] += count
+
+    def estimate(self, key) -> int:
+        '''
+            Never below the true count, above it by at most epsilon * total with probability 1 - delta.
+        '''
+        return min(row[column] for row, column in zip(self.rows, self._columns(key)))
+
+
+class HyperLogLog:
+    '''
+        Keeps the sum of 2 ** -register (scaled by 2 ** 64 to stay an exact integer) and the
+        number of empty registers up to date, so estimate() is O(1). Until more than
+        2 ** precision / 16 values are added their sorted hashes are kept instead (as HLL++
+        does), so the small counts of most zips are exact rather than off by register collisions.
+    '''
+    _sparse = None      # sketches persisted before the sparse phase have registers only
+
+    def __init__(self, precision: int):
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+        self._inverse_sum = len(self.registers) << 64
+        self._zeros = len(self.registers)
+        self._sparse = array.array("Q")
+
+    @property
+    def exact(self) -> bool:
+        return self._sparse is not None
+
+    def add(self, value):
+        h = _hash(value)
+        if self._sparse is not None:
+            position = bisect.bisect_left(self._sparse, h)
+            if position < len(self._sparse) and self._sparse[position] == h:
+                return
+            if len(self._sparse) < len(self.registers) >> 4:
+                self._sparse.insert(position, h)
+                return
+            sparse, self._sparse = self._sparse, None
+            for previous in sparse:
+                self._add_hash(previous)
+        self._add_hash(h)
+
+    def _add_hash(self, h: int):
+        index = h >> (64 - self.precision)
+        rest = h & ((1 << (64 - self.precision)) - 1)
+        rank = (64 - self.precision) - rest.bit_length() + 1
+        register = self.registers[index]
+        if rank > register:
+            self._inverse_sum += (1 << (64 - rank)) - (1 << (64 - register))
+            self._zeros -= register == 0
+            self.registers[index] = rank
+
+    def estimate(self) -> float:
+        if self._sparse is not None:
+            return len(self._sparse)
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m * (1 << 64) / self._inverse_sum
+        if estimate <= 2.5 * m and self._zeros:
+            # Small range correction (linear counting).
+            estimate = m * math.log(m / self._zeros)
+        return estimate
+
+
+class Sketches:
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        # One catch-up at a time, the next one only reads what the previous one did not.
+        self._catch_up_lock = threading.RLock()
+        self._catching_up = False
+        self._stop = threading.Event()
+        self._thread = None
+        self.configure()
+
+    def configure(self, settings: dict = None):
+        settings = dict(SETTINGS_DEFAULTS, **(settings or {}))
+        self.enabled = settings["enabled"]
+        self.capacity = settings["capacity"]
+        self.epsilon = settings["epsilon"]
+        self.delta = settings["delta"]
+        self.precision = settings["precision"]
+        self.path = settings["path"]
+        self.persist_seconds = settings["persist_seconds"]
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self.instore = SpaceSaving(self.capacity)
+            self.instore_counts = CountMinSketch(self.epsilon, self.delta)
+            self.shipping = {}              # zip code -> HyperLogLog of order ids
+            # Every order up to watermark has been recorded, and those of seen above it.
+            self.watermark = 0
+            self.seen = set()
+            self.recorded = 0
+
+    def _record(self, order_id: int, instore_customer_id, shipping_zips):
+        if order_id <= self.watermark or order_id in self.seen:
+            return
+        if order_id == self.watermark + 1:
+            self.watermark = order_id
+            while self.watermark + 1 in self.seen:
+                self.watermark += 1
+                self.seen.remove(self.watermark)
+        else:
+            self.seen.add(order_id)
+        self.recorded += 1
+        if instore_customer_id is not None:
+            self.instore.add(instore_customer_id)
+            self.instore_counts.add(instore_customer_id)
+        for zip_code in shipping_zips:
+            hll = self.shipping.get(zip_code)
+            if hll is None:
+                hll = self.shipping[zip_code] = HyperLogLog(self.precision)
+            hll.add(order_id)
+
+    def _trim(self):
+        '''
+            Moves the watermark up to CATCH_UP_RESCAN_IDS below the highest order recorded. The
+            ids missing below it are rolled back transactions (or committed too late) and are
+            given up on, which keeps seen small.
+        '''
+        if self.seen:
+            self.watermark = max(self.watermark, max(self.seen) - CATCH_UP_RESCAN_IDS)
+            self.seen = {order_id for order_id in self.seen if order_id > self.watermark}
+
+    def record_orders(self, orders, addresses):
+        '''
+            orders are the (order id, NewOrder, List[NewOrderItem]) of committed orders, addresses
+            maps the address ids they reference to rows carrying their zip_code.
+        '''
+        if not self.enabled:
+            return
+        with self._lock:
+            for order_id, order, items in orders:
+                self._record(order_id, order.customer_id if order.source == OrderSource.store else None,
+                             {addresses[item.dest_customer_address_id].zip_code for item in items
+                              if item.fulfillment_modality in HOME_DELIVERY_MODALITIES})
+            # Not while catching up, the orders it has yet to record may lie below the new watermark.
+            if len(self.seen) > 2 * CATCH_UP_RESCAN_IDS and not self._catching_up:
+                self._trim()
+
+    def _merge(self, orders):
+        with self._lock:
+            for order in orders:
+                self._record(*order)
+
+    def catch_up(self, db):
+        '''
+            Records the orders above the watermark that are not recorded yet, in one range
+            scan of the orders (joined to their home delivery addresses). The sketches are only
+            locked to merge every CATCH_UP_BATCH_SIZE orders read, order writes and answers go
+            on meanwhile. The watermark only follows the highest order read
+            CATCH_UP_RESCAN_IDS behind, see _trim.
+        '''
+        with self._catch_up_lock:
+            with self._lock:
+                watermark, recorded = self.watermark, self.recorded
+                self._catching_up = True
+            query = select(Orders.order_id, Orders.source, Orders.customer_id, CustomerAddresess.zip_code).outerjoin(
+                OrderItems, (OrderItems.order_id == Orders.order_id)
+                & OrderItems.fulfillment_modality.in_(HOME_DELIVERY_MODALITIES)).outerjoin(
+                CustomerAddresess, CustomerAddresess.customer_address_id == OrderItems.dest_customer_address_id).where(
+                Orders.order_id > watermark).order_by(Orders.order_id).execution_options(yield_per = CATCH_UP_BATCH_SIZE)
+
+            try:
+                orders, order = [], None
+                for order_id, source, customer_id, zip_code in db.execute(query):
+                    if order is None or order[0] != order_id:
+                        if order is not None:
+                            orders.append(order)
+                            if len(orders) >= CATCH_UP_BATCH_SIZE:
+                                self._merge(orders)
+                                orders = []
+                        order = (order_id, customer_id if source == OrderSource.store else None, set())
+                    if zip_code is not None:
+                        order[2].add(zip_code)
+                if order is not None:
+                    orders.append(order)
+                self._merge(orders)
+            finally:
+                with self._lock:
+                    self._catching_up = False
+                    self._trim()
+                    caught_up = self.recorded - recorded
+            if caught_up > 0:
+                logger.info(f"Caught up on {caught_up} orders.")
+
+    def instore_top(self, top_k: int) -> dict:
+        '''
+            {customer_id: {"count", "lower", "upper"}} of the top_k in store shoppers. count is
+            the tighter of the Space-Saving and Count-Min overestimates, which holds with
+            probability 1 - delta, and lower the Space-Saving count less its error.
+        '''
+        with self._lock:
+            counts = [(key, min(count, self.instore_counts.estimate(key)), count - error)
+                      for key, count, error in self.instore.top(self.instore.capacity)]
+        counts.sort(key = lambda count: (-count[1], count[0]))
+        return {key: {"count": upper, "lower": lower, "upper": upper} for key, upper, lower in counts[:top_k]}
+
+    def shipping_counts(self) -> dict:
+        '''
+            {zip_code: {"count", "lower", "upper"}} largest first, the bounds are two standard
+            errors (about 95% confidence).
+        '''
+        with self._lock:
+            estimates = {zip_code: (hll.estimate(), hll.exact) for zip_code, hll in self.shipping.items()}
+            error = 2 * 1.04 / math.sqrt(1 << self.precision)
+        results = {}
+        for zip_code, (estimate, exact) in sorted(estimates.items(), key = lambda item: (-item[1][0], item[0])):
+            if exact:
+                results[zip_code] = {"count": estimate, "lower": estimate, "upper": estimate}
+            else:
+                results[zip_code] = {"count": round(estimate), "lower": max(0, math.floor(estimate * (1 - error))),
+                                     "upper": math.ceil(estimate * (1 + error))}
+        return results
+
+    def persist(self):
+        if not self.path:
+            return
+        with self._lock:
+            data = pickle.dumps({"settings": (self.capacity, self.epsilon, self.delta, self.precision),
+                                 "instore": self.instore, "instore_counts": self.instore_counts,
+                                 "shipping": self.shipping, "watermark": self.watermark, "seen": self.seen,
+                                 "recorded": self.recorded})
+        temporary = f"{self.path}.tmp"
+        with open(temporary, "wb") as f:
+            f.write(data)
+        os.replace(temporary, self.path)
+
+    def _persist_logged(self):
+        try:
+            self.persist()
+        except OSError as e:
+            logger.error(f"Could not persist the sketches: {e}")
+
+    def load(self, db):
+        '''
+            Reads the persisted sketches back, if any were made with the same settings, then
+            catches up with the orders written since.
+        '''
+        if not self.enabled:
+            return
+        # Approximate answers asked meanwhile wait for the catch-up instead of reading from scratch.
+        with self._catch_up_lock:
+            self.clear()
+            if self.path and os.path.exists(self.path):
+                with open(self.path, "rb") as f:
+                    state = pickle.load(f)
+                if state["settings"] == (self.capacity, self.epsilon, self.delta, self.precision):
+                    with self._lock:
+                        self.instore, self.instore_counts = state["instore"], state["instore_counts"]
+                        self.shipping, self.watermark, self.seen = state["shipping"], state["watermark"], state["seen"]
+                        self.recorded = state["recorded"]
+                else:
+                    logger.warning(f"Ignoring {self.path}, it was made with other settings.")
+            self.catch_up(db)
+
+    def _run(self, session_factory):
+        try:
+            with session_factory() as db:
+                self.load(db)
+        except Exception as e:
+            logger.warning(f"Sketches not loaded at startup, they will be caught up on first use: {e}")
+        while not self._stop.wait(self.persist_seconds):
+            if self.path:
+                self._persist_logged()
+
+    def start(self, session_factory):
+        '''
+            Starts the worker thread loading the sketches with a session of session_factory,
+            then persisting them every persist_seconds, off the request threads.
+        '''
+        if not self.enabled or self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target = self._run, args = (session_factory,),
+                                        name = "sketches", daemon = True)
+        self._thread.start()
+
+    def stop(self):
+        '''
+            Stops the worker thread and persists the sketches a last time.
+        '''
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        self._persist_logged()
+
+
+sketches = Sketches()
@@ -0,0 +1,169 @@
+'''
+    Slow query log.
+
+    Every statement taking longer than the threshold (config.yaml slow_queries.threshold_ms) is
+    recorded with its SQL, the shape of its parameters (types, not values), its duration, the
+    route of the request that ran it and its plan. The plan is captured right away with EXPLAIN
+    on the same connection, so it is the plan of the data the statement actually saw.
+
+    Entries are kept in a bounded ring buffer served at /admin/slow_queries and appended to a
+    rotating JSON lines file.
+'''
+import datetime
+import json
+import logging
+import threading
+import time
+from collections import deque
+from logging.handlers import RotatingFileHandler
+
+from sqlalchemy import event
+
+from .metrics import current_stats
+
+logger = logging.getLogger(__name__)
+
+SETTINGS_DEFAULTS = {
+    "threshold_ms": 100,
+    "buffer_size": 200,
+    "explain": True,
+    "file": "slow_queries.jsonl",   # null to keep the entries in memory only
+    "max_bytes": 10485760,
+    "backup_count": 5,
+}
+
+EXPLAINABLE = ("SELECT", "WITH", "INSERT", "UPDATE", "DELETE")
+MAX_PARAMETERS = 20
+
+
+def parameter_shape(parameters):
+    '''
+        Type names of the parameters, long lists (expanded IN clauses) are truncated.
+    '''
+    if isinstance(parameters, dict):
+        names = list(parameters)
+        shape = {name: type(parameters[name]).__name__ for name in names[:MAX_PARAMETERS]}
+        if len(names) > MAX_PARAMETERS:
+            shape["..."] = f"{len(names) - MAX_PARAMETERS} more"
+        return shape
+    if isinstance(parameters, (list, tuple)):
+        shape = [type(value).__name__ for value in parameters[:MAX_PARAMETERS]]
+        if len(parameters) > MAX_PARAMETERS:
+            shape.append(f"... {len(parameters) - MAX_PARAMETERS} more")
+        return shape
+    return type(parameters).__name__
+
+
+def explain(dbapi_connection, dialect: str, statement: str, parameters):
+    '''
+        Plan lines of statement, run through a fresh cursor of the connection that executed it.
+    '''
+    if dialect == "sqlite":
+        prefix, column = "EXPLAIN QUERY PLAN ", -1
+    elif dialect == "postgresql":
+        prefix, column = "EXPLAIN ", 0
+    else:
+        return None
+
+    # A failed statement aborts the whole Postgres transaction, so the EXPLAIN runs in a savepoint
+    # and failing to plan a statement cannot fail the request that ran it.
+    savepoint = dialect == "postgresql" and not getattr(dbapi_connection, "autocommit", False)
+    cursor = dbapi_connection.cursor()
+    try:
+        if savepoint:
+            cursor.execute("SAVEPOINT slow_query_explain")
+        try:
+            cursor.execute(prefix + statement, parameters)
+            return [row[column] for row in cursor.fetchall()]
+        except Exception:
+            if savepoint:
+                cursor.execute("ROLLBACK TO SAVEPOINT slow_query_explain")
+            raise
+        finally:
+            if savepoint:
+                cursor.execute("RELEASE SAVEPOINT slow_query_explain")
+    finally:
+        cursor.close()
+
+
+class SlowQueryLog:
+
+    def __init__(self):
+        self.configure()
+
+    def configure(self, settings: dict = None):
+        self.settings = dict(SETTINGS_DEFAULTS, **(settings or {}))
+        self.threshold = self.settings["threshold_ms"] / 1000
+        self._entries = deque(maxlen = self.settings["buffer_size"])
+        self._lock = threading.Lock()
+
+        self._file_logger = None
+        if self.settings["file"]:
+            self._file_logger = logging.getLogger(f"{__name__}.file")
+            self._file_logger.propagate = False
+            self._file_logger.setLevel(logging.INFO)
+            for handler in list(self._file_logger.handlers):
+                self._file_logger.removeHandler(handler)
+                handler.close()
+            handler = RotatingFileHandler(self.settings["file"], maxBytes = self.settings["max_bytes"],
+                                          backupCount = self.settings["backup_count"], delay = True)
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            self._file_logger.addHandler(handler)
+
+    def install(self, engine):
+        '''
+            Times every statement of engine (for an AsyncEngine pass async_engine.sync_engine).
+        '''
+        @event.listens_for(engine, "before_cursor_execute")
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            if context is not None:
+                context.slow_query_start = time.perf_counter()
+
+        @event.listens_for(engine, "after_cursor_execute")
+        def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            start = getattr(context, "slow_query_start", None)
+            if start is None:
+                return
+            duration = time.perf_counter() - start
+            if duration >= self.threshold:
+                self.record(conn, statement, parameters, executemany, duration)
+
+    def record(self, conn, statement: str, parameters, executemany: bool, duration: float):
+        stats = current_stats()
+        entry = {
+            "time": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "method": stats.method if stats else None,
+            "route": stats.route if stats else None,
+            "duration_ms": round(duration * 1000, 3),
+            "statement": statement,
+            "parameters": parameter_shape(parameters[0] if executemany and parameters else parameters),
+            "executemany": len(parameters) if executemany else None,
+            "plan": None,
+        }
+
+        if self.settings["explain"] and statement.lstrip().upper().startswith(EXPLAINABLE):
+            try:
+                entry["plan"] = explain(conn.connection.dbapi_connection, conn.dialect.name, statement,
+                                        parameters[0] if executemany else parameters)
+            except Exception as e:
+                logger.warning(f"Could not explain slow statement: {e}")
+
+        with self._lock:
+            self._entries.append(entry)
+        if self._file_logger is not None:
+            self._file_logger.info(json.dumps(entry, default = str))
+
+    def entries(self, limit: int = None) -> list:
+        '''
+            Newest first.
+        '''
+        with self._lock:
+            entries = list(reversed(self._entries))
+        return entries[:limit] if limit else entries
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+slow_query_log = SlowQueryLog()
@@ -1,24 +1,40 @@
 import requests
 import json
+import logging
 import yaml
 import os
 import pytest
-from datetime import datetime
+from datetime import datetime, timedelta
 import numpy as np
 import math
 import pandas as pd
 import random
+import time
 import copy
+import threading
+import io
 from functools import wraps
 from fastapi import FastAPI
 from fastapi.testclient import TestClient
-from sqlalchemy import create_engine, event
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.dialects import postgresql
 from sqlalchemy.orm import sessionmaker
 from sqlmodel.pool import StaticPool
 from sqlmodel import Session, SQLModel, create_engine
 
-from pier2.database import get_db
-from pier2.models import Base, FulfillmentModality, OrderSource
+from pier2.database import get_db, get_read_db, get_sync_db
+from pier2.models import Base, FulfillmentModality, OrderSource, Orders, Stores
+from pier2 import database, rollups, index_advisor, seed, fast_json, importer
+from pier2.schemas import validate_email, validate_phone_number, validate_zip, validate_state
+from pier2.routers.queries import encode_cursor
+from pier2.routers import exports
+from pier2.metrics import instrument_engine, registry
+from pier2.id_registry import IdBitmap, id_registry
+from pier2.sketches import sketches, SpaceSaving, HyperLogLog
+from pier2.materializer import materializer
+from pier2.slow_queries import slow_query_log, explain
+from pier2.database import config
+from pier2.cache import entity_cache, query_cache, idempotency_cache, customer_lookup_cache, data_version, LRUCache, MISSING
 from pier2.main import app
 
 IN_MEMORY_DB = "sqlite:///:memory:"
@@ -211,22 +227,22 @@ def add_all(client, customers = None, customer_addresses = None, orders = None,
 
     if orders is not None:
         for index, row in orders.iterrows():
-            order_id = row.order_id
-            order_data = row.to_dict()
-            items = []
-            for index, r in order_items.query(f'order_id == {order_id}').iterrows():
-
-                item_data = r.to_dict()
-                # Fix for pandas converting int's to nan's due to nulls allowed in the following
-                for k in ['source_warehouse_id', 'source_store_id', 'dest_store_id', 'dest_customer_address_id']:
-                    if item_data[k] is not None:
-                        if math.isnan(item_data[k]):
-                            item_data.pop(k)
-                        else:
-                            item_data[k] = int(item_data[k])
-                items.append(item_data)
-
-            add_order(client, order_data, items)
+            add_order(client, row.to_dict(), order_items_payload(order_items, row.order_id))
+
+def order_items_payload(order_items, order_id):
+    items = []
+    for index, r in order_items.query(f'order_id == {order_id}').iterrows():
+
+        item_data = r.to_dict()
+        # Fix for pandas converting int's to nan's due to nulls allowed in the following
+        for k in ['source_warehouse_id', 'source_store_id', 'dest_store_id', 'dest_customer_address_id']:
+            if item_data[k] is not None:
+                if math.isnan(item_data[k]):
+                    item_data.pop(k)
+                else:
+                    item_data[k] = int(item_data[k])
+        items.append(item_data)
+    return items
 
 @pytest.fixture(name="session")
 def session_fixture():
@@ -244,6 +260,9 @@ def session_fixture():
             cursor.execute("PRAGMA foreign_keys = ON")
             cursor.close()
 
+    # Same cursor hooks as the service's engine, so the /metrics numbers cover the tests' requests.
+    instrument_engine(engine)
+    slow_query_log.install(engine)
     Base.metadata.create_all(engine)
     print(f"*** Created tables {Base.metadata.tables.keys()}")
     with Session(engine) as session:
@@ -255,6 +274,18 @@ def client_fixture(session: Session):
         return session
 
     app.dependency_overrides[get_db] = get_session_override
+    app.dependency_overrides[get_sync_db] = get_session_override
+    app.dependency_overrides[get_read_db] = get_session_override
+    # Every test starts from an empty database, cached entities from other tests are stale.
+    entity_cache.clear()
+    query_cache.clear()
+    registry.clear()
+    id_registry.clear()
+    idempotency_cache.clear()
+    customer_lookup_cache.clear()
+    materializer.clear()
+    # In memory only, persisting is covered by test_approximate_aggregates.
+    sketches.configure(dict(config.get("sketches") or {}, path = None))
     client = TestClient(app)
     yield client
     app.dependency_overrides.clear()
@@ -433,6 +464,22 @@ def test_add_order(client: TestClient):
     result = json.loads(resp.text)
     print(f"** Recieved from server after post: {resp.status_code}")
 
+    # The response is built without re-reading the rows, it must match what was stored.
+    resp = client.get(f'/orders/{result["order_id"]}')
+    assert resp.status_code == 200, resp.content
+    assert json.loads(resp.text) == result
+
+    # The same item twice with the same source and destination, the response keeps the items in order.
+    repeated = [items[0], dict(items[0], quantity = 5), items[0]]
+    resp = client.post(f'/orders', json = {'items' : repeated, 'order': order_data})
+    assert resp.status_code == 200, resp.content
+    result = json.loads(resp.text)
+    assert [item['quantity'] for item in result['items']] == [3, 5, 3]
+    assert json.loads(client.get(f'/orders/{result["order_id"]}').text) == result
+    resp = client.post('/orders/bulk', json = [{'items' : repeated, 'order': order_data}])
+    assert resp.status_code == 200, resp.content
+    assert json.loads(resp.text)['rejected'] == []
+
     # Test make billing a non-billing address
     address_data['is_billing'] = False
     address_data['is_shipping'] = True
@@ -473,6 +520,294 @@ def test_add_order(client: TestClient):
     print(f"** Recieved from server after post: {resp.status_code}")
 
 
+def test_entity_cache(client: TestClient, session: Session):
+    item_id = add_item(client)
+    customer_id = add_customer(client, {"email": "pink@floyd.com", "first_name": "Pink", "last_name": "Floyd"})
+
+    assert client.get(f'/items/{item_id}').status_code == 200
+    assert client.get(f'/customers/{customer_id}').status_code == 200
+    stats = json.loads(client.get('/admin/cache').text)
+    assert (stats['hits'], stats['misses']) == (0, 2)
+
+    # Served from the cache, even with the row gone from the database.
+    session.execute(text("DELETE FROM items"))
+    session.commit()
+    resp = client.get(f'/items/{item_id}')
+    assert resp.status_code == 200 and json.loads(resp.text) == {'item_id': item_id}
+    assert json.loads(client.get('/admin/cache').text)['hits'] == 1
+
+    # Creating the row again invalidates the entry.
+    assert add_item(client) == item_id
+    assert client.get(f'/items/{item_id}').status_code == 200
+    assert json.loads(client.get('/admin/cache').text)['misses'] == 3
+
+    # Not found is not cached.
+    assert client.get('/customers/123456789').status_code == 404
+    assert client.get('/customers/123456789').status_code == 404
+    assert json.loads(client.get('/admin/cache').text)['misses'] == 5
+
+def test_query_cache_etag(client: TestClient, session: Session):
+    customers = get_customers_df(3)
+    customer_addresses = get_customer_addresses_df(list(customers.customer_id))
+    item_ids = [add_item(client) for i in range(1, 21)]
+    store_ids = [add_store(client) for i in range(1, 4)]
+    warehouse_ids = [add_warehouse(client) for i in range(1, 4)]
+    orders, order_items = get_orders_df(customers, customer_addresses, item_ids, store_ids, warehouse_ids)
+    add_all(client, customers, customer_addresses)
+    rest, last = orders.iloc[:-1], orders.iloc[-1:]
+    add_all(client, orders = rest, order_items = order_items[order_items.order_id.isin(rest.order_id)])
+
+    resp = client.get('/query/count_billing_orders')
+    assert resp.status_code == 200, resp.content
+    etag, counts = resp.headers['etag'], json.loads(resp.text)
+    assert sum(counts.values()) == len(rest)
+
+    resp = client.get('/query/count_billing_orders', headers = {'If-None-Match': etag})
+    assert resp.status_code == 304 and resp.headers['etag'] == etag
+    assert client.get('/query/instore_shoppers', params = {'top_k': 1}).headers['etag'] != \
+        client.get('/query/instore_shoppers', params = {'top_k': 2}).headers['etag']
+
+    # Served from the cache while the data is unchanged, even with the rollup gone.
+    session.execute(text("DELETE FROM billing_zip_order_counts"))
+    session.commit()
+    assert json.loads(client.get('/query/count_billing_orders').text) == counts
+    rollups.rebuild(session)
+    session.commit()
+
+    # A new order changes the ETag and the result.
+    add_all(client, orders = last, order_items = order_items[order_items.order_id.isin(last.order_id)])
+    resp = client.get('/query/count_billing_orders', headers = {'If-None-Match': etag})
+    assert resp.status_code == 200 and resp.headers['etag'] != etag
+    assert sum(json.loads(resp.text).values()) == len(orders)
+
+def test_metrics(client: TestClient):
+    customer_id = add_customer(client, {"email": "pink@floyd.com", "first_name": "Pink", "last_name": "Floyd"})
+
+    resp = client.get(f'/customers/{customer_id}')
+    assert resp.status_code == 200
+    timing = resp.headers['server-timing']
+    assert timing.startswith('db;dur=') and 'serialize;dur=' in timing and 'app;dur=' in timing
+    assert 'desc="1 statements, 1 rows"' in timing
+
+    # Cached, no statement at all.
+    assert 'desc="0 statements, 0 rows"' in client.get(f'/customers/{customer_id}').headers['server-timing']
+
+    resp = client.get('/metrics')
+    assert resp.status_code == 200
+    assert 'pier2_requests_total{method="GET",route="/customers/{customer_id}",status="200"} 2' in resp.text
+    assert 'pier2_db_statements_bucket{method="GET",route="/customers/{customer_id}",le="1"} 2' in resp.text
+    assert 'pier2_db_rows_count{method="POST",route="/customers/",status' not in resp.text
+    assert 'pier2_db_rows_count{method="POST",route="/customers/"} 1' in resp.text
+
+def test_slow_query_log(client: TestClient, tmp_path):
+    add_customer(client, {"email": "pink@floyd.com", "first_name": "Pink", "last_name": "Floyd"})
+    slow_query_log.configure({"threshold_ms": 0, "buffer_size": 3, "file": str(tmp_path / "slow.jsonl")})
+    try:
+        assert client.get('/query/count_billing_orders', params = {'start': '2025-01-01'}).status_code == 200
+        entries = json.loads(client.get('/admin/slow_queries').text)
+        assert len(entries) == 1
+        entry = entries[0]
+        assert entry['route'] == '/query/count_billing_orders' and entry['method'] == 'GET'
+        assert 'FROM customer_addresses JOIN orders' in entry['statement']
+        assert entry['parameters'] == ['str'] and entry['duration_ms'] >= 0
+        assert any('ix_orders_time' in line for line in entry['plan'])
+
+        # Bounded, newest first.
+        for i in range(3):
+            client.get(f'/customers/{i + 10}')
+        entries = json.loads(client.get('/admin/slow_queries').text)
+        assert len(entries) == 3 and all(e['route'] == '/customers/{customer_id}' for e in entries)
+        assert len(json.loads(client.get('/admin/slow_queries', params = {'limit': 1}).text)) == 1
+
+        lines = (tmp_path / "slow.jsonl").read_text().splitlines()
+        assert len(lines) == 4 and json.loads(lines[0])['route'] == '/query/count_billing_orders'
+    finally:
+        slow_query_log.configure(config.get("slow_queries"))
+
+    # On Postgres a failed EXPLAIN is rolled back to a savepoint, leaving the transaction usable.
+    class Cursor:
+        def execute(self, statement, parameters = None):
+            executed.append(statement)
+            if statement.startswith("EXPLAIN"):
+                raise ValueError("could not plan")
+        def close(self):
+            pass
+    class Connection:
+        def cursor(self):
+            return Cursor()
+    executed = []
+    with pytest.raises(ValueError):
+        explain(Connection(), "postgresql", "SELECT 1", {})
+    assert executed == ["SAVEPOINT slow_query_explain", "EXPLAIN SELECT 1",
+                        "ROLLBACK TO SAVEPOINT slow_query_explain", "RELEASE SAVEPOINT slow_query_explain"]
+
+def test_lru_cache_eviction_and_ttl():
+    cache = LRUCache(maxsize = 2, ttl_seconds = 60)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert cache.get('b') is MISSING
+    assert cache.get('a') == 1 and cache.get('c') == 3
+    assert cache.stats()['evictions'] == 1
+
+    cache.ttl_seconds = -1
+    cache.set('d', 4)
+    assert cache.get('d') is MISSING
+    assert cache.stats()['expirations'] == 1
+
+def test_id_registry(client: TestClient, session: Session):
+    ids = IdBitmap()
+    ids.update([1, 2, 3, 1000])
+    ids.add(3)
+    assert len(ids) == 4 and 1000 in ids and 999 not in ids and -1 not in ids and 10 ** 9 not in ids
+
+    store_id = add_store(client)
+    item_id = add_item(client)
+    customer_id = add_customer(client, {'email': 'pink@floyd.com', 'first_name': 'Pink', 'last_name': 'Floyd'})
+    address_id = add_customer_address(client, {'customer_id': customer_id, 'address_line_1': '34 Haight',
+                                               'city': 'San Francisco', 'state': 'CA', 'zip_code': '94131',
+                                               'is_billing': True, 'is_shipping': True})
+    order = {'customer_id': customer_id, 'time_of_order': '2025-02-09 14:14:37',
+             'source': OrderSource.online.value, 'billing_address_id': address_id}
+    item = {'item_id': item_id, 'fulfillment_modality': FulfillmentModality.store_inventory.value,
+            'quantity': 1, 'price_per_item': 1.0, 'source_store_id': store_id}
+
+    resp = client.post('/orders', json = {'order': order, 'items': [dict(item, item_id = item_id + 1)]})
+    assert resp.status_code == 422, resp.content
+    assert json.loads(resp.text)['detail'] == f'Unknown item_id {item_id + 1}'
+    resp = client.post('/orders', json = {'order': order, 'items': [dict(item, source_store_id = store_id + 1)]})
+    assert resp.status_code == 422, resp.content
+    assert json.loads(resp.text)['detail'] == f'Unknown source_store_id {store_id + 1}'
+
+    # Rows created after loading: through the API they are added once committed, others are
+    # found in the database.
+    resp = client.post('/orders', json = {'order': order, 'items': [dict(item, item_id = add_item(client))]})
+    assert resp.status_code == 200, resp.content
+    session.add(Stores())
+    session.commit()
+    resp = client.post('/orders', json = {'order': order, 'items': [dict(item, source_store_id = store_id + 1)]})
+    assert resp.status_code == 200, resp.content
+    assert store_id + 1 in id_registry._ids(session, 'stores')
+
+def test_batch_assets(client: TestClient, session: Session):
+    store_id = add_store(client)
+    id_registry.load(session)
+    resp = client.post('/stores/batch', params = {'count': 1000})
+    assert resp.status_code == 200, resp.content
+    assert json.loads(resp.text) == {'first_id': store_id + 1, 'last_id': store_id + 1000, 'count': 1000}
+    assert session.execute(text('SELECT count(*), max(store_id) FROM stores')).one() == (1001, store_id + 1000)
+    assert add_store(client) == store_id + 1001
+
+    for path in ['/items/batch', '/warehouses/batch']:
+        resp = client.post(path, params = {'count': 3})
+        assert resp.status_code == 200, resp.content
+        assert json.loads(resp.text) == {'first_id': 1, 'last_id': 3, 'count': 3}
+    assert client.post('/items/batch', params = {'count': 0}).status_code == 422
+
+    # The new ids are known to the order checks.
+    assert id_registry.missing(session, 'stores', range(1, store_id + 1002)) == set()
+    assert id_registry.missing(session, 'stores', [store_id + 1002]) == {store_id + 1002}
+
+def test_idempotent_add_order(client: TestClient, session: Session):
+    store_id = add_store(client)
+    item_id = add_item(client)
+    customer_id = add_customer(client, {'email': 'pink@floyd.com', 'first_name': 'Pink', 'last_name': 'Floyd'})
+    address_id = add_customer_address(client, {'customer_id': customer_id, 'address_line_1': '34 Haight',
+                                               'city': 'San Francisco', 'state': 'CA', 'zip_code': '94131',
+                                               'is_billing': True, 'is_shipping': True})
+    payload = {'order': {'customer_id': customer_id, 'time_of_order': '2025-02-09 14:14:37',
+                         'source': OrderSource.online.value, 'billing_address_id': address_id},
+               'items': [{'item_id': item_id, 'fulfillment_modality': FulfillmentModality.store_inventory.value,
+                          'quantity': 1, 'price_per_item': 1.0, 'source_store_id': store_id}]}
+    headers = {'Idempotency-Key': 'pos-7-0001'}
+
+    resp = client.post('/orders', json = payload, headers = headers)
+    assert resp.status_code == 200, resp.content
+    created = json.loads(resp.text)
+
+    # Retries get the same order, from the recent keys and then from the table.
+    for clear in [False, True]:
+        if clear:
+            idempotency_cache.clear()
+        resp = client.post('/orders', json = payload, headers = headers)
+        assert resp.status_code == 200, resp.content
+        assert json.loads(resp.text) == created
+        if not clear:
+            assert 'desc="0 statements, 0 rows"' in resp.headers['server-timing']
+    assert session.execute(text('SELECT count(*) FROM orders')).scalar() == 1
+
+    resp = client.post('/orders', json = dict(payload, items = []), headers = headers)
+    assert resp.status_code == 422, resp.content
+    assert json.loads(resp.text)['detail'] == 'The Idempotency-Key was already used for a different order.'
+
+    resp = client.post('/orders', json = payload, headers = {'Idempotency-Key': 'pos-7-0002'})
+    assert resp.status_code == 200, resp.content
+    assert json.loads(resp.text)['order_id'] == created['order_id'] + 1
+
+def test_add_orders_bulk(client: TestClient, session: Session):
+    customers = get_customers_df(3)
+    customer_addresses = get_customer_addresses_df(list(customers.customer_id))
+    item_ids = [add_item(client) for i in range(1, 21)]
+    store_ids = [add_store(client) for i in range(1, 4)]
+    warehouse_ids = [add_warehouse(client) for i in range(1, 4)]
+    orders, order_items = get_orders_df(customers, customer_addresses, item_ids, store_ids, warehouse_ids)
+    add_all(client, customers, customer_addresses)
+
+    payload = [{'order': row.to_dict(), 'items': order_items_payload(order_items, row.order_id)}
+               for index, row in orders.iterrows()]
+
+    # One order with an unknown billing address and one shipping to a non-shipping address.
+    address_data = {
+        'customer_id': int(customers.customer_id[0]),
+        'address_line_1': '34 Haight',
+        'city': 'San Francisco',
+        'state': 'CA',
+        'zip_code': "94131",
+        'is_billing': True,
+        'is_shipping': False
+    }
+    billing_only_id = add_customer_address(client, address_data)
+    bad_billing = copy.deepcopy(payload[0])
+    bad_billing['order']['billing_address_id'] = 123456789
+    bad_shipping = copy.deepcopy(payload[0])
+    bad_shipping['items'] = [{'item_id': item_ids[0],
+                              'fulfillment_modality': FulfillmentModality.ware_to_home.value,
+                              'quantity': 1,
+                              'price_per_item': 1.0,
+                              'source_warehouse_id': warehouse_ids[0],
+                              'dest_customer_address_id': billing_only_id}]
+    bad_modality = copy.deepcopy(bad_shipping)
+    bad_modality['items'][0]['source_store_id'] = store_ids[0]
+    # Rejected rather than failing the whole request on the foreign key.
+    bad_customer = copy.deepcopy(payload[0])
+    bad_customer['order']['customer_id'] = 987654321
+    payload = [bad_billing, bad_customer] + payload + [bad_shipping, bad_modality]
+
+    resp = client.post('/orders/bulk', json = payload)
+    assert resp.status_code == 200, resp.content
+    result = json.loads(resp.text)
+
+    assert [r['index'] for r in result['rejected']] == [0, 1, len(payload) - 2, len(payload) - 1]
+    assert result['rejected'][1]['detail'] == "Unknown customer_id 987654321"
+    assert result['order_ids'][:2] == [None, None] and result['order_ids'][-2:] == [None, None]
+    assert result['order_ids'][2:-2] == list(orders.order_id)
+
+    # The batch modality check reports what NewOrderItem raises for a single order.
+    resp = client.post('/orders/', json = bad_modality)
+    assert resp.status_code == 422, resp.content
+    assert json.loads(resp.text)['detail'][0]['msg'] == f"Value error, {result['rejected'][-1]['detail']}"
+    assert result['rejected'][-1]['detail'] == (f"Cannot supply source_store_id {store_ids[0]} or dest_store_id None "
+                                                f"when {FulfillmentModality.ware_to_home}.")
+
+    resp = client.get(f'/orders/{result["order_ids"][2]}')
+    assert resp.status_code == 200, resp.content
+    assert len(json.loads(resp.text)['items']) == len(order_items.query('order_id == 1'))
+
+    all_items = pd.read_sql("SELECT * FROM order_items", session.bind)
+    assert len(all_items) == len(order_items)
+    assert rollups.verify(session) == {}
+
 def test_order_history_query(client: TestClient):
     customers = get_customers_df(2)
     customer_addresses = get_customer_addresses_df(list(customers.customer_id))
@@ -495,6 +830,170 @@ def test_order_history_query(client: TestClient):
         response_orders = set(pd.DataFrame(result)['order_id'])
         assert pandas_orders == response_orders, f"Pandas result: {pandas_orders}, response result: {response_orders}"
 
+def test_order_history_pages_and_stream(client: TestClient):
+    customers = get_customers_df(2)
+    customer_addresses = get_customer_addresses_df(list(customers.customer_id))
+    item_ids = [add_item(client) for i in range(1, 21)]
+    store_ids = [add_store(client) for i in range(1, 4)]
+    warehouse_ids = [add_warehouse(client) for i in range(1, 4)]
+    orders, order_items = get_orders_df(customers, customer_addresses, item_ids, store_ids, warehouse_ids,
+                                        min_orders = 5)
+    add_all(client, customers, customer_addresses, orders, order_items)
+
+    email = customers.email[0]
+    resp = client.get(f'/query/order_history', params = {'email': email})
+    assert resp.status_code == 200, resp.content
+    full = json.loads(resp.text)
+    assert [o['order_id'] for o in full] == [o['order_id'] for o in sorted(
+        full, key = lambda o: (o['time_of_order'], o['order_id']))]
+
+    pages = []
+    params = {'email': email, 'limit': 2}
+    while True:
+        resp = client.get(f'/query/order_history', params = params)
+        assert resp.status_code == 200, resp.content
+        pages.extend(json.loads(resp.text))
+        if 'X-Next-Cursor' not in resp.headers:
+            break
+        params['after'] = resp.headers['X-Next-Cursor']
+    assert pages == full
+
+    resp = client.get(f'/query/order_history', params = {'email': email, 'stream': True})
+    assert resp.status_code == 200, resp.content
+    assert resp.headers['content-type'] == 'application/x-ndjson'
+    assert [json.loads(line) for line in resp.text.splitlines()] == full
+
+    resp = client.get(f'/query/order_history', params = {'email': email, 'after': 'not-a-cursor'})
+    assert resp.status_code == 422, resp.content
+
+def test_order_history_round_trips(client: TestClient):
+    customers = get_customers_df(2)
+    customer_addresses = get_customer_addresses_df(list(customers.customer_id))
+    item_ids = [add_item(client) for i in range(1, 6)]
+    store_ids = [add_store(client) for i in range(1, 3)]
+    warehouse_ids = [add_warehouse(client) for i in range(1, 3)]
+    orders, order_items = get_orders_df(customers, customer_addresses, item_ids, store_ids, warehouse_ids,
+                                        min_orders = 3)
+    add_all(client, customers, customer_addresses, orders, order_items)
+
+    def statements(params):
+        resp = client.get('/query/order_history', params = params)
+        assert resp.status_code == 200, resp.content
+        return int(resp.headers['server-timing'].split('desc="')[1].split(' ')[0]), json.loads(resp.text)
+
+    email = customers.email[0]
+    first = statements({'email': email})
+    assert first[0] == 1 and len(first[1]) == len(orders.query(f'customer_id == {customers.customer_id[0]}'))
+    assert statements({'email': email}) == first
+    assert statements({'email': email, 'fast': True}) == first
+    assert statements({'email': email, 'limit': 2}) == (1, first[1][:2])
+
+    # A customer without orders takes a second statement until its id is cached.
+    customer_id = add_customer(client, {'email': 'pink@floyd.com', 'first_name': 'Pink', 'last_name': 'Floyd',
+                                        'phone': '111-222-4444'})
+    assert statements({'email': 'pink@floyd.com'}) == (2, [])
+    assert statements({'email': 'pink@floyd.com', 'fast': True}) == (1, [])
+    assert statements({'phone': '111-222-4444', 'fast': True}) == (2, [])
+    assert client.get('/query/order_history', params = {'email': 'nobody@floyd.com'}).status_code == 404
+    assert customer_lookup_cache.get(('email', 'pink@floyd.com')) == customer_id
+
+def test_fast_order_history(client: TestClient, monkeypatch):
+    customers = get_customers_df(2)
+    customer_addresses = get_customer_addresses_df(list(customers.customer_id))
+    item_ids = [add_item(client) for i in range(1, 21)]
+    store_ids = [add_store(client) for i in range(1, 4)]
+    warehouse_ids = [add_warehouse(client) for i in range(1, 4)]
+    orders, order_items = get_orders_df(customers, customer_addresses, item_ids, store_ids, warehouse_ids,
+                                        min_orders = 5)
+    add_all(client, customers, customer_addresses, orders, order_items)
+
+    for email in customers.email:
+        for params in [{'email': email}, {'email': email, 'limit': 2},
+                       {'email': email, 'limit': 2, 'after': encode_cursor(datetime(2000, 1, 1), 0)}]:
+            expected = client.get('/query/order_history', params = params)
+            fast = client.get('/query/order_history', params = dict(params, fast = True))
+            assert fast.status_code == expected.status_code == 200, fast.content
+            assert fast.content == expected.content
+            assert fast.headers['content-type'] == expected.headers['content-type']
+            assert fast.headers.get('X-Next-Cursor') == expected.headers.get('X-Next-Cursor')
+
+            monkeypatch.setattr(fast_json, 'orjson', None)
+            assert client.get('/query/order_history', params = dict(params, fast = True)).content == expected.content
+            monkeypatch.undo()
+
+    assert client.get('/query/order_history', params = {'email': 'no@one.com', 'fast': True}).status_code == 404
+
+def add_export_data(client: TestClient):
+    customers = get_customers_df(3)
+    customer_addresses = get_customer_addresses_df(list(customers.customer_id))
+    item_ids = [add_item(client) for i in range(1, 21)]
+    store_ids = [add_store(client) for i in range(1, 4)]
+    warehouse_ids = [add_warehouse(client) for i in range(1, 4)]
+    orders, order_items = get_orders_df(customers, customer_addresses, item_ids, store_ids, warehouse_ids,
+                                        min_orders = 5)
+    add_all(client, customers, customer_addresses, orders, order_items)
+    return customer_addresses, orders
+
+def exported_order_items(session: Session):
+    expected = pd.read_sql(text('SELECT * FROM order_items ORDER BY order_item_id'), session.connection())
+    expected['fulfillment_modality'] = expected['fulfillment_modality'].astype(object)
+    return expected
+
+def test_exports(client: TestClient, session: Session, monkeypatch):
+    customer_addresses, orders = add_export_data(client)
+    monkeypatch.setattr(exports, 'EXPORT_CHUNK_SIZE', 4)
+
+    expected = exported_order_items(session)
+    resp = client.get('/export/order_items', params = {'format': 'csv'})
+    assert resp.status_code == 200, resp.content
+    assert resp.headers['content-type'].startswith('text/csv')
+    assert resp.headers['content-disposition'] == 'attachment; filename="order_items.csv"'
+    csv_frame = pd.read_csv(io.BytesIO(resp.content))
+    pd.testing.assert_frame_equal(csv_frame, expected, check_dtype = False)
+
+    resp = client.get('/export/customer_addresses')
+    assert len(pd.read_csv(io.BytesIO(resp.content), dtype = {'zip_code': str})) == len(customer_addresses)
+
+    query = json.loads(client.get('/query/count_billing_orders').text)
+    resp = client.get('/export/query/count_billing_orders', params = {'format': 'csv'})
+    exported = pd.read_csv(io.BytesIO(resp.content), dtype = {'zip_code': str})
+    assert dict(zip(exported.zip_code, exported.order_count)) == query
+
+    assert client.get('/export/customers').status_code == 422
+    assert client.get('/export/orders', params = {'format': 'xml'}).status_code == 422
+
+def test_arrow_exports(client: TestClient, session: Session, monkeypatch):
+    pyarrow = pytest.importorskip('pyarrow')
+    import pyarrow.parquet
+    customer_addresses, orders = add_export_data(client)
+    monkeypatch.setattr(exports, 'EXPORT_CHUNK_SIZE', 4)
+
+    expected = exported_order_items(session)
+    resp = client.get('/export/order_items', params = {'format': 'arrow'})
+    assert resp.status_code == 200, resp.content
+    reader = pyarrow.ipc.open_stream(resp.content)
+    batches = list(reader)
+    assert len(batches) == math.ceil(len(expected) / 4)
+    pd.testing.assert_frame_equal(pyarrow.Table.from_batches(batches).to_pandas(), expected, check_dtype = False)
+
+    resp = client.get('/export/orders', params = {'format': 'parquet'})
+    assert resp.status_code == 200, resp.content
+    parquet_file = pyarrow.parquet.ParquetFile(io.BytesIO(resp.content))
+    assert parquet_file.metadata.num_rows == len(orders)
+    assert parquet_file.num_row_groups == math.ceil(len(orders) / 4)
+    exported = parquet_file.read().to_pandas()
+    assert list(exported.order_id) == sorted(exported.order_id)
+    assert set(exported.source) <= {'store', 'online'}
+    assert str(exported.time_of_order.dtype).startswith('datetime64')
+
+    window = {'start': '2000-01-01', 'bucket': 'month'}
+    query = json.loads(client.get('/query/instore_shoppers', params = dict(window, top_k = 1000)).text)
+    resp = client.get('/export/query/instore_shoppers', params = dict(window, format = 'arrow'))
+    exported = pyarrow.ipc.open_stream(resp.content).read_all().to_pylist()
+    assert list(exported[0]) == ['bucket', 'customer_id', 'order_count']
+    assert {b: {str(c): n for b2, c, n in [tuple(r.values()) for r in exported] if b2.isoformat() == b}
+            for b in query} == query
+
 def test_group_by_billing_zip(client: TestClient, session: Session):
     customers = get_customers_df(3)
     customer_addresses = get_customer_addresses_df(list(customers.customer_id))
@@ -566,7 +1065,482 @@ def test_instore_shoppers(client: TestClient, session: Session):
 
     # check against pandas result
     orders = pd.read_sql( "SELECT * FROM orders", session.bind)
+    # Ties are broken by customer_id, as the endpoint does.
     pandas_result = orders[orders['source'] == 'store'].groupby('customer_id').size().reset_index(
-        name = "count").sort_values("count", ascending=False).head(5)
+        name = "count").sort_values(["count", "customer_id"], ascending=[False, True]).head(5)
 
     assert {str(row['customer_id']): int(row['count']) for _, row in pandas_result.iterrows()} == result
+
+def test_sketches():
+    counts = {key: 1000 // key for key in range(1, 200)}
+    stream = [key for key, count in counts.items() for _ in range(count)]
+    random.Random(7).shuffle(stream)
+    top = SpaceSaving(20)
+    for key in stream:
+        top.add(key)
+    result = top.top(5)
+    assert [key for key, _, _ in result] == [1, 2, 3, 4, 5]
+    assert all(count - error <= counts[key] <= count for key, count, error in result)
+
+    for n in [10, 1000, 100000]:
+        hll = HyperLogLog(10)
+        for value in range(n):
+            hll.add(value)
+        assert abs(hll.estimate() - n) <= 3 * 1.04 / 32 * n + 1
+        assert hll.exact == (n <= 64)
+
+def test_approximate_aggregates(client: TestClient, session: Session, tmp_path):
+    customers = get_customers_df(10)
+    customer_addresses = get_customer_addresses_df(list(customers.customer_id))
+    item_ids = [add_item(client) for i in range(1, 21)]
+    store_ids = [add_store(client) for i in range(1, 4)]
+    warehouse_ids = [add_warehouse(client) for i in range(1, 4)]
+    orders, order_items = get_orders_df(customers, customer_addresses, item_ids, store_ids, warehouse_ids)
+    add_all(client, customers, customer_addresses, orders, order_items)
+    # Orders written behind the API's back are caught up with.
+    seeded = get_customers_df(3)
+    seeded['email'] = 'seeded.' + seeded.email
+    seeded_addresses = get_customer_addresses_df(list(seeded.customer_id))
+    seed.seed(session, seeded, seeded_addresses, *get_orders_df(seeded, seeded_addresses, item_ids, store_ids, warehouse_ids))
+
+    def within_bounds(approx, exact):
+        assert set(approx) <= set(exact)
+        for key, estimate in approx.items():
+            assert estimate['lower'] <= exact[key] <= estimate['upper'], (key, estimate, exact[key])
+
+    exact_shipping = json.loads(client.get('/query/count_by_shipping_zip').text)
+    resp = client.get('/query/count_by_shipping_zip', params = {'approx': True})
+    assert resp.status_code == 200, resp.content
+    shipping = json.loads(resp.text)
+    assert set(shipping) == set(exact_shipping)
+    within_bounds(shipping, exact_shipping)
+
+    exact_instore = json.loads(client.get('/query/instore_shoppers', params = {'top_k': 100}).text)
+    resp = client.get('/query/instore_shoppers', params = {'approx': True, 'top_k': 3})
+    assert resp.status_code == 200, resp.content
+    instore = json.loads(resp.text)
+    assert len(instore) == 3
+    within_bounds(instore, exact_instore)
+    assert sorted(exact_instore.values(), reverse = True)[:3] == [v['count'] for v in instore.values()]
+
+    assert client.get('/query/instore_shoppers', params = {'approx': True, 'bucket': 'day'}).status_code == 422
+    assert client.get('/query/instore_shoppers', params = {'approx': True, 'top_k': 5000}).status_code == 422
+
+    # Persisted sketches are read back and caught up with the orders added since.
+    sketches.path = str(tmp_path / 'sketches.pickle')
+    sketches.persist()
+    more = get_customers_df(2)
+    more['email'] = 'more.' + more.email
+    more_addresses = get_customer_addresses_df(list(more.customer_id))
+    seed.seed(session, more, more_addresses, *get_orders_df(more, more_addresses, item_ids, store_ids, warehouse_ids))
+    sketches.load(session)
+    query_cache.clear()
+    exact_shipping = json.loads(client.get('/query/count_by_shipping_zip').text)
+    within_bounds(json.loads(client.get('/query/count_by_shipping_zip', params = {'approx': True}).text), exact_shipping)
+    assert sketches.recorded == session.execute(text('SELECT count(*) FROM orders')).scalar()
+
+    # An order committing after orders with higher ids (allocated later) is still caught up with.
+    orders_table, items_table = Base.metadata.tables['orders'], Base.metadata.tables['order_items']
+    late = session.execute(text('SELECT max(order_id) FROM orders')).scalar() - 5
+    late_order = dict(session.execute(orders_table.select().where(orders_table.c.order_id == late)).one()._mapping)
+    late_items = [dict(row._mapping) for row in session.execute(items_table.select().where(items_table.c.order_id == late))]
+    session.execute(items_table.delete().where(items_table.c.order_id == late))
+    session.execute(orders_table.delete().where(orders_table.c.order_id == late))
+    session.commit()
+    sketches.clear()
+    sketches.catch_up(session)
+    session.execute(orders_table.insert(), [late_order])
+    if late_items:
+        session.execute(items_table.insert(), late_items)
+    session.commit()
+    sketches.catch_up(session)
+    count = session.execute(text('SELECT count(*) FROM orders')).scalar()
+    assert sketches.recorded == count
+
+    # The orders are read without holding the sketches, order writes can record theirs meanwhile.
+    acquired = []
+    def probe():
+        if sketches._lock.acquire(timeout = 1):
+            acquired.append(True)
+            sketches._lock.release()
+    class ProbingSession:
+        def execute(self, statement):
+            for i, row in enumerate(session.execute(statement)):
+                if i == 0:
+                    thread = threading.Thread(target = probe)
+                    thread.start()
+                    thread.join()
+                yield row
+    sketches.clear()
+    sketches.catch_up(ProbingSession())
+    assert acquired and sketches.recorded == count
+
+    # The worker thread loads the sketches at start and persists them at stop.
+    os.remove(sketches.path)
+    sketches.clear()
+    sketches.start(lambda: Session(session.get_bind()))
+    sketches.stop()
+    assert sketches.recorded == count
+    assert os.path.exists(sketches.path)
+
+def test_read_replicas(client: TestClient, session: Session, tmp_path, monkeypatch):
+    # Two replicas, store 1 only exists on the first. The primary is the test session.
+    replicas = []
+    for name, stores in [("a", 1), ("b", 0)]:
+        replica = create_engine(f"sqlite:///{tmp_path / name}.db")
+        Base.metadata.create_all(replica)
+        with Session(replica) as db:
+            db.add_all([Stores() for _ in range(stores)])
+            db.commit()
+        replicas.append(replica)
+    monkeypatch.setattr(database, "read_engines", database.ReadEngines(replicas))
+    monkeypatch.setattr(database, "SessionLocal", sessionmaker(bind = session.get_bind()))
+    del app.dependency_overrides[get_read_db]
+
+    statuses = []
+    for _ in range(4):
+        entity_cache.clear()
+        statuses.append(client.get("/stores/1").status_code)
+    assert statuses == [200, 404, 200, 404]
+
+    # A connection checked out of the first replica sends every read to the second.
+    least_loaded = database.ReadEngines(replicas, "least_loaded")
+    with replicas[0].connect():
+        assert {least_loaded.pick() for _ in range(3)} == {replicas[1]}
+    assert {least_loaded.pick() for _ in range(2)} == set(replicas)
+    with pytest.raises(ValueError):
+        database.ReadEngines(replicas, "random")
+
+    # A replica may lag behind the data version, its aggregates are neither cached nor tagged with it.
+    stored = []
+    monkeypatch.setattr(query_cache, "set", lambda key, value: stored.append(key))
+    response = client.get("/query/instore_shoppers")
+    assert response.status_code == 200 and "ETag" not in response.headers
+    assert stored == []
+
+    # Reads following a commit go to the primary, which has stores 1 and 2.
+    writer = TestClient(database.ReadYourWritesMiddleware(app))
+    assert database.LAST_WRITE_COOKIE not in writer.get("/stores/1").cookies
+    writer.post("/stores/", json = {})
+    response = writer.post("/stores/", json = {})
+    assert response.json()["store_id"] == 2
+    assert database.LAST_WRITE_COOKIE in response.cookies
+    assert writer.get("/stores/2").status_code == 200
+    entity_cache.clear()
+    assert client.get("/stores/2").status_code == 404
+
+    monkeypatch.setitem(database.REPLICA_SETTINGS, "read_your_writes_seconds", 0)
+    assert writer.get("/stores/2").status_code == 404
+
+def test_materialized_aggregates(client: TestClient, session: Session, monkeypatch, caplog):
+    customers = get_customers_df(5)
+    customer_addresses = get_customer_addresses_df(list(customers.customer_id))
+    item_ids = [add_item(client) for i in range(1, 21)]
+    store_ids = [add_store(client) for i in range(1, 4)]
+    warehouse_ids = [add_warehouse(client) for i in range(1, 4)]
+    add_all(client, customers, customer_addresses, *get_orders_df(customers, customer_addresses, item_ids, store_ids, warehouse_ids))
+
+    # No snapshot until the worker has run, the request computes the answer.
+    response = client.get('/query/count_billing_orders')
+    assert 'X-As-Of' not in response.headers
+    exact = {path: json.loads(client.get(path).text) for path in ['/query/count_billing_orders', '/query/count_by_shipping_zip']}
+
+    materializer.refresh(session)
+    for path, counts in exact.items():
+        response = client.get(path)
+        assert json.loads(response.text) == counts
+        as_of = response.headers['X-As-Of']
+        assert datetime.fromisoformat(as_of).tzinfo is not None
+        response = client.get(path, headers = {'If-None-Match': response.headers['ETag']})
+        assert response.status_code == 304 and response.headers['X-As-Of'] == as_of
+    assert 'X-As-Of' not in client.get('/query/count_billing_orders', params = {'bucket': 'day'}).headers
+    assert 'X-As-Of' not in client.get('/query/count_by_shipping_zip', params = {'approx': True}).headers
+
+    # Out of date snapshots are answered until max_lag_seconds after the first write they miss,
+    # however old the snapshot itself is, and bypassed after.
+    old = materializer.latest('count_billing_orders')
+    old = old._replace(as_of = old.as_of - timedelta(hours = 1))
+    materializer._snapshots['count_billing_orders'] = old
+    data_version.bump()
+    materializer.mark_dirty()
+    assert client.get('/query/count_billing_orders').headers['X-As-Of'] == old.as_of.isoformat()
+    monkeypatch.setattr(materializer, 'max_lag_seconds', 0)
+    assert 'X-As-Of' not in client.get('/query/count_billing_orders').headers
+    monkeypatch.setattr(materializer, 'max_lag_seconds', 30)
+
+    # A failed refresh leaves the snapshot out of date, which is logged when it is served.
+    compute = materializer._views['count_billing_orders']
+    def failing(db):
+        raise ValueError('no rollup')
+    materializer.register('count_billing_orders', failing)
+    with caplog.at_level(logging.WARNING, logger = 'pier2.materializer'):
+        materializer.refresh(session)
+        assert client.get('/query/count_billing_orders').headers['X-As-Of'] == old.as_of.isoformat()
+    assert 'its refresh failed: no rollup' in caplog.text
+    materializer.register('count_billing_orders', compute)
+
+    # The worker refreshes at start, then when an order write raises the dirty flag.
+    monkeypatch.setattr(materializer, 'min_interval_seconds', 0.01)
+    def wait_for_current_snapshot():
+        for _ in range(500):
+            snapshot = materializer.latest('count_billing_orders')
+            if snapshot is not None and snapshot.version == data_version.value:
+                return snapshot
+            time.sleep(0.01)
+        raise AssertionError('The materializer did not refresh.')
+
+    materializer.start(lambda: Session(session.get_bind()))
+    try:
+        first = wait_for_current_snapshot()
+        data_version.bump()
+        materializer.mark_dirty()
+        assert wait_for_current_snapshot().as_of > first.as_of
+    finally:
+        materializer.stop()
+
+def test_windowed_aggregates(client: TestClient, session: Session):
+    customers = get_customers_df(5)
+    customer_addresses = get_customer_addresses_df(list(customers.customer_id))
+    item_ids = [add_item(client) for i in range(1, 21)]
+    store_ids = [add_store(client) for i in range(1, 4)]
+    warehouse_ids = [add_warehouse(client) for i in range(1, 4)]
+    orders, order_items = get_orders_df(customers, customer_addresses, item_ids, store_ids, warehouse_ids)
+    add_all(client, customers, customer_addresses, orders, order_items)
+
+    year = datetime.now().year
+    window = {'start': f'{year - 1}-01-01T00:00:00', 'end': f'{year}-01-01T00:00:00'}
+    all_orders = pd.read_sql("SELECT * FROM orders", session.bind, parse_dates = ['time_of_order'])
+    in_window = all_orders[(all_orders.time_of_order >= window['start']) & (all_orders.time_of_order < window['end'])]
+    all_customer_addresses = pd.read_sql("SELECT * FROM customer_addresses", session.bind)
+    all_order_items = pd.read_sql("SELECT * FROM order_items", session.bind)
+
+    billing = in_window.merge(all_customer_addresses, left_on = 'billing_address_id', right_on = 'customer_address_id')
+    resp = client.get('/query/count_billing_orders', params = window)
+    assert resp.status_code == 200, resp.content
+    assert json.loads(resp.text) == billing.groupby('zip_code').size().to_dict()
+
+    shipping = in_window[['order_id']].merge(all_order_items, on = 'order_id').merge(
+        all_customer_addresses, left_on = 'dest_customer_address_id', right_on = 'customer_address_id')
+    resp = client.get('/query/count_by_shipping_zip', params = window)
+    assert json.loads(resp.text) == shipping.groupby('zip_code')['order_id'].nunique().to_dict()
+
+    # One query for all the buckets, weeks start on Monday.
+    resp = client.get('/query/count_billing_orders', params = dict(window, bucket = 'week'))
+    assert resp.status_code == 200, resp.content
+    weeks = billing.time_of_order.dt.normalize() - pd.to_timedelta(billing.time_of_order.dt.weekday, unit = 'D')
+    expected = {}
+    for (week, zip_code), count in billing.groupby([weeks.dt.strftime('%Y-%m-%d'), 'zip_code']).size().items():
+        expected.setdefault(week, {})[zip_code] = count
+    assert json.loads(resp.text) == expected
+
+    # top_k applies per bucket.
+    resp = client.get('/query/instore_shoppers', params = {'top_k': 2, 'bucket': 'month'})
+    instore = all_orders[all_orders.source == 'store']
+    months = instore.time_of_order.dt.strftime('%Y-%m-01')
+    expected = instore.groupby([months, 'customer_id']).size().groupby(level = 0).nlargest(2)
+    result = json.loads(resp.text)
+    assert set(result) == set(months)
+    for month, counts in result.items():
+        assert sorted(counts.values(), reverse = True) == list(expected[month].values)
+
+    assert client.get('/query/count_billing_orders', params = {'start': window['end'], 'end': window['start']}).status_code == 422
+    assert client.get('/query/count_billing_orders', params = {'bucket': 'year'}).status_code == 422
+
+
+def test_time_bucket_dialects():
+    # Dates on both backends, so bucket keys (and the cache keys built from them) match.
+    for dialect in ['sqlite', 'postgresql']:
+        bucket = rollups.time_bucket(Orders.time_of_order, 'week', dialect)
+        assert str(bucket.type) == 'DATE'
+    assert str(rollups.time_bucket(Orders.time_of_order, 'month', 'postgresql').compile(dialect = postgresql.dialect())) == \
+        "CAST(date_trunc('month', orders.time_of_order) AS DATE)"
+
+def test_rollups_rebuild_and_verify(client: TestClient, session: Session):
+    customers = get_customers_df(3)
+    customer_addresses = get_customer_addresses_df(list(customers.customer_id))
+    item_ids = [add_item(client) for i in range(1, 21)]
+    store_ids = [add_store(client) for i in range(1, 4)]
+    warehouse_ids = [add_warehouse(client) for i in range(1, 4)]
+    orders, order_items = get_orders_df(customers, customer_addresses, item_ids, store_ids, warehouse_ids)
+    add_all(client, customers, customer_addresses, orders, order_items)
+
+    assert rollups.verify(session) == {}
+    expected = json.loads(client.get('/query/count_billing_orders').text)
+
+    session.execute(text("UPDATE billing_zip_order_counts SET order_count = order_count + 1"))
+    session.execute(text("DELETE FROM instore_shopper_counts"))
+    diffs = rollups.verify(session)
+    assert set(diffs) == {'billing_zip_order_counts', 'instore_shopper_counts'} or \
+        (set(diffs) == {'billing_zip_order_counts'} and (orders['source'] != OrderSource.store.value).all())
+
+    rollups.rebuild(session)
+    session.commit()
+    assert rollups.verify(session) == {}
+    assert json.loads(client.get('/query/count_billing_orders').text) == expected
+
+def test_seed(client: TestClient, session: Session):
+    item_ids = [add_item(client) for i in range(1, 21)]
+    store_ids = [add_store(client) for i in range(1, 4)]
+    warehouse_ids = [add_warehouse(client) for i in range(1, 4)]
+    # Rows already in the tables, the seeded ids must continue from them.
+    existing = get_customers_df(1)
+    existing_addresses = get_customer_addresses_df(list(existing.customer_id))
+    add_all(client, existing, existing_addresses)
+
+    customers = get_customers_df(5)
+    customers['email'] = 'seeded.' + customers.email
+    customer_addresses = get_customer_addresses_df(list(customers.customer_id))
+    orders, order_items = get_orders_df(customers, customer_addresses, item_ids, store_ids, warehouse_ids)
+    offsets = seed.seed(session, customers, customer_addresses, orders, order_items)
+    assert offsets['customers'] == 1 and offsets['customer_addresses'] == len(existing_addresses)
+    assert offsets['orders'] == 0 and offsets['order_items'] == 0
+    assert rollups.verify(session) == {}
+
+    # Same rows as posting them through the API would have created.
+    customer_id = int(customers.customer_id[0]) + offsets['customers']
+    resp = client.get(f'/customers/{customer_id}')
+    assert resp.status_code == 200 and json.loads(resp.text)['email'] == customers.email[0]
+    order = orders.iloc[0]
+    resp = client.get(f'/orders/{order.order_id}')
+    assert resp.status_code == 200, resp.content
+    result = json.loads(resp.text)
+    assert result['time_of_order'].replace('T', ' ') == order.time_of_order
+    assert result['source'] == order.source
+    assert result['billing_address_id'] == order.billing_address_id + offsets['customer_addresses']
+    assert len(result['items']) == (order_items.order_id == order.order_id).sum()
+
+    order_data = {'customer_id': 1, 'time_of_order': '2025-02-09 14:14:37', 'source': 1, 'billing_address_id': 1}
+    items = [{'item_id': item_ids[0], 'fulfillment_modality': 4, 'quantity': 1, 'price_per_item': 1.0,
+              'source_store_id': store_ids[0]}]
+    assert add_order(client, order_data, items) == len(orders) + 1
+
+def test_import_checks_match_validators():
+    def rejected(validator, value):
+        try:
+            validator(value)
+            return False
+        except ValueError:
+            return True
+
+    candidates = {
+        (validate_email, importer.EMAIL_REGEX): ['a@b.co', 'a@b', 'a b@c.d', '@b.c', 'a@b.c d', 'a@@b.c', 'x.y+z@q.r.s', ''],
+        (validate_phone_number, importer.PHONE_REGEX): ['111-222-3333', '1112223333', '111-222-333', '111-222-33334',
+                                                        'a11-222-3333', ' 111-222-3333'],
+        (validate_zip, importer.ZIP_REGEX): ['12345', '1234', '123456', '12a45', '02345', ' 12345'],
+    }
+    for (validator, pattern), values in candidates.items():
+        vectorized = importer._is_not(pd.Series(values, dtype = 'string'), pattern)
+        assert list(vectorized) == [rejected(validator, v) for v in values], validator.__name__
+
+    states = pd.DataFrame({'state': ['ca', 'CA', 'Ca', 'XX', 'C', 'ny']})
+    assert list(states.state.str.upper().isin(importer.states)) == [not rejected(validate_state, v) for v in states.state]
+
+@pytest.mark.parametrize('orders_format', ['csv', 'parquet'])
+def test_import(client: TestClient, session: Session, tmp_path, monkeypatch, orders_format):
+    if orders_format == 'parquet':
+        pytest.importorskip('pyarrow')
+    monkeypatch.setattr(importer, 'IMPORT_DIRECTORY', str(tmp_path))
+    monkeypatch.setattr(importer, 'IMPORT_CHUNK_SIZE', 7)
+
+    existing = add_customer(client, {"email": "pink@floyd.com", "first_name": "Pink", "last_name": "Floyd"})
+    customers = get_customers_df(6)
+    customer_addresses = get_customer_addresses_df(list(customers.customer_id))
+    item_ids = [add_item(client) for i in range(1, 21)]
+    store_ids = [add_store(client) for i in range(1, 4)]
+    warehouse_ids = [add_warehouse(client) for i in range(1, 4)]
+    orders, order_items = get_orders_df(customers, customer_addresses, item_ids, store_ids, warehouse_ids)
+    orders['time_of_order'] = orders.time_of_order.str.replace(' 00:00:00', ' 00:00:01')
+
+    bad_customers = pd.DataFrame([
+        {'customer_id': 100001, 'email': 'not-an-email', 'first_name': 'A', 'last_name': 'B'},
+        {'customer_id': 100002, 'email': 'pink@floyd.com', 'first_name': 'A', 'last_name': 'B'},
+        {'customer_id': 100003, 'email': customers.email[0], 'first_name': 'A', 'last_name': 'B'},
+        {'customer_id': 100004, 'email': 'x@y.com', 'first_name': ' ', 'last_name': 'B'},
+        {'customer_id': 100005, 'email': 'z@y.com', 'first_name': 'A', 'last_name': 'B', 'phone': '555'},
+        {'customer_id': 100006, 'email': 'w@y.com', 'first_name': 'A', 'last_name': 'B'},
+        {'customer_id': 100007, 'email': 'w@y.com', 'first_name': 'A', 'last_name': 'B'},
+    ])
+    bad_addresses = pd.DataFrame([
+        dict(customer_addresses.iloc[0], customer_address_id = 200001, state = 'XX'),
+        dict(customer_addresses.iloc[0], customer_address_id = 200002, zip_code = '123'),
+        dict(customer_addresses.iloc[0], customer_address_id = 200003, customer_id = 100001),
+        dict(customer_addresses.iloc[0], customer_address_id = 200004, is_billing = False, is_shipping = False),
+    ])
+    shipping_only = customer_addresses.query('not is_billing').customer_address_id
+    bad_orders = pd.DataFrame([
+        dict(orders.iloc[0], order_id = 300001, time_of_order = '2025-01-01 00:00:00'),
+        dict(orders.iloc[0], order_id = 300002, billing_address_id = 200001),
+        dict(orders.iloc[0], order_id = 300003, source = 7),
+    ] + ([dict(orders.iloc[0], order_id = 300004, billing_address_id = shipping_only.iloc[0])] if len(shipping_only) else []))
+    bad_items = pd.DataFrame([
+        dict(order_items.iloc[0], order_id = 300001),
+        dict(order_items.iloc[0], item_id = 999),
+        dict(order_items.iloc[0], fulfillment_modality = FulfillmentModality.store_inventory.value,
+             source_store_id = store_ids[0], source_warehouse_id = warehouse_ids[0],
+             dest_store_id = None, dest_customer_address_id = None),
+    ])
+    # An order may list the same item twice with the same source and destination.
+    order_items = pd.concat([order_items, order_items.iloc[:1].assign(order_item_id = len(order_items) + 1)],
+                            ignore_index = True)
+
+    pd.concat([customers, bad_customers]).to_csv(tmp_path / 'customers.csv', index = False)
+    pd.concat([customer_addresses, bad_addresses]).to_csv(tmp_path / 'addresses.csv', index = False)
+    write = {'csv': lambda frame, path: frame.to_csv(path, index = False), 'parquet': pd.DataFrame.to_parquet}[orders_format]
+    write(pd.concat([orders, bad_orders]), tmp_path / f'orders.{orders_format}')
+    write(pd.concat([order_items, bad_items]), tmp_path / f'items.{orders_format}')
+
+    resp = client.post('/admin/import', json = {'customers': 'customers.csv', 'customer_addresses': 'addresses.csv',
+                                                'orders': f'orders.{orders_format}', 'order_items': f'items.{orders_format}',
+                                                'rejects': 'rejects.csv'})
+    assert resp.status_code == 200, resp.content
+    result = json.loads(resp.text)
+    expected = {'customers': (len(customers) + 1, len(bad_customers) - 1),
+                'customer_addresses': (len(customer_addresses), len(bad_addresses)),
+                'orders': (len(orders), len(bad_orders)),
+                'order_items': (len(order_items), len(bad_items))}
+    for name, (imported, rejected) in expected.items():
+        assert result['tables'][name] == {'rows': imported + rejected, 'imported': imported, 'rejected': rejected}, name
+
+    details = {(r['table'], r['id']): r['detail'] for r in result['rejected']}
+    assert details[('customers', '100001')] == 'Invalid email format.'
+    assert details[('customers', '100002')] == 'A customer with this email exists already.'
+    # Rows of earlier chunks are in the database already.
+    assert details[('customers', '100003')] == 'A customer with this email exists already.'
+    assert details[('customers', '100007')] == 'The email appears more than once in the file.'
+    assert details[('customers', '100004')] == 'Invalid name as it was empty.'
+    assert details[('customers', '100005')] == 'Invalid phone number format.'
+    assert details[('customer_addresses', '200001')] == 'Invalid state XX.'
+    assert details[('customer_addresses', '200002')] == 'Invalid zip code.'
+    assert details[('customer_addresses', '200003')] == 'Unknown customer_id 100001'
+    assert details[('customer_addresses', '200004')].startswith('An address must be either')
+    assert details[('orders', '300001')] == 'Time of order must contain time information.'
+    assert details[('orders', '300002')] == 'Unknown billing_address_id 200001'
+    assert details[('orders', '300003')] == 'Invalid source.'
+    if len(shipping_only):
+        assert details[('orders', '300004')] == 'The address provided for billing is not marked as a billing address.'
+    item_rejections = [r['detail'] for r in result['rejected'] if r['table'] == 'order_items']
+    assert item_rejections == ['Unknown order_id 300001', 'Unknown item_id 999',
+                               'Cannot supply source_warehouse_id 1 or dest_store_id None or dest_customer_address_id None '
+                               'when FulfillmentModality.store_inventory.']
+    rejects = pd.read_csv(tmp_path / 'rejects.csv')
+    assert len(rejects) == sum(rejected for _, rejected in expected.values())
+
+    # Ids continue after the existing customer and references were translated.
+    email = customers.email[1]
+    assert json.loads(client.get(f'/customers/{existing + 2}').text)['email'] == email
+    history = json.loads(client.get('/query/order_history', params = {'email': email}).text)
+    source_orders = orders[orders.customer_id == customers.customer_id[1]]
+    assert len(history) == len(source_orders)
+    assert sum(len(o['items']) for o in history) == len(order_items[order_items.order_id.isin(source_orders.order_id)])
+    assert rollups.verify(session) == {}
+
+    assert client.post('/admin/import', json = {'customers': '../customers.csv'}).status_code == 422
+    assert client.post('/admin/import', json = {'customers': 'missing.csv'}).status_code == 422
+
+def test_query_plans_use_indexes(client: TestClient, session: Session):
+    index_advisor.seed_sample_data(client)
+    report = index_advisor.check(session.bind)
+
+    assert {path for path, _, _, _ in report} == {path for path, _ in index_advisor.sample_requests(session)}
+    for path, statement, plan, scans in report:
+        assert not scans, f"{path} scans {scans}: {statement} {plan}"